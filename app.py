@@ -1,22 +1,47 @@
 #3D slicer code:(app.py)
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
+from werkzeug.datastructures import MIMEAccept, MultiDict
 import os
 import io
 import base64
+import hashlib
+import importlib.util
+import itertools
+import json
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+from urllib.parse import urlencode
 
 import numpy as np
-import SimpleITK as sitk
-import pydicom
-from skimage import measure
 from PIL import Image
 
-# Try nibabel for NIfTI
+import dicom_ingest
+import upload_store
+
+# SimpleITK, pydicom, nibabel, scipy.ndimage, scikit-image and
+# fast-simplification are imported where they are used, so starting the
+# server (and every reload) does not pay for them before /list-items
+
+# nibabel for NIfTI, if installed
+HAVE_NIB = importlib.util.find_spec("nibabel") is not None
+
+# fast-simplification for quadric mesh decimation, if installed
+HAVE_SIMPLIFY = importlib.util.find_spec("fast_simplification") is not None
+
+# Try flask-sock for the WebSocket slice channel
 try:
-    import nibabel as nib
-    HAVE_NIB = True
+    from flask_sock import Sock
+    HAVE_SOCK = True
 except Exception:
-    HAVE_NIB = False
+    HAVE_SOCK = False
 
 
 # ------------------------------------------------------
@@ -24,10 +49,65 @@ except Exception:
 # ------------------------------------------------------
 app = Flask(__name__)
 CORS(app)
+sock = Sock(app) if HAVE_SOCK else None
 
 UPLOAD_FOLDER = "/mnt/external/Testing project/pythonProject2/upload"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Catalog of uploaded cases behind /list-items, and how often it checks
+# the upload tree for changes made outside the app (seconds)
+CATALOG_DB = os.environ.get("VIEWER_CATALOG_DB", UPLOAD_FOLDER.rstrip(os.sep) + ".catalog.sqlite")
+CATALOG_RESCAN_SECONDS = float(os.environ.get("VIEWER_CATALOG_RESCAN", 10))
+
+# Uploaded bytes by SHA-256 (shared with the segmentation service); files
+# under UPLOAD_FOLDER are links to these objects
+UPLOAD_OBJECTS = os.environ.get("UPLOAD_OBJECTS", UPLOAD_FOLDER.rstrip(os.sep) + ".objects")
+
+# Memory budget for decoded volumes kept between viewer requests (default 4 GB)
+VOLUME_CACHE_BYTES = int(os.environ.get("VIEWER_CACHE_BYTES", 4 * 1024 * 1024 * 1024))
+
+# Transcoded volumes are stored next to the upload as "<path>.vstore/"
+STORE_SUFFIX = ".vstore"
+STORE_BRICK = int(os.environ.get("VIEWER_BRICK_SIZE", 64))
+
+# Downsampled previews kept in the store ("pyramid-<f>.npy"); the
+# coarsest one answers /viewer/init and list thumbnails
+PREVIEW_FACTORS = (2, 4, 8)
+
+# Viewer axis name -> array axis of the (D, H, W) volume
+VIEW_AXES = {"axial": 0, "coronal": 1, "sagittal": 2}
+
+# Browser/proxy cache lifetime for binary slice responses (seconds)
+SLICE_MAX_AGE = int(os.environ.get("VIEWER_SLICE_MAX_AGE", 300))
+
+# Encoded slices kept in memory, and how far ahead of the slider to render
+RENDER_CACHE_BYTES = int(os.environ.get("VIEWER_RENDER_CACHE_BYTES", 256 * 1024 * 1024))
+PREFETCH_SLICES = int(os.environ.get("VIEWER_PREFETCH_SLICES", 8))
+PREFETCH_WORKERS = int(os.environ.get("VIEWER_PREFETCH_WORKERS", 2))
+MAX_BATCH_SLICES = 64
+
+# Oblique reformats: largest output edge, and how many slab samples are
+# interpolated per reduction block, and the output rows of a slab read
+# from the volume as one box
+MAX_REFORMAT_SIZE = 2048
+REFORMAT_BLOCK = 8
+REFORMAT_BAND_ROWS = 64
+
+# Edge length of /viewer/slice-tile tiles (pixels of the requested level)
+TILE_SIZE = int(os.environ.get("VIEWER_TILE_SIZE", 256))
+
+# Masks with at least this many voxels in their bounding box are meshed
+# in z-slabs across a process pool
+MESH_WORKERS = int(os.environ.get("VIEWER_MESH_WORKERS", min(8, os.cpu_count() or 1)))
+PARALLEL_MESH_MIN_VOXELS = int(os.environ.get("VIEWER_PARALLEL_MESH_MIN_VOXELS", 16 * 1024 * 1024))
+
+# Mesh level-of-detail pyramid: level name -> marching cubes step size,
+# coarsest first
+MESH_LODS = {"coarse": 4, "medium": 2, "full": 1}
+
+# Meshes kept in memory on top of the on-disk cache in the volume store
+MESH_CACHE_BYTES = int(os.environ.get("VIEWER_MESH_CACHE_BYTES", 512 * 1024 * 1024))
+
 
 # ------------------------------------------------------
 #  GLOBAL CORS
@@ -37,14 +117,51 @@ def apply_cors(resp):
     resp.headers["Access-Control-Allow-Origin"] = "*"
     resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
     resp.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+    resp.headers["Access-Control-Expose-Headers"] = (
+        "ETag, X-Slice-Shape, X-Slice-Dtype, X-Slice-Index, X-Slice-Count, X-Slice-Codec, X-Slice-Box, "
+        "X-Tile-Size, X-Tile-Grid, X-Level-Shape, "
+        "X-Mesh-Vertices, X-Mesh-Faces, X-Mesh-Groups"
+    )
     return resp
 
 
 # ------------------------------------------------------
-#  BASIC UTILITIES
+#  WINDOWING
 # ------------------------------------------------------
-def window_image(img, ww=400, wl=40):
-    """Apply CT windowing and return 8-bit image."""
+# Named (ww, wl) settings usable as "window": "<name>" in requests
+WINDOW_PRESETS = {
+    "soft_tissue": (400, 40),
+    "lung": (1500, -600),
+    "mediastinum": (350, 50),
+    "bone": (1800, 400),
+}
+
+# Integer dtypes windowed through a lookup table indexed by their bit pattern
+_LUT_INDEX_DTYPES = {
+    np.dtype(np.int8): np.dtype(np.uint8),
+    np.dtype(np.uint8): np.dtype(np.uint8),
+    np.dtype(np.int16): np.dtype(np.uint16),
+    np.dtype(np.uint16): np.dtype(np.uint16),
+}
+_LUT_CACHE = OrderedDict()      # (dtype, ww, wl) -> uint8 LUT
+_LUT_CACHE_SIZE = 32
+_LUT_LOCK = threading.Lock()
+
+
+def resolve_window(params, ww=400, wl=40):
+    """
+    (ww, wl) from a request: a named preset via "window", optionally
+    overridden by explicit "ww" / "wl".
+    """
+    preset = params.get("window")
+    if preset:
+        if preset not in WINDOW_PRESETS:
+            raise ValueError(f"Unknown window preset: {preset}")
+        ww, wl = WINDOW_PRESETS[preset]
+    return float(params.get("ww", ww)), float(params.get("wl", wl))
+
+
+def _window_float(img, ww, wl):
     img = img.astype(np.float32)
     low = wl - ww / 2.0
     high = wl + ww / 2.0
@@ -54,107 +171,437 @@ def window_image(img, ww=400, wl=40):
     return img
 
 
+def _window_lut(dtype, ww, wl):
+    key = (dtype, float(ww), float(wl))
+    with _LUT_LOCK:
+        lut = _LUT_CACHE.get(key)
+        if lut is not None:
+            _LUT_CACHE.move_to_end(key)
+            return lut
+
+    # every value of the dtype, ordered by its unsigned bit pattern
+    index_dtype = _LUT_INDEX_DTYPES[dtype]
+    values = np.arange(np.iinfo(index_dtype).max + 1, dtype=index_dtype).view(dtype)
+    lut = _window_float(values, ww, wl)
+
+    with _LUT_LOCK:
+        _LUT_CACHE[key] = lut
+        while len(_LUT_CACHE) > _LUT_CACHE_SIZE:
+            _LUT_CACHE.popitem(last=False)
+    return lut
+
+
+def window_image(img, ww=400, wl=40):
+    """
+    Apply CT windowing and return 8-bit image.
+    Works on a slice or a whole slab. 8/16-bit integer data goes through
+    a cached per-(ww, wl) lookup table in a single gather; other dtypes
+    use the float path.
+    """
+    img = np.asarray(img)
+    if img.dtype not in _LUT_INDEX_DTYPES:
+        return _window_float(img, ww, wl)
+    lut = _window_lut(img.dtype, ww, wl)
+    return lut[img.view(_LUT_INDEX_DTYPES[img.dtype])]
+
+
+# ------------------------------------------------------
+#  BASIC UTILITIES
+# ------------------------------------------------------
+# Overlay colour per label; label 1 keeps the original green, labels past
+# the end of the list cycle through it again.
+LABEL_PALETTE = [
+    (0, 255, 0), (255, 64, 64), (64, 128, 255), (255, 200, 0),
+    (200, 64, 255), (0, 220, 220), (255, 128, 0), (255, 64, 200),
+    (128, 255, 128), (160, 120, 60), (128, 160, 255), (255, 255, 160),
+]
+OVERLAY_ALPHA = 160
+
+_LABEL_LUT_CACHE = OrderedDict()    # (size, labels) -> (size, 4) uint8 LUT
+_LABEL_LUT_LOCK = threading.Lock()
+
+
+def label_color(label):
+    return LABEL_PALETTE[(int(label) - 1) % len(LABEL_PALETTE)]
+
+
+def parse_labels(value):
+    """Label subset from a list or "1,3" string; None (all labels) if empty."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = [v for v in value.split(",") if v.strip()]
+    labels = tuple(sorted({int(v) for v in value}))
+    if any(label <= 0 for label in labels):
+        raise ValueError("Labels must be positive integers")
+    return labels or None
+
+
+def _label_lut(size, labels):
+    """RGBA LUT over every possible label value; 0 and unselected labels transparent."""
+    key = (size, labels)
+    with _LABEL_LUT_LOCK:
+        lut = _LABEL_LUT_CACHE.get(key)
+        if lut is not None:
+            _LABEL_LUT_CACHE.move_to_end(key)
+            return lut
+
+    values = np.arange(size)
+    lut = np.zeros((size, 4), dtype=np.uint8)
+    lut[1:, :3] = np.asarray(LABEL_PALETTE, dtype=np.uint8)[(values[1:] - 1) % len(LABEL_PALETTE)]
+    lut[1:, 3] = OVERLAY_ALPHA
+    if labels is not None:
+        lut[~np.isin(values, labels)] = 0
+
+    with _LABEL_LUT_LOCK:
+        _LABEL_LUT_CACHE[key] = lut
+        while len(_LABEL_LUT_CACHE) > _LUT_CACHE_SIZE:
+            _LABEL_LUT_CACHE.popitem(last=False)
+    return lut
+
+
+def overlay_rgba(label_2d, labels=None):
+    """Label map → transparent RGBA image, one colour per label."""
+    if label_2d.dtype not in (np.uint8, np.uint16):
+        label_2d = np.clip(label_2d, 0, 65535).astype(np.uint16)
+    return _label_lut(256 if label_2d.dtype == np.uint8 else 65536, labels)[label_2d]
+
+
 def slice_to_png_base64(slice_2d, ww=400, wl=40):
     """Grayscale CT slice → PNG (base64)."""
-    arr = window_image(slice_2d, ww, wl)
-    pil_img = Image.fromarray(arr)
-    buf = io.BytesIO()
-    pil_img.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
+    png, _ = encode_image(window_image(slice_2d, ww, wl), "png")
+    return base64.b64encode(png).decode("utf-8")
 
 
-def mask_to_overlay_png_base64(mask_2d):
+def mask_to_overlay_png_base64(mask_2d, labels=None):
     """
-    Binary mask → transparent green PNG (base64).
+    Label map → transparent PNG (base64); label 1 is green.
     """
-    mask = (mask_2d > 0).astype(np.uint8)
-    h, w = mask.shape
-    rgba = np.zeros((h, w, 4), dtype=np.uint8)
-    rgba[mask > 0, 1] = 255     # green
-    rgba[mask > 0, 3] = 160     # alpha
-    pil_img = Image.fromarray(rgba, mode="RGBA")
+    png, _ = encode_image(overlay_rgba(mask_2d, labels), "png")
+    return base64.b64encode(png).decode("utf-8")
+
+
+# ------------------------------------------------------
+#  SLICE CODECS
+# ------------------------------------------------------
+def _encode_pil(arr, **save_args):
+    mode = "RGBA" if arr.ndim == 3 else "L"
     buf = io.BytesIO()
-    pil_img.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
+    Image.fromarray(arr, mode=mode).save(buf, **save_args)
+    return buf.getvalue()
+
+
+def _encode_png(arr, level=None, quality=None):
+    # PIL's default level 6 is several times slower than 1 for a few % size
+    return _encode_pil(arr, format="PNG", compress_level=1 if level is None else level)
+
+
+def _encode_webp(arr, level=None, quality=None):
+    return _encode_pil(arr, format="WEBP", lossless=True, method=1 if level is None else level)
+
+
+def _encode_jpeg(arr, level=None, quality=None):
+    if arr.ndim == 3:
+        raise ValueError("JPEG cannot carry the overlay alpha channel.")
+    return _encode_pil(arr, format="JPEG", quality=90 if quality is None else quality)
+
+
+def _encode_raw(arr, level=None, quality=None):
+    # little-endian, C order; shape and dtype are sent as headers
+    return np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder("<")).tobytes()
+
+
+# codec name -> (mimetype, encoder)
+SLICE_CODECS = {
+    "png": ("image/png", _encode_png),
+    "webp": ("image/webp", _encode_webp),
+    "jpeg": ("image/jpeg", _encode_jpeg),
+    "raw": ("application/octet-stream", _encode_raw),
+}
+
+
+def encode_image(arr, codec="png", level=None, quality=None):
+    """Encode a uint8/int16 (H, W) or RGBA (H, W, 4) array → (bytes, mimetype)."""
+    if codec not in SLICE_CODECS:
+        raise ValueError(f"Unknown codec: {codec}")
+    mimetype, encoder = SLICE_CODECS[codec]
+    return encoder(arr, level=level, quality=quality), mimetype
+
+
+def negotiate_codec(args, accept):
+    """Codec from an explicit ?codec= or else the Accept header, PNG by default."""
+    codec = args.get("codec")
+    if codec:
+        return codec
+    best = accept.best_match([mimetype for mimetype, _ in SLICE_CODECS.values()])
+    listed = {value for value, _ in accept}
+    for name, (mimetype, _) in SLICE_CODECS.items():
+        if best == mimetype and best in listed:   # not just matched by */*
+            return name
+    return "png"
+
+
+# ------------------------------------------------------
+#  VOLUME HANDLES
+# ------------------------------------------------------
+class VolumeHandle:
+    """
+    Lazily read (D, H, W) volume in its stored dtype.
+    Physical values are stored * slope + intercept; slices and slabs are
+    decoded and rescaled on demand, so nothing is read until it is needed.
+    """
+
+    def __init__(self, shape, dtype, spacing=(1.0, 1.0, 1.0), slope=1.0, intercept=0.0):
+        if len(shape) != 3:
+            raise ValueError(f"Expected a 3D volume, got shape {tuple(shape)}")
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.spacing = tuple(float(s) for s in spacing)
+        self.slope = float(slope)
+        self.intercept = float(intercept)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.modality = None    # DICOM Modality of DICOM sources
+
+    @property
+    def rescaled(self):
+        return self.slope != 1.0 or self.intercept != 0.0
+
+    def _read(self, slicer):
+        """Stored values for a tuple of three ints / slices."""
+        raise NotImplementedError
+
+    def _apply_rescale(self, arr):
+        arr = np.asarray(arr)
+        if not self.rescaled:
+            return arr
+        return arr.astype(np.float32) * np.float32(self.slope) + np.float32(self.intercept)
+
+    def get_slice(self, axis, index):
+        slicer = [slice(None)] * 3
+        slicer[axis] = int(index)
+        return self._apply_rescale(self._read(tuple(slicer)))
+
+    def get_slab(self, axis, start, stop):
+        slicer = [slice(None)] * 3
+        slicer[axis] = slice(start, stop)
+        return self._apply_rescale(self._read(tuple(slicer)))
+
+    def read(self, slicer=(slice(None),) * 3):
+        return self._apply_rescale(self._read(slicer))
+
+    def sample(self, coords, order=1):
+        """
+        float32 values at (3, N) voxel coordinates, trilinear (order 1)
+        or nearest (order 0); NaN outside the volume. Reads only the box
+        the coordinates span.
+        """
+        from scipy import ndimage
+
+        lo = np.maximum(np.floor(coords.min(axis=1)), 0).astype(int)
+        hi = np.minimum(np.floor(coords.max(axis=1)) + 2, self.shape).astype(int)
+        if np.any(hi <= lo):
+            return np.full(coords.shape[1], np.nan, np.float32)
+        arr = self.read(tuple(slice(a, b) for a, b in zip(lo, hi)))
+        return ndimage.map_coordinates(
+            arr, coords - lo.astype(np.float32)[:, None], order=order, output=np.float32,
+            mode="constant", cval=np.nan, prefilter=False,
+        )
+
+
+class ArrayVolumeHandle(VolumeHandle):
+    """Volume backed by an ndarray or np.memmap."""
+
+    def __init__(self, arr, spacing=(1.0, 1.0, 1.0), slope=1.0, intercept=0.0):
+        super().__init__(arr.shape, arr.dtype, spacing, slope, intercept)
+        self._arr = arr
+
+    def _read(self, slicer):
+        return self._arr[slicer]
+
+
+class NiftiVolumeHandle(VolumeHandle):
+    """NIfTI volume read through nibabel's array proxy (no float64 copy)."""
+
+    def __init__(self, path):
+        import nibabel as nib
+
+        img = nib.load(path)
+        self._proxy = img.dataobj
+        # Read raw values and rescale ourselves when the proxy allows it;
+        # otherwise let nibabel scale each slab it reads.
+        self._raw = hasattr(self._proxy, "_get_unscaled")
+        slope, inter = 1.0, 0.0
+        if self._raw:
+            slope = float(getattr(self._proxy, "slope", 1.0))
+            inter = float(getattr(self._proxy, "inter", 0.0))
+            if not np.isfinite(slope) or slope == 0:
+                slope = 1.0
+            if not np.isfinite(inter):
+                inter = 0.0
+        # nibabel arrays are used in their on-disk axis order
+        super().__init__(img.shape, img.get_data_dtype(),
+                         img.header.get_zooms()[:3], slope, inter)
+
+    def _read(self, slicer):
+        if self._raw:
+            return self._proxy._get_unscaled(slicer=slicer)
+        return np.asarray(self._proxy[slicer])
+
+
+class SitkVolumeHandle(VolumeHandle):
+    """Single-file image (e.g. NRRD) read region by region with SimpleITK."""
+
+    def __init__(self, path):
+        import SimpleITK as sitk
+
+        self.path = path
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(path)
+        reader.ReadImageInformation()
+        size = reader.GetSize()                   # (x, y, z)
+        if len(size) != 3:
+            raise ValueError(f"Expected a 3D image, got size {size}")
+        # Read one voxel to learn the numpy dtype SimpleITK produces
+        reader.SetExtractIndex([0, 0, 0])
+        reader.SetExtractSize([1, 1, 1])
+        dtype = sitk.GetArrayFromImage(reader.Execute()).dtype
+        super().__init__(tuple(reversed(size)), dtype, tuple(reversed(reader.GetSpacing())))
+
+    def _read(self, slicer):
+        import SimpleITK as sitk
+
+        index, size, post = [], [], []
+        for s, n in zip(slicer, self.shape):
+            if isinstance(s, slice):
+                start, stop, step = s.indices(n)
+                index.append(start)
+                size.append(max(stop - start, 0))
+                post.append(slice(None, None, step))
+            else:
+                s = int(s) + n if int(s) < 0 else int(s)
+                index.append(s)
+                size.append(1)
+                post.append(0)
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(self.path)
+        reader.SetExtractIndex(list(reversed(index)))
+        reader.SetExtractSize(list(reversed(size)))
+        arr = sitk.GetArrayFromImage(reader.Execute())
+        return arr[tuple(post)]
+
+
+class LabelVolumeHandle(VolumeHandle):
+    """
+    Integer label map view of another volume: values are rounded, and
+    anything below zero is background. uint8 for 8-bit sources, else uint16.
+    """
+
+    def __init__(self, base):
+        small = base.dtype.itemsize == 1 and not base.rescaled
+        super().__init__(base.shape, np.uint8 if small else np.uint16, base.spacing)
+        self._base = base
+        self.modality = base.modality
+
+    def _read(self, slicer):
+        values = self._base._apply_rescale(self._base._read(slicer))
+        if values.dtype == self.dtype:
+            return values
+        if np.issubdtype(values.dtype, np.floating):
+            values = np.rint(values)
+        return np.clip(values, 0, np.iinfo(self.dtype).max).astype(self.dtype)
 
 
 # ------------------------------------------------------
 #  LOADERS
 # ------------------------------------------------------
-def load_dicom_series(folder):
-    reader = sitk.ImageSeriesReader()
-    files = reader.GetGDCMSeriesFileNames(folder)
-    if len(files) == 0:
-        raise ValueError(f"No DICOM series found in: {folder}")
-    reader.SetFileNames(files)
-    img = reader.Execute()
-    vol = sitk.GetArrayFromImage(img)         # (z, y, x)
-    return vol.astype(np.float32)
+def load_dicom_series(path):
+    """DICOM folder or ZIP via dicom_ingest (indexed headers, parallel decode)."""
+    series = dicom_ingest.load_series(path)
+    handle = ArrayVolumeHandle(series.pixels, series.spacing, series.slope, series.intercept)
+    handle.modality = series.modality
+    return handle
+
+
+def load_dicom_file(path):
+    import pydicom
+
+    ds = pydicom.dcmread(path)
+    arr = ds.pixel_array[np.newaxis, ...]
+    slope = float(getattr(ds, "RescaleSlope", 1))
+    intercept = float(getattr(ds, "RescaleIntercept", 0))
+    spacing = [float(getattr(ds, "SliceThickness", 1.0) or 1.0)]
+    spacing += [float(v) for v in getattr(ds, "PixelSpacing", (1.0, 1.0))]
+    handle = ArrayVolumeHandle(arr, spacing, slope, intercept)
+    handle.modality = str(getattr(ds, "Modality", "") or "") or None
+    return handle
+
+
+def _find_volume_file(folder):
+    """First .npy / NIfTI / NRRD file in folder, in that order of preference."""
+    files = os.listdir(folder)
+    npy_files = [f for f in files if f.lower().endswith(".npy")]
+    nii_files = [f for f in files if f.lower().endswith((".nii", ".nii.gz"))]
+    nrrd_files = [f for f in files if f.lower().endswith(".nrrd")]
+
+    if npy_files:
+        return os.path.join(folder, npy_files[0])
+    if nii_files and HAVE_NIB:
+        return os.path.join(folder, nii_files[0])
+    if nrrd_files:
+        return os.path.join(folder, nrrd_files[0])
+    return None
+
+
+def _open_volume_file(path):
+    """VolumeHandle for a single .npy / NIfTI / NRRD file, or None."""
+    low = path.lower()
+    if low.endswith(".npy"):
+        return ArrayVolumeHandle(np.load(path, mmap_mode="r"))
+    if low.endswith((".nii", ".nii.gz")) and HAVE_NIB:
+        return NiftiVolumeHandle(path)
+    if low.endswith(".nrrd"):
+        return SitkVolumeHandle(path)
+    return None
 
 
 def load_ct_volume(path):
     """
-    Load CT volume from folder/file (.npy / .nii(.gz) / .nrrd / .dcm).
-    Returns (D, H, W).
+    Open CT volume from folder/file (.npy / .nii(.gz) / .nrrd / .dcm /
+    DICOM .zip).
+    Returns a VolumeHandle of shape (D, H, W).
     """
     if not os.path.exists(path):
         raise FileNotFoundError(f"CT path does not exist: {path}")
 
     if os.path.isdir(path):
-        files = os.listdir(path)
-        npy_files = [f for f in files if f.lower().endswith(".npy")]
-        nii_files = [f for f in files if f.lower().endswith((".nii", ".nii.gz"))]
-        nrrd_files = [f for f in files if f.lower().endswith(".nrrd")]
-        dcm_files = [f for f in files if f.lower().endswith(".dcm")]
-
-        if npy_files:
-            vol = np.load(os.path.join(path, npy_files[0]))
-            return vol.astype(np.float32)
-
-        if nii_files and HAVE_NIB:
-            img = nib.load(os.path.join(path, nii_files[0]))
-            vol = img.get_fdata()
-            return vol.astype(np.float32)
-
-        if nrrd_files:
-            img = sitk.ReadImage(os.path.join(path, nrrd_files[0]))
-            vol = sitk.GetArrayFromImage(img)
-            return vol.astype(np.float32)
-
-        if dcm_files:
+        vol_file = _find_volume_file(path)
+        if vol_file:
+            return _open_volume_file(vol_file)
+
+        if any(f.lower().endswith(".dcm") for f in os.listdir(path)):
             return load_dicom_series(path)
 
         raise ValueError("No CT volume found in folder.")
 
     # single file
-    low = path.lower()
-    if low.endswith(".npy"):
-        return np.load(path).astype(np.float32)
-
-    if low.endswith((".nii", ".nii.gz")) and HAVE_NIB:
-        img = nib.load(path)
-        return img.get_fdata().astype(np.float32)
+    handle = _open_volume_file(path)
+    if handle is not None:
+        return handle
 
-    if low.endswith(".nrrd"):
-        img = sitk.ReadImage(path)
-        return sitk.GetArrayFromImage(img).astype(np.float32)
+    if path.lower().endswith(".dcm"):
+        return load_dicom_file(path)
 
-    if low.endswith(".dcm"):
-        ds = pydicom.dcmread(path)
-        arr = ds.pixel_array.astype(np.float32)
-        slope = getattr(ds, "RescaleSlope", 1)
-        intercept = getattr(ds, "RescaleIntercept", 0)
-        vol = arr * slope + intercept
-        return vol[np.newaxis, ...]
+    if path.lower().endswith(".zip"):
+        return load_dicom_series(path)
 
     raise ValueError("Unsupported CT format.")
 
 
 def load_seg_volume(path):
     """
-    Load segmentation (.npy / .nii(.gz) / .nrrd / .dcm, file or folder).
-    Returns binary mask (D, H, W) in {0,1}.
-    Supports DICOM-SEG via SimpleITK, merging all labels if 4D.
+    Open segmentation (.npy / .nii(.gz) / .nrrd / .dcm, file or folder).
+    Returns a label map VolumeHandle (D, H, W): 0 is background, every
+    other value a label. 4D DICOM-SEG segments become labels 1..N.
     """
     if not path:
         raise ValueError("Empty segmentation path.")
@@ -162,59 +609,830 @@ def load_seg_volume(path):
     if not os.path.exists(path):
         raise FileNotFoundError(f"Segmentation path does not exist: {path}")
 
-    seg = None
-
     # ----- Folder -----
     if os.path.isdir(path):
-        files = os.listdir(path)
-        npy_files = [f for f in files if f.lower().endswith(".npy")]
-        nii_files = [f for f in files if f.lower().endswith((".nii", ".nii.gz"))]
-        nrrd_files = [f for f in files if f.lower().endswith(".nrrd")]
-        dcm_files = [f for f in files if f.lower().endswith(".dcm")]
-
-        if npy_files:
-            seg = np.load(os.path.join(path, npy_files[0]))
-        elif nii_files and HAVE_NIB:
-            img = nib.load(os.path.join(path, nii_files[0]))
-            seg = img.get_fdata()
-        elif nrrd_files:
-            img = sitk.ReadImage(os.path.join(path, nrrd_files[0]))
-            seg = sitk.GetArrayFromImage(img)
-        elif dcm_files:
+        seg_file = _find_volume_file(path)
+        if seg_file is None:
+            dcm_files = [f for f in os.listdir(path) if f.lower().endswith(".dcm")]
+            if not dcm_files:
+                raise ValueError("No segmentation file in folder.")
             # Take first DICOM-SEG object in folder
-            seg_img = sitk.ReadImage(os.path.join(path, dcm_files[0]))
-            seg = sitk.GetArrayFromImage(seg_img)
-        else:
-            raise ValueError("No segmentation file in folder.")
+            seg_file = os.path.join(path, dcm_files[0])
 
     # ----- Single file -----
     else:
-        low = path.lower()
-        if low.endswith(".npy"):
-            seg = np.load(path)
-        elif low.endswith((".nii", ".nii.gz")) and HAVE_NIB:
-            img = nib.load(path)
-            seg = img.get_fdata()
-        elif low.endswith(".nrrd"):
-            img = sitk.ReadImage(path)
-            seg = sitk.GetArrayFromImage(img)
-        elif low.endswith(".dcm"):
-            # DICOM-SEG: SimpleITK will read as image (possibly 4D)
-            seg_img = sitk.ReadImage(path)
-            seg = sitk.GetArrayFromImage(seg_img)
-        else:
-            raise ValueError("Unsupported segmentation format.")
+        seg_file = path
+
+    handle = _open_volume_file(seg_file)
+    if handle is not None:
+        return LabelVolumeHandle(handle)
+
+    if not seg_file.lower().endswith(".dcm"):
+        raise ValueError("Unsupported segmentation format.")
 
-    # ----- Convert to binary mask, handle 4D SEG -----
-    seg = np.asarray(seg)
+    # DICOM-SEG: SimpleITK will read as image (possibly 4D)
+    import SimpleITK as sitk
 
-    # If 4D (num_labels, z, y, x) -> merge labels into one mask
+    seg_img = sitk.ReadImage(seg_file)
+    seg = sitk.GetArrayFromImage(seg_img)
+    spacing = tuple(reversed(seg_img.GetSpacing()))[-3:]
+
+    # If 4D (num_segments, z, y, x) -> segment i becomes label i + 1
     if seg.ndim == 4:
-        seg = (seg > 0).any(axis=0).astype(np.uint8)
-    else:
-        seg = (seg > 0).astype(np.uint8)
+        labels = np.zeros(seg.shape[1:], dtype=np.uint8 if len(seg) < 256 else np.uint16)
+        for i, segment in enumerate(seg):
+            labels[segment > 0] = i + 1
+        return ArrayVolumeHandle(labels, spacing)
+
+    return LabelVolumeHandle(ArrayVolumeHandle(seg, spacing))
+
+
+# ------------------------------------------------------
+#  CHUNKED VOLUME STORE
+# ------------------------------------------------------
+# Each volume is transcoded once into <path>.vstore/:
+#   header.json  shape, spacing, dtype, brick size, source mtime/size
+#   bricks.bin   (gz, gy, gx, B, B, B) bricks, each brick contiguous
+# A slice along any axis only touches the bricks it intersects.
+# Label maps are stored sparse: bricks.bin holds only the non-empty
+# bricks, and brick_index.npy maps each grid cell to one of them (-1 for
+# an all-zero brick).
+
+class ChunkedVolume(VolumeHandle):
+    """Memory-mapped, brick-layout volume produced by build_chunked_store()."""
+
+    def __init__(self, store_dir, header):
+        super().__init__(header["shape"], header["dtype"], header["spacing"])
+        self.store_dir = store_dir
+        self.header = header
+        self.modality = header.get("modality")
+        self.brick = header["brick"]
+        self.grid = tuple(-(-n // self.brick) for n in self.shape)
+        self._index = None
+        if header.get("sparse"):
+            self._index = np.load(os.path.join(store_dir, "brick_index.npy"))
+            stored = int(self._index.max(initial=-1)) + 1
+            self.nbytes = stored * self.brick ** 3 * self.dtype.itemsize
+            if stored == 0:     # empty label map: nothing to map
+                self._bricks = np.zeros((0,) + (self.brick,) * 3, dtype=self.dtype)
+                return
+        self._bricks = np.memmap(
+            os.path.join(store_dir, "bricks.bin"),
+            dtype=self.dtype,
+            mode="r",
+            shape=(self.grid if self._index is None else (stored,)) + (self.brick,) * 3,
+        )
+
+    def _bricks_at(self, cells, inner=()):
+        """self._bricks[cells + inner] as if the store were dense."""
+        if self._index is None:
+            return self._bricks[cells + inner]
+        index = self._index[cells]
+        out = np.zeros(index.shape + np.empty((self.brick,) * 3)[inner].shape, dtype=self.dtype)
+        present = index >= 0
+        if present.any():
+            out[present] = self._bricks[(index[present],) + inner]
+        return out
+
+    def get_slice(self, axis, index):
+        D, H, W = self.shape
+        gz, gy, gx = self.grid
+        B = self.brick
+        b, o = divmod(int(index), B)
+
+        if axis == 0:
+            plane = self._bricks_at((b, slice(None), slice(None)), (o,))      # (gy, gx, B, B)
+            return plane.transpose(0, 2, 1, 3).reshape(gy * B, gx * B)[:H, :W]
+        if axis == 1:
+            plane = self._bricks_at((slice(None), b, slice(None)), (slice(None), o))    # (gz, gx, B, B)
+            return plane.transpose(0, 2, 1, 3).reshape(gz * B, gx * B)[:D, :W]
+        plane = self._bricks_at((slice(None), slice(None), b), (slice(None), slice(None), o))   # (gz, gy, B, B)
+        return plane.transpose(0, 2, 1, 3).reshape(gz * B, gy * B)[:D, :H]
+
+    def _read(self, slicer):
+        # Gather the bricks covering the requested box, then crop
+        B = self.brick
+        lo, hi, post = [], [], []
+        for s, n in zip(slicer, self.shape):
+            if isinstance(s, slice):
+                start, stop, step = s.indices(n)
+                stop = max(stop, start)
+                post.append(slice(None, None, step))
+            else:
+                start = int(s) + n if int(s) < 0 else int(s)
+                stop = start + 1
+                post.append(0)
+            lo.append(start)
+            hi.append(stop)
+
+        sub = self._bricks_at((
+            slice(lo[0] // B, -(-hi[0] // B)),
+            slice(lo[1] // B, -(-hi[1] // B)),
+            slice(lo[2] // B, -(-hi[2] // B)),
+        ))
+        gz, gy, gx = sub.shape[:3]
+        block = sub.transpose(0, 3, 1, 4, 2, 5).reshape(gz * B, gy * B, gx * B)
+        box = tuple(slice(l % B, l % B + (h - l)) for l, h in zip(lo, hi))
+        return block[box][tuple(post)]
+
+    def _brick_offsets(self, idx):
+        """Offsets into the flat brick file of (3, N) integer voxel coordinates (-1: empty brick)."""
+        B = self.brick
+        cells, inner = np.divmod(idx, B)
+        local = (inner[0] * B + inner[1]) * B + inner[2]
+        if self._index is None:
+            _, gy, gx = self.grid
+            brick = (cells[0] * gy + cells[1]) * gx + cells[2]
+        else:
+            brick = self._index[cells[0], cells[1], cells[2]].astype(np.int64)
+        return np.where(brick >= 0, brick * B ** 3 + local, -1)
+
+    def sample(self, coords, order=1):
+        # Gathers the voxels straight from the bricks they are in, so an
+        # oblique plane reads only the pages it passes through
+        shape = np.asarray(self.shape)[:, None]
+        flat = self._bricks.reshape(-1)
+        out = np.full(coords.shape[1], np.nan, np.float32)
+        if order == 0:
+            idx = np.floor(coords + 0.5).astype(np.int64)
+            valid = ((idx >= 0) & (idx < shape)).all(axis=0)
+            offsets = self._brick_offsets(idx[:, valid])
+            values = np.zeros(len(offsets), np.float32)
+            values[offsets >= 0] = flat[offsets[offsets >= 0]]
+            out[valid] = values
+            return self._apply_rescale(out)
+
+        valid = ((coords >= 0) & (coords <= shape - 1)).all(axis=0)
+        coords = coords[:, valid]
+        base = np.floor(coords).astype(np.int64)
+        frac = (coords - base).astype(np.float32)
+        top = np.minimum(base + 1, shape - 1)
+        acc = np.zeros(coords.shape[1], np.float32)
+        if self._index is None:
+            # dense store: the flat offset is a sum of per-axis terms
+            B = self.brick
+            _, gy, gx = self.grid
+            strides = ((gy * gx * B ** 3, B * B), (gx * B ** 3, B), (B ** 3, 1))
+            terms = [[(i // B) * cell + (i % B) * step for i in (base[a], top[a])]
+                     for a, (cell, step) in enumerate(strides)]
+            for kz, ky, kx in itertools.product((0, 1), repeat=3):
+                weight = ((frac[0] if kz else 1 - frac[0]) * (frac[1] if ky else 1 - frac[1])
+                          * (frac[2] if kx else 1 - frac[2]))
+                acc += weight * flat[terms[0][kz] + terms[1][ky] + terms[2][kx]]
+        else:
+            for corner in itertools.product((0, 1), repeat=3):
+                idx = np.stack([top[a] if k else base[a] for a, k in enumerate(corner)])
+                offsets = self._brick_offsets(idx)
+                values = np.zeros(len(offsets), np.float32)
+                values[offsets >= 0] = flat[offsets[offsets >= 0]]
+                weight = np.ones(len(offsets), np.float32)
+                for a, k in enumerate(corner):
+                    weight *= frac[a] if k else 1 - frac[a]
+                acc += weight * values
+        out[valid] = acc
+        return self._apply_rescale(out)
+
+
+class _NeedsWiderStore(Exception):
+    """Raised when a slab's values do not fit the store dtype being written."""
+
+
+# Store dtypes to try per volume kind, narrowest first
+STORE_DTYPES = {
+    "ct": (np.dtype(np.int16), np.dtype(np.float32)),
+    "seg": (np.dtype(np.uint8), np.dtype(np.uint16)),
+}
+STORE_VERSION = 3
+
+
+def store_dir_for(path):
+    return os.path.realpath(path).rstrip(os.sep) + STORE_SUFFIX
+
+
+def _fit_store_dtype(slab, dtype):
+    """Return slab if it converts to the integer store dtype without loss."""
+    if not np.issubdtype(dtype, np.integer) or slab.dtype == dtype or slab.size == 0:
+        return slab
+    info = np.iinfo(dtype)
+    if slab.min() < info.min or slab.max() > info.max:
+        raise _NeedsWiderStore()
+    if not np.issubdtype(slab.dtype, np.integer) and not np.array_equal(slab, np.rint(slab)):
+        raise _NeedsWiderStore()
+    return slab
+
+
+def open_chunked_store(store_dir, signature):
+    """Open an existing store, or return None if missing or stale."""
+    header_path = os.path.join(store_dir, "header.json")
+    try:
+        with open(header_path) as fh:
+            header = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if header.get("version") != STORE_VERSION:
+        return None
+    if header.get("source") != {"mtime_ns": signature[1], "size": signature[2]}:
+        return None
+    return ChunkedVolume(store_dir, header)
+
+
+def _brick_slabs(handle, dtype):
+    """Yield (bz, (gy, gx, B, B, B) bricks) for each brick-thick z slab."""
+    B = STORE_BRICK
+    D, H, W = handle.shape
+    gz, gy, gx = (-(-n // B) for n in handle.shape)
+    slab = np.zeros((B, gy * B, gx * B), dtype=dtype)
+    for bz in range(gz):
+        part = _fit_store_dtype(handle.get_slab(0, bz * B, min(D, (bz + 1) * B)), dtype)
+        slab.fill(0)
+        slab[:part.shape[0], :H, :W] = part
+        # (B, gy, B, gx, B) -> (gy, gx, B, B, B)
+        yield bz, slab.reshape(B, gy, B, gx, B).transpose(1, 3, 0, 2, 4)
+
+
+def _write_bricks(handle, bricks_path, dtype):
+    B = STORE_BRICK
+    gz, gy, gx = (-(-n // B) for n in handle.shape)
+    bricks = np.memmap(bricks_path, dtype=dtype, mode="w+", shape=(gz, gy, gx, B, B, B))
+    try:
+        for bz, slab in _brick_slabs(handle, dtype):
+            bricks[bz] = slab
+        bricks.flush()
+    finally:
+        del bricks
+
+
+def _write_sparse_bricks(handle, bricks_path, dtype):
+    """Write only the non-zero bricks; returns the (gz, gy, gx) brick index."""
+    gz, gy, gx = (-(-n // STORE_BRICK) for n in handle.shape)
+    index = np.full((gz, gy, gx), -1, dtype=np.int32)
+    stored = 0
+    with open(bricks_path, "wb") as fh:
+        for bz, slab in _brick_slabs(handle, dtype):
+            present = slab.reshape(gy, gx, -1).any(axis=2)
+            count = int(present.sum())
+            index[bz][present] = np.arange(stored, stored + count)
+            fh.write(np.ascontiguousarray(slab[present]).tobytes())
+            stored += count
+    return index
+
+
+def build_chunked_store(handle, store_dir, signature, kind):
+    """
+    Transcode a VolumeHandle into a brick store, one brick-thick slab at
+    a time, and open it. Label maps are stored sparse as uint8 (uint16 if
+    there are more labels) and CT as int16 unless its values are
+    fractional or out of range, in which case float32.
+    """
+    tmp_dir = f"{store_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    bricks_path = os.path.join(tmp_dir, "bricks.bin")
+    try:
+        # each dtype is verified slab by slab while writing
+        sparse = kind == "seg"
+        for dtype in STORE_DTYPES[kind]:
+            try:
+                if sparse:
+                    np.save(os.path.join(tmp_dir, "brick_index.npy"),
+                            _write_sparse_bricks(handle, bricks_path, dtype))
+                else:
+                    _write_bricks(handle, bricks_path, dtype)
+                break
+            except _NeedsWiderStore:
+                continue
+
+        header = {
+            "version": STORE_VERSION,
+            "kind": kind,
+            "modality": handle.modality,
+            "shape": list(handle.shape),
+            "spacing": list(handle.spacing),
+            "dtype": dtype.name,
+            "brick": STORE_BRICK,
+            "sparse": sparse,
+            "source": {"mtime_ns": signature[1], "size": signature[2]},
+        }
+        with open(os.path.join(tmp_dir, "header.json"), "w") as fh:
+            json.dump(header, fh)
+
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.replace(tmp_dir, store_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return ChunkedVolume(store_dir, header)
+
+
+def open_volume(path, kind, signature):
+    """
+    Open the chunked store for path, transcoding it on first use, and
+    queue its preview pyramid if it has none yet. Falls back to the lazy
+    source handle if the store cannot be written.
+    """
+    store_dir = store_dir_for(path)
+    vol = open_chunked_store(store_dir, signature)
+    if vol is None:
+        handle = load_seg_volume(path) if kind == "seg" else load_ct_volume(path)
+        try:
+            vol = build_chunked_store(handle, store_dir, signature, kind)
+        except OSError:
+            return handle
+    schedule_pyramid(vol, kind)
+    return vol
+
+
+def _halve(arr, kind):
+    """
+    2x downsample on every axis (odd lengths edge-padded). CT uses the
+    2x2x2 block mean as its anti-aliasing filter; label maps keep the
+    highest label in each block so thin structures survive.
+    """
+    pad = [(0, n % 2) for n in arr.shape]
+    if any(p for _, p in pad):
+        arr = np.pad(arr, pad, mode="edge")
+    d, h, w = (n // 2 for n in arr.shape)
+    blocks = arr.reshape(d, 2, h, 2, w, 2)
+    if kind == "seg":
+        return blocks.max(axis=(1, 3, 5))
+    mean = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+    if np.issubdtype(arr.dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(arr.dtype)
+
+
+def pyramid_path(store_dir, factor):
+    return os.path.join(store_dir, f"pyramid-{factor}.npy")
+
+
+def build_pyramid(vol, kind):
+    """
+    Write every PREVIEW_FACTORS level into the store of a ChunkedVolume.
+    The first level is built slab by slab from the bricks, the others
+    from the level before; the coarsest is written last.
+    """
+    D, H, W = vol.shape
+    tmp = f"{pyramid_path(vol.store_dir, 2)}.tmp-{os.getpid()}-{threading.get_ident()}.npy"
+    level = np.lib.format.open_memmap(
+        tmp, mode="w+", dtype=vol.dtype, shape=tuple(-(-n // 2) for n in vol.shape)
+    )
+    try:
+        planes = 2 * 16
+        for z0 in range(0, D, planes):
+            half = _halve(vol.get_slab(0, z0, min(D, z0 + planes)), kind)
+            level[z0 // 2:z0 // 2 + len(half)] = half
+        level.flush()
+    finally:
+        del level
+    os.replace(tmp, pyramid_path(vol.store_dir, 2))
+
+    arr = np.load(pyramid_path(vol.store_dir, 2))
+    for factor in PREVIEW_FACTORS[1:]:
+        arr = _halve(arr, kind)
+        tmp = f"{pyramid_path(vol.store_dir, factor)}.tmp-{os.getpid()}-{threading.get_ident()}.npy"
+        np.save(tmp, arr)
+        os.replace(tmp, pyramid_path(vol.store_dir, factor))
+
+
+PYRAMID_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview-pyramid")
+_QUEUED_PYRAMIDS = set()    # (store_dir, source mtime, source size)
+_QUEUED_PYRAMIDS_LOCK = threading.Lock()
+
+
+def schedule_pyramid(vol, kind):
+    """Build the preview pyramid of a store in the background, once."""
+    if os.path.exists(pyramid_path(vol.store_dir, PREVIEW_FACTORS[-1])):
+        return
+    source = vol.header["source"]
+    key = (vol.store_dir, source["mtime_ns"], source["size"])
+    with _QUEUED_PYRAMIDS_LOCK:
+        if key in _QUEUED_PYRAMIDS:
+            return
+        _QUEUED_PYRAMIDS.add(key)
+
+    def build():
+        try:
+            build_pyramid(vol, kind)
+        except Exception:
+            # previews are optional; full-resolution slices still work,
+            # and the next open of the volume tries again
+            app.logger.exception("Preview pyramid of %s failed", vol.store_dir)
+            with _QUEUED_PYRAMIDS_LOCK:
+                _QUEUED_PYRAMIDS.discard(key)
+    PYRAMID_POOL.submit(build)
+
+
+# ------------------------------------------------------
+#  VOLUME CACHE
+# ------------------------------------------------------
+def path_signature(path):
+    """
+    (realpath, mtime_ns, size) describing the current contents of path.
+    For folders the newest mtime and total size of the files directly
+    inside are used, matching what the folder loaders read.
+    """
+    if not path or not os.path.exists(path):
+        raise FileNotFoundError(f"Path does not exist: {path}")
+
+    real = os.path.realpath(path)
+    st = os.stat(real)
+    if not os.path.isdir(real):
+        return real, st.st_mtime_ns, st.st_size
+
+    mtime, size = st.st_mtime_ns, 0
+    with os.scandir(real) as entries:
+        for entry in entries:
+            if entry.is_file():
+                est = entry.stat()
+                mtime = max(mtime, est.st_mtime_ns)
+                size += est.st_size
+    return real, mtime, size
 
-    return seg
+
+class _PendingLoad:
+    """A load in progress; other requests for the same key wait on it."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ByteLRUCache:
+    """
+    Process-wide LRU cache bounded by the total nbytes of its values.
+    Keys are tuples whose second element is the source realpath.
+    Concurrent requests for the same key share a single load.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._entries = OrderedDict()   # key -> (value, nbytes)
+        self._pending = {}              # key -> _PendingLoad
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries or key in self._pending
+
+    def get(self, key, loader):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = _PendingLoad()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            value = loader()
+        except Exception as e:
+            pending.error = e
+            with self._lock:
+                del self._pending[key]
+            pending.event.set()
+            raise
+
+        with self._lock:
+            del self._pending[key]
+            self._put(key, value)
+        pending.value = value
+        pending.event.set()
+        return value
+
+    def _put(self, key, value):
+        nbytes = int(getattr(value, "nbytes", 0))
+        if nbytes > self.max_bytes:
+            return  # would evict everything else; serve it uncached
+        while self._entries and self.total_bytes + nbytes > self.max_bytes:
+            _, (_, old_bytes) = self._entries.popitem(last=False)
+            self.total_bytes -= old_bytes
+            self.evictions += 1
+        self._entries[key] = (value, nbytes)
+        self.total_bytes += nbytes
+
+    def invalidate(self, path):
+        """
+        Drop every entry loaded from path, from a folder containing path,
+        or from a file inside path.
+        """
+        real = os.path.realpath(path)
+        with self._lock:
+            for key in list(self._entries):
+                cached = key[1]
+                if (cached == real
+                        or real.startswith(cached + os.sep)
+                        or cached.startswith(real + os.sep)):
+                    _, nbytes = self._entries.pop(key)
+                    self.total_bytes -= nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+            }
+
+
+VOLUME_CACHE = ByteLRUCache(VOLUME_CACHE_BYTES)
+RENDER_CACHE = ByteLRUCache(RENDER_CACHE_BYTES)
+MESH_CACHE = ByteLRUCache(MESH_CACHE_BYTES)
+
+
+def get_ct_volume(path):
+    """Cached, chunked CT volume for path."""
+    sig = path_signature(path)
+    return VOLUME_CACHE.get(("ct",) + sig, lambda: open_volume(path, "ct", sig))
+
+
+def get_seg_volume(path):
+    """Cached, chunked segmentation mask for path."""
+    sig = path_signature(path)
+    return VOLUME_CACHE.get(("seg",) + sig, lambda: open_volume(path, "seg", sig))
+
+
+def invalidate_caches(path):
+    VOLUME_CACHE.invalidate(path)
+    RENDER_CACHE.invalidate(path)
+    MESH_CACHE.invalidate(path)
+
+
+@app.route("/viewer/window-presets", methods=["GET"])
+def viewer_window_presets():
+    return jsonify({name: {"ww": ww, "wl": wl} for name, (ww, wl) in WINDOW_PRESETS.items()})
+
+
+@app.route("/viewer/cache-stats", methods=["GET"])
+def viewer_cache_stats():
+    return jsonify({"volumes": VOLUME_CACHE.stats(), "slices": RENDER_CACHE.stats(),
+                    "meshes": MESH_CACHE.stats()})
+
+
+# ------------------------------------------------------
+#  SEGMENTATION OCCUPANCY INDEX
+# ------------------------------------------------------
+class SliceOccupancy:
+    """
+    Which slices of a label map contain anything, where, and how much.
+    zy / zx / yx are the mask's "any" projections onto each pair of axes;
+    every slice's bounding box follows from two of them. counts[axis] is
+    (slices, labels) voxel counts for the labels in `labels`.
+    """
+
+    def __init__(self, zy, zx, yx, labels, counts):
+        self.zy, self.zx, self.yx = zy, zx, yx
+        self.labels = labels
+        self.counts = counts
+        self.nbytes = zy.nbytes + zx.nbytes + yx.nbytes + sum(c.nbytes for c in counts)
+
+    def _columns(self, labels):
+        if labels is None:
+            return slice(None)
+        return np.isin(self.labels, labels)
+
+    def occupied(self, axis, labels=None):
+        """Boolean per slice along axis: any (selected) label present."""
+        return self.counts[axis][:, self._columns(labels)].sum(axis=1) > 0
+
+    def is_empty(self, axis, index, labels=None):
+        return not self.counts[axis][index, self._columns(labels)].any()
+
+    def bbox(self, axis, index):
+        """(row0, row1, col0, col1) of the labels in a slice, or None if empty."""
+        if axis == 0:
+            rows, cols = self.zy[index], self.zx[index]
+        elif axis == 1:
+            rows, cols = self.zy[:, index], self.yx[index]
+        else:
+            rows, cols = self.zx[:, index], self.yx[:, index]
+        r, c = np.flatnonzero(rows), np.flatnonzero(cols)
+        if r.size == 0 or c.size == 0:
+            return None
+        return int(r[0]), int(r[-1]) + 1, int(c[0]), int(c[-1]) + 1
+
+    def summary(self, labels=None):
+        """JSON: voxels per label, and per axis the first/last slice and [start, stop) runs."""
+        axes = {}
+        for name, axis in VIEW_AXES.items():
+            occupied = self.occupied(axis, labels)
+            edges = np.flatnonzero(np.diff(np.concatenate([[0], occupied.astype(np.int8), [0]])))
+            runs = edges.reshape(-1, 2).tolist()
+            axes[name] = {
+                "first": runs[0][0] if runs else None,
+                "last": runs[-1][1] - 1 if runs else None,
+                "ranges": runs,
+            }
+        return {
+            "labels": [
+                {"label": int(label), "voxels": int(voxels),
+                 "color": "#%02x%02x%02x" % label_color(label)}
+                for label, voxels in zip(self.labels, self.counts[0].sum(axis=0))
+            ],
+            "axes": axes,
+        }
+
+
+def build_occupancy(seg):
+    """One pass over a label map in brick-thick axial slabs."""
+    D, H, W = seg.shape
+    zy = np.zeros((D, H), dtype=bool)
+    zx = np.zeros((D, W), dtype=bool)
+    yx = np.zeros((H, W), dtype=bool)
+    counts = {}     # label -> [per z, per y, per x] voxel counts
+
+    for z0 in range(0, D, STORE_BRICK):
+        slab = seg.get_slab(0, z0, min(D, z0 + STORE_BRICK))
+        nonzero = slab > 0
+        if not nonzero.any():
+            continue
+        zy[z0:z0 + len(slab)] = nonzero.any(axis=2)
+        zx[z0:z0 + len(slab)] = nonzero.any(axis=1)
+        yx |= nonzero.any(axis=0)
+        for label in np.unique(slab[nonzero]):
+            mask = slab == label
+            c = counts.setdefault(int(label), [np.zeros(D, np.int32), np.zeros(H, np.int32), np.zeros(W, np.int32)])
+            c[0][z0:z0 + len(slab)] += mask.sum(axis=(1, 2), dtype=np.int32)
+            c[1] += mask.sum(axis=(0, 2), dtype=np.int32)
+            c[2] += mask.sum(axis=(0, 1), dtype=np.int32)
+
+    labels = np.array(sorted(counts), dtype=np.int64)
+    per_axis = [
+        np.stack([counts[label][axis] for label in labels], axis=1) if len(labels)
+        else np.zeros((n, 0), np.int32)
+        for axis, n in enumerate(seg.shape)
+    ]
+    return SliceOccupancy(zy, zx, yx, labels, per_axis)
+
+
+def get_occupancy(path):
+    """Occupancy index of the segmentation at path, cached in memory and next to its store."""
+    sig = path_signature(path)
+
+    def load():
+        cache_path = os.path.join(store_dir_for(path), "occupancy.npz")
+        seg = get_seg_volume(path)
+        if isinstance(seg, ChunkedVolume) and os.path.exists(cache_path):
+            try:
+                with np.load(cache_path) as c:
+                    return SliceOccupancy(c["zy"], c["zx"], c["yx"], c["labels"],
+                                          [c["counts0"], c["counts1"], c["counts2"]])
+            except Exception:
+                pass    # unreadable cache entry: rebuild it
+
+        occ = build_occupancy(seg)
+        if isinstance(seg, ChunkedVolume):
+            # the store is rebuilt (and this file dropped) when the source changes
+            tmp_path = f"{cache_path}.tmp-{os.getpid()}-{threading.get_ident()}.npz"
+            try:
+                np.savez(tmp_path, zy=occ.zy, zx=occ.zx, yx=occ.yx, labels=occ.labels,
+                         counts0=occ.counts[0], counts1=occ.counts[1], counts2=occ.counts[2])
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                pass
+        return occ
+
+    return VOLUME_CACHE.get(("occupancy",) + sig, load)
+
+
+_EMPTY_OVERLAYS = {}    # (shape, codec, level, quality) -> (body, mimetype)
+_EMPTY_OVERLAYS_LOCK = threading.Lock()
+
+
+def empty_overlay(shape, codec="png", level=None, quality=None):
+    """Encoded fully transparent overlay, encoded once per shape and codec."""
+    key = (tuple(shape), codec, level, quality)
+    with _EMPTY_OVERLAYS_LOCK:
+        cached = _EMPTY_OVERLAYS.get(key)
+    if cached is None:
+        arr = np.zeros(tuple(shape) + (4,), dtype=np.uint8)
+        cached = encode_image(arr, codec, level, quality)
+        with _EMPTY_OVERLAYS_LOCK:
+            _EMPTY_OVERLAYS[key] = cached
+    return cached
+
+
+def seg_overlay_png_base64(seg_path, seg, axis, index, labels=None):
+    """Full-size overlay PNG (base64) of one slice; empty slices skip the read and encode."""
+    if get_occupancy(seg_path).is_empty(axis, index, labels):
+        plane_shape = [n for a, n in enumerate(seg.shape) if a != axis]
+        return base64.b64encode(empty_overlay(plane_shape)[0]).decode("utf-8")
+    return mask_to_overlay_png_base64(seg.get_slice(axis, index), labels)
+
+
+def seg_overlay_preview_base64(seg_path, seg, axis, index, factor, labels=None):
+    """
+    Overlay PNG (base64) of one full-resolution slice, downsampled by
+    factor the way seg preview levels are, for when the CT preview
+    exists but the seg pyramid has not been built yet.
+    """
+    plane_shape = [-(-n // factor) for a, n in enumerate(seg.shape) if a != axis]
+    if get_occupancy(seg_path).is_empty(axis, index, labels):
+        return base64.b64encode(empty_overlay(plane_shape)[0]).decode("utf-8")
+    arr = seg.get_slice(axis, index)[None]
+    for _ in range(int(factor).bit_length() - 1):
+        arr = _halve(arr, "seg")
+    return mask_to_overlay_png_base64(arr[0], labels)
+
+
+@app.route("/viewer/seg-occupancy", methods=["GET"])
+def viewer_seg_occupancy():
+    """
+    Where a segmentation has labels, so the viewer can jump to them.
+    Query: path, labels=1,3 (default all)
+    Response: { shape, labels: [{ label, voxels, color }],
+                axes: { axial|coronal|sagittal: { first, last, ranges } } }
+    """
+    try:
+        path = request.args["path"]
+        labels = parse_labels(request.args.get("labels"))
+        summary = get_occupancy(path).summary(labels)
+        summary["shape"] = list(get_seg_volume(path).shape)
+        return jsonify(summary)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+# ------------------------------------------------------
+#  PREVIEW PYRAMID
+# ------------------------------------------------------
+def get_preview(path, kind, factor=PREVIEW_FACTORS[-1]):
+    """
+    factor-times downsampled handle of the volume at path, or None while
+    its pyramid has not been built yet.
+    """
+    vol = get_seg_volume(path) if kind == "seg" else get_ct_volume(path)
+    if not isinstance(vol, ChunkedVolume):
+        return None
+    level_path = pyramid_path(vol.store_dir, factor)
+    if not os.path.exists(level_path):
+        return None
+
+    def load():
+        spacing = tuple(s * factor for s in vol.spacing)
+        return ArrayVolumeHandle(np.load(level_path, mmap_mode="r"), spacing)
+    return VOLUME_CACHE.get((f"{kind}-preview-{factor}",) + path_signature(path), load)
+
+
+def has_thumbnail(path):
+    return os.path.exists(pyramid_path(store_dir_for(path), PREVIEW_FACTORS[-1]))
+
+
+@app.route("/viewer/thumbnail", methods=["GET"])
+def viewer_thumbnail():
+    """
+    Middle axial slice of the coarsest preview as PNG: windowed CT, or
+    the label overlay for segmentations.
+    Query: path, ww, wl and/or window=<preset>
+    """
+    try:
+        path = request.args["path"]
+        sig = path_signature(path)
+        with open(os.path.join(store_dir_for(path), "header.json")) as fh:
+            kind = json.load(fh)["kind"]
+        preview = get_preview(path, kind)
+        if preview is None:
+            return jsonify({"error": "No thumbnail yet"}), 404
+
+        window = resolve_window(request.args)
+        etag = slice_etag(("thumbnail",) + sig + (window,))
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            plane = preview.get_slice(0, preview.shape[0] // 2)
+            arr = overlay_rgba(plane) if kind == "seg" else window_image(plane, *window)
+            body, mimetype = encode_image(arr, "png")
+            resp = Response(body, mimetype=mimetype)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = f"private, max-age={SLICE_MAX_AGE}"
+        return resp
+
+    except FileNotFoundError:
+        return jsonify({"error": "No thumbnail yet"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
 
 
 # ------------------------------------------------------
@@ -222,21 +1440,34 @@ def load_seg_volume(path):
 # ------------------------------------------------------
 @app.route("/viewer/init", methods=["POST"])
 def viewer_init():
+    """
+    Shape, middle indices and the three middle planes (+ overlays).
+    With "preview": true the planes come from the coarsest preview level
+    when it exists ("preview_factor" > 1); the viewer then fetches the
+    full-resolution slices to replace them.
+    """
     try:
         data = request.get_json()
         ct_path = data["path"]
         seg_path = data.get("seg_path", "").strip()
-        ww = data.get("ww", 400)
-        wl = data.get("wl", 40)
+        labels = parse_labels(data.get("labels"))
+        ww, wl = resolve_window(data)
 
-        vol = load_ct_volume(ct_path)
+        vol = get_ct_volume(ct_path)
         D, H, W = vol.shape
         mid = {"z": D // 2, "y": H // 2, "x": W // 2}
 
+        factor = 1
+        if data.get("preview"):
+            preview = get_preview(ct_path, "ct")
+            if preview is not None:
+                vol, factor = preview, PREVIEW_FACTORS[-1]
+        at = {k: v // factor for k, v in mid.items()}
+
         # CT slices (NO rotation; we rotate sagittal/coronal in frontend)
-        axial_slice = vol[mid["z"], :, :]
-        sag_slice = vol[:, :, mid["x"]]      # (D, H)
-        cor_slice = vol[:, mid["y"], :]      # (D, W)
+        axial_slice = vol.get_slice(0, at["z"])
+        sag_slice = vol.get_slice(2, at["x"])       # (D, H)
+        cor_slice = vol.get_slice(1, at["y"])       # (D, W)
 
         axial_b64 = slice_to_png_base64(axial_slice, ww, wl)
         sagittal_b64 = slice_to_png_base64(sag_slice, ww, wl)
@@ -247,21 +1478,29 @@ def viewer_init():
         coronal_seg_b64 = None
 
         if seg_path:
-            seg = load_seg_volume(seg_path)
-            if seg.shape != vol.shape:
-                raise ValueError(f"Segmentation shape {seg.shape} does not match CT {vol.shape}")
-
-            axial_mask = seg[mid["z"], :, :]
-            sag_mask = seg[:, :, mid["x"]]
-            cor_mask = seg[:, mid["y"], :]
-
-            axial_seg_b64 = mask_to_overlay_png_base64(axial_mask)
-            sagittal_seg_b64 = mask_to_overlay_png_base64(sag_mask)
-            coronal_seg_b64 = mask_to_overlay_png_base64(cor_mask)
+            seg = get_seg_volume(seg_path)
+            if seg.shape != (D, H, W):
+                raise ValueError(f"Segmentation shape {seg.shape} does not match CT {(D, H, W)}")
+            warm_mesh_lods(seg_path)
+
+            seg_preview = get_preview(seg_path, "seg") if factor > 1 else None
+            if seg_preview is not None:
+                axial_seg_b64 = mask_to_overlay_png_base64(seg_preview.get_slice(0, at["z"]), labels)
+                sagittal_seg_b64 = mask_to_overlay_png_base64(seg_preview.get_slice(2, at["x"]), labels)
+                coronal_seg_b64 = mask_to_overlay_png_base64(seg_preview.get_slice(1, at["y"]), labels)
+            elif factor > 1:
+                axial_seg_b64 = seg_overlay_preview_base64(seg_path, seg, 0, mid["z"], factor, labels)
+                sagittal_seg_b64 = seg_overlay_preview_base64(seg_path, seg, 2, mid["x"], factor, labels)
+                coronal_seg_b64 = seg_overlay_preview_base64(seg_path, seg, 1, mid["y"], factor, labels)
+            else:
+                axial_seg_b64 = seg_overlay_png_base64(seg_path, seg, 0, mid["z"], labels)
+                sagittal_seg_b64 = seg_overlay_png_base64(seg_path, seg, 2, mid["x"], labels)
+                coronal_seg_b64 = seg_overlay_png_base64(seg_path, seg, 1, mid["y"], labels)
 
         return jsonify({
             "shape": {"depth": D, "height": H, "width": W},
             "mid_indices": mid,
+            "preview_factor": factor,
             "axial_png": axial_b64,
             "sagittal_png": sagittal_b64,
             "coronal_png": coronal_b64,
@@ -285,43 +1524,26 @@ def viewer_slice():
         seg_path = data.get("seg_path", "").strip()
         axis = data["axis"]
         index = int(data["index"])
-        ww = data.get("ww", 400)
-        wl = data.get("wl", 40)
+        labels = parse_labels(data.get("labels"))
+        ww, wl = resolve_window(data)
 
-        vol = load_ct_volume(ct_path)
-        D, H, W = vol.shape
-
-        if axis == "axial":
-            index = max(0, min(D - 1, index))
-            ct_slice = vol[index, :, :]
-
-        elif axis == "sagittal":
-            index = max(0, min(W - 1, index))
-            ct_slice = vol[:, :, index]
-
-        elif axis == "coronal":
-            index = max(0, min(H - 1, index))
-            ct_slice = vol[:, index, :]
-
-        else:
+        if axis not in VIEW_AXES:
             return jsonify({"error": "Invalid axis"}), 400
+        ax = VIEW_AXES[axis]
+
+        vol = get_ct_volume(ct_path)
+        index = max(0, min(vol.shape[ax] - 1, index))
+        ct_slice = vol.get_slice(ax, index)
 
         ct_b64 = slice_to_png_base64(ct_slice, ww, wl)
 
         seg_b64 = None
         if seg_path:
-            seg = load_seg_volume(seg_path)
+            seg = get_seg_volume(seg_path)
             if seg.shape != vol.shape:
                 raise ValueError(f"Segmentation shape {seg.shape} does not match CT {vol.shape}")
 
-            if axis == "axial":
-                mask_slice = seg[index, :, :]
-            elif axis == "sagittal":
-                mask_slice = seg[:, :, index]
-            else:
-                mask_slice = seg[:, index, :]
-
-            seg_b64 = mask_to_overlay_png_base64(mask_slice)
+            seg_b64 = seg_overlay_png_base64(seg_path, seg, ax, index, labels)
 
         return jsonify({"png_ct": ct_b64, "png_seg": seg_b64})
 
@@ -329,35 +1551,1420 @@ def viewer_slice():
         return jsonify({"error": str(e)}), 400
 
 
+# ------------------------------------------------------
+#  RENDERED SLICE CACHE + PREFETCH
+# ------------------------------------------------------
+class RenderedSlice:
+    """Encoded slice body plus the metadata sent with it."""
+
+    def __init__(self, body, mimetype, index, shape, dtype, box=None):
+        self.body = body
+        self.mimetype = mimetype
+        self.index = index
+        self.shape = shape
+        self.dtype = dtype
+        self.box = box      # (row0, row1, col0, col1) of a cropped overlay
+        self.nbytes = len(body)
+
+
+def parse_slice_params(args, accept, needs_axis=True):
+    """Rendering parameters shared by the binary slice endpoints."""
+    params = {
+        "layer": args.get("layer", "ct"),
+        "axis": args["axis"] if needs_axis else None,
+        "window": resolve_window(args),
+        "codec": negotiate_codec(args, accept),
+        "level": args.get("level", type=int),
+        "quality": args.get("quality", type=int),
+        "dtype": args.get("dtype", "uint8"),
+        "labels": parse_labels(args.get("labels")),
+        "crop": args.get("crop", "0").lower() in ("1", "true"),
+    }
+    if needs_axis and params["axis"] not in VIEW_AXES:
+        raise ValueError("Invalid axis")
+    if params["layer"] not in ("ct", "seg"):
+        raise ValueError("Invalid layer")
+    if params["codec"] not in SLICE_CODECS:
+        raise ValueError(f"Unknown codec: {params['codec']}")
+    if params["codec"] == "png" and params["level"] is None:
+        params["level"] = 1
+    return params
+
+
+def slice_cache_key(sig, params, index):
+    return ("slice",) + sig + (
+        params["layer"], params["axis"], index, params["window"],
+        params["codec"], params["level"], params["quality"], params["dtype"],
+        params["labels"], params["crop"],
+    )
+
+
+def slice_etag(key):
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def _render_seg_slice(path, vol, params, index):
+    """
+    Overlay slice using the occupancy index: empty slices get the shared
+    transparent image, and with crop only the labels' bounding box is
+    read and encoded.
+    """
+    axis = VIEW_AXES[params["axis"]]
+    occ = get_occupancy(path)
+
+    if occ.is_empty(axis, index, params["labels"]):
+        if not params["crop"]:
+            shape = tuple(n for a, n in enumerate(vol.shape) if a != axis)
+        elif params["codec"] == "raw":
+            shape = (0, 0)
+        else:
+            shape = (1, 1)      # images need a pixel; the box says there is nothing
+        box = (0, 0, 0, 0) if params["crop"] else None
+        if params["codec"] == "raw":
+            return _render_slice(np.zeros(shape, dtype=vol.dtype), params, index, box)
+        body, mimetype = empty_overlay(shape, params["codec"], params["level"], params["quality"])
+        return RenderedSlice(body, mimetype, index, shape + (4,), "uint8", box)
+
+    if not params["crop"]:
+        return _render_slice(vol.get_slice(axis, index), params, index)
+
+    # crop to the bounding box of the slice's labels
+    box = occ.bbox(axis, index)
+    rows, cols = [a for a in range(3) if a != axis]
+    slicer = [None] * 3
+    slicer[axis] = index
+    slicer[rows] = slice(box[0], box[1])
+    slicer[cols] = slice(box[2], box[3])
+    return _render_slice(vol.read(tuple(slicer)), params, index, box)
+
+
+def _render_slice(plane, params, index, box=None):
+    codec = params["codec"]
+
+    if params["layer"] == "seg":
+        if codec != "raw":
+            arr = overlay_rgba(plane, params["labels"])
+        elif params["labels"] is not None:
+            arr = np.where(np.isin(plane, params["labels"]), plane, 0).astype(plane.dtype)
+        else:
+            arr = plane
+    elif codec == "raw" and params["dtype"] == "int16":
+        arr = np.clip(np.rint(plane), -32768, 32767).astype(np.int16)
+    else:
+        arr = window_image(plane, *params["window"])
+
+    body, mimetype = encode_image(arr, codec, params["level"], params["quality"])
+    return RenderedSlice(body, mimetype, index, arr.shape, arr.dtype.name, box)
+
+
+def render_slice(path, sig, params, index):
+    """Encoded slice from RENDER_CACHE, rendering it on a miss."""
+    def load():
+        if params["layer"] == "seg":
+            return _render_seg_slice(path, get_seg_volume(path), params, index)
+        vol = get_ct_volume(path)
+        return _render_slice(vol.get_slice(VIEW_AXES[params["axis"]], index), params, index)
+    return RENDER_CACHE.get(slice_cache_key(sig, params, index), load)
+
+
+def render_slice_range(path, sig, params, indices):
+    """
+    Encoded slices for a contiguous range. CT slices missing from the
+    cache are read and windowed as one slab, then encoded one by one.
+    """
+    keys = [slice_cache_key(sig, params, i) for i in indices]
+    missing = [i for i, key in zip(indices, keys) if key not in RENDER_CACHE]
+    raw16 = params["codec"] == "raw" and params["dtype"] == "int16"
+
+    if len(missing) > 1 and params["layer"] == "ct" and not raw16:
+        ax = VIEW_AXES[params["axis"]]
+        lo, hi = missing[0], missing[-1] + 1
+        windowed = window_image(get_ct_volume(path).get_slab(ax, lo, hi), *params["window"])
+        for i in missing:
+            arr = np.take(windowed, i - lo, axis=ax)
+            body, mimetype = encode_image(arr, params["codec"], params["level"], params["quality"])
+            rendered = RenderedSlice(body, mimetype, i, arr.shape, arr.dtype.name)
+            RENDER_CACHE.get(slice_cache_key(sig, params, i), lambda: rendered)
+
+    return [render_slice(path, sig, params, i) for i in indices]
+
+
+PREFETCH_POOL = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="slice-prefetch")
+
+# (realpath, layer, axis) -> (last index, direction, generation)
+_SCRUB_STATE = {}
+_SCRUB_LOCK = threading.Lock()
+
+
+def schedule_prefetch(path, sig, params, index, length):
+    """
+    Render the next PREFETCH_SLICES slices in the direction the slider is
+    moving. Work queued for an older position is dropped when it starts.
+    """
+    stream = (sig[0], params["layer"], params["axis"])
+    with _SCRUB_LOCK:
+        last, step, gen = _SCRUB_STATE.get(stream, (index, 1, 0))
+        if index != last:
+            step = 1 if index > last else -1
+        gen += 1
+        _SCRUB_STATE[stream] = (index, step, gen)
+
+    for k in range(1, PREFETCH_SLICES + 1):
+        i = index + step * k
+        if not 0 <= i < length:
+            break
+        if slice_cache_key(sig, params, i) in RENDER_CACHE:
+            continue
+        PREFETCH_POOL.submit(_prefetch_slice, stream, gen, path, sig, params, i)
+
+
+def _prefetch_slice(stream, gen, path, sig, params, index):
+    with _SCRUB_LOCK:
+        if _SCRUB_STATE.get(stream, (None, None, gen))[2] != gen:
+            return  # the slider has moved on
+    try:
+        render_slice(path, sig, params, index)
+    except Exception:
+        pass    # prefetch is best effort; a real request will report errors
+
+
+# ------------------------------------------------------
+#  VIEWER: BINARY SLICE (GET, cacheable)
+# ------------------------------------------------------
+@app.route("/viewer/slice-image", methods=["GET"])
+def viewer_slice_image():
+    """
+    One CT slice or overlay as a binary image.
+    Query: path, axis, index, layer=ct|seg, ww, wl and/or window=<preset>,
+           codec=png|webp|jpeg|raw (else negotiated from Accept),
+           level (PNG zlib level / WebP method), quality (JPEG),
+           dtype=uint8|int16 (raw CT only: windowed bytes or HU values),
+           labels=1,3 (seg only: labels to draw, default all),
+           crop=1 (seg only: encode just the labels' bounding box, given
+           as X-Slice-Box "row0,row1,col0,col1"; "0,0,0,0" if empty)
+    """
+    try:
+        path = request.args["path"]
+        index = int(request.args["index"])
+        params = parse_slice_params(request.args, request.accept_mimetypes)
+
+        sig = path_signature(path)
+        vol = get_seg_volume(path) if params["layer"] == "seg" else get_ct_volume(path)
+        length = vol.shape[VIEW_AXES[params["axis"]]]
+        index = max(0, min(length - 1, index))
+
+        etag = slice_etag(slice_cache_key(sig, params, index))
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            rendered = render_slice(path, sig, params, index)
+            resp = Response(rendered.body, mimetype=rendered.mimetype)
+            if params["codec"] == "raw":
+                resp.headers["X-Slice-Shape"] = ",".join(str(n) for n in rendered.shape)
+                resp.headers["X-Slice-Dtype"] = rendered.dtype
+            if rendered.box is not None:
+                resp.headers["X-Slice-Box"] = ",".join(str(n) for n in rendered.box)
+
+        if PREFETCH_SLICES > 0:
+            schedule_prefetch(path, sig, params, index, length)
+
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = f"private, max-age={SLICE_MAX_AGE}"
+        resp.headers["X-Slice-Index"] = str(index)
+        return resp
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/viewer/slice-batch", methods=["GET"])
+def viewer_slice_batch():
+    """
+    A contiguous range of slices in one response.
+    Query: as /viewer/slice-image, with start and count instead of index.
+    Body: for each slice, little-endian uint32 index, uint32 length,
+    then the encoded slice. X-Slice-Count and X-Slice-Codec describe it.
+    """
+    try:
+        path = request.args["path"]
+        start = int(request.args["start"])
+        count = max(0, min(MAX_BATCH_SLICES, int(request.args.get("count", PREFETCH_SLICES))))
+        params = parse_slice_params(request.args, request.accept_mimetypes)
+
+        sig = path_signature(path)
+        vol = get_seg_volume(path) if params["layer"] == "seg" else get_ct_volume(path)
+        length = vol.shape[VIEW_AXES[params["axis"]]]
+        indices = range(max(0, start), min(length, start + count))
+
+        etag = slice_etag(("batch",) + slice_cache_key(sig, params, (indices.start, indices.stop)))
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            parts = []
+            for i, rendered in zip(indices, render_slice_range(path, sig, params, indices)):
+                parts.append(struct.pack("<II", i, rendered.nbytes))
+                parts.append(rendered.body)
+            resp = Response(b"".join(parts), mimetype="application/octet-stream")
+
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = f"private, max-age={SLICE_MAX_AGE}"
+        resp.headers["X-Slice-Count"] = str(len(indices))
+        resp.headers["X-Slice-Codec"] = params["codec"]
+        return resp
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+# ------------------------------------------------------
+#  VIEWER: SLICE TILES (zoom-aware)
+# ------------------------------------------------------
+# Zoom level L shows the plane downsampled 2**L times (0 is full
+# resolution) and is cut into TILE_SIZE x TILE_SIZE tiles; tile (tx, ty)
+# covers columns tx*T.. and rows ty*T.. of that level's plane.
+TILE_LEVELS = {0: 1, **{int(f).bit_length() - 1: f for f in PREVIEW_FACTORS}}
+
+
+def level_plane_shape(shape, axis, factor):
+    """(rows, cols) of an axis plane at a downsampling factor."""
+    return tuple(-(-n // factor) for a, n in enumerate(shape) if a != axis)
+
+
+def _downsample_plane(plane, factor, kind):
+    """(n, rows, cols) block of planes -> one plane, filtered like the pyramid."""
+    plane = plane.max(axis=0) if kind == "seg" else plane.mean(axis=0, dtype=np.float32)
+    pad = [(0, -n % factor) for n in plane.shape]
+    if any(p for _, p in pad):
+        plane = np.pad(plane, pad, mode="edge")
+    h, w = (n // factor for n in plane.shape)
+    blocks = plane.reshape(h, factor, w, factor)
+    if kind == "seg":
+        return blocks.max(axis=(1, 3))
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def _render_tile(path, params, index, level, tx, ty):
+    kind = params["layer"]
+    axis = VIEW_AXES[params["axis"]]
+    factor = TILE_LEVELS[level]
+    vol = get_seg_volume(path) if kind == "seg" else get_ct_volume(path)
+    rows, cols = level_plane_shape(vol.shape, axis, factor)
+    r0, c0 = ty * TILE_SIZE, tx * TILE_SIZE
+    if not (0 <= r0 < rows and 0 <= c0 < cols):
+        raise ValueError("Tile out of range")
+    r1, c1 = min(rows, r0 + TILE_SIZE), min(cols, c0 + TILE_SIZE)
+
+    if kind == "seg" and params["codec"] != "raw":
+        occ = get_occupancy(path)
+        box = occ.bbox(axis, index)
+        if (occ.is_empty(axis, index, params["labels"]) or box[0] >= r1 * factor
+                or box[1] <= r0 * factor or box[2] >= c1 * factor or box[3] <= c0 * factor):
+            body, mimetype = empty_overlay((r1 - r0, c1 - c0), params["codec"], params["level"],
+                                           params["quality"])
+            return RenderedSlice(body, mimetype, index, (r1 - r0, c1 - c0, 4), "uint8")
+
+    rest = [a for a in range(3) if a != axis]
+    source = vol if factor == 1 else get_preview(path, kind, factor)
+    slicer = [None] * 3
+    if source is not None:
+        slicer[axis] = index // factor
+        slicer[rest[0]] = slice(r0, r1)
+        slicer[rest[1]] = slice(c0, c1)
+        plane = source.read(tuple(slicer))
+    else:
+        # pyramid still building: reduce the full-resolution region
+        first = index // factor * factor
+        slicer[axis] = slice(first, min(vol.shape[axis], first + factor))
+        slicer[rest[0]] = slice(r0 * factor, r1 * factor)
+        slicer[rest[1]] = slice(c0 * factor, c1 * factor)
+        block = np.moveaxis(vol.read(tuple(slicer)), axis, 0)
+        plane = _downsample_plane(block, factor, kind)
+    return _render_slice(plane, params, index)
+
+
+def render_tile(path, sig, params, index, level, tx, ty):
+    """Encoded tile from RENDER_CACHE, rendering it on a miss."""
+    key = slice_cache_key(sig, params, ("tile", index, level, tx, ty))
+    return RENDER_CACHE.get(key, lambda: _render_tile(path, params, index, level, tx, ty))
+
+
+@app.route("/viewer/slice-tile", methods=["GET"])
+def viewer_slice_tile():
+    """
+    One TILE_SIZE tile of a slice at a zoom level, so the viewer only
+    fetches what is visible.
+    Query: as /viewer/slice-image (index in full-resolution voxels; level
+           stays the codec level), plus zoom (0 = full resolution,
+           L = 2**L downsampled), tx, ty.
+    Headers: X-Tile-Size, X-Tile-Grid "cols,rows" and X-Level-Shape
+             "rows,cols" of the level's plane; tiles on the right and
+             bottom edges are smaller than X-Tile-Size.
+    """
+    try:
+        path = request.args["path"]
+        index = int(request.args["index"])
+        level = int(request.args.get("zoom", 0))
+        tx, ty = int(request.args["tx"]), int(request.args["ty"])
+        params = parse_slice_params(request.args, request.accept_mimetypes)
+        if level not in TILE_LEVELS:
+            raise ValueError(f"Invalid zoom (available: {sorted(TILE_LEVELS)})")
+
+        sig = path_signature(path)
+        vol = get_seg_volume(path) if params["layer"] == "seg" else get_ct_volume(path)
+        axis = VIEW_AXES[params["axis"]]
+        index = max(0, min(vol.shape[axis] - 1, index))
+        rows, cols = level_plane_shape(vol.shape, axis, TILE_LEVELS[level])
+
+        etag = slice_etag(slice_cache_key(sig, params, ("tile", index, level, tx, ty)))
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            rendered = render_tile(path, sig, params, index, level, tx, ty)
+            resp = Response(rendered.body, mimetype=rendered.mimetype)
+            if params["codec"] == "raw":
+                resp.headers["X-Slice-Shape"] = ",".join(str(n) for n in rendered.shape)
+                resp.headers["X-Slice-Dtype"] = rendered.dtype
+
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = f"private, max-age={SLICE_MAX_AGE}"
+        resp.headers["X-Slice-Index"] = str(index)
+        resp.headers["X-Tile-Size"] = str(TILE_SIZE)
+        resp.headers["X-Tile-Grid"] = f"{-(-cols // TILE_SIZE)},{-(-rows // TILE_SIZE)}"
+        resp.headers["X-Level-Shape"] = f"{rows},{cols}"
+        return resp
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+# ------------------------------------------------------
+#  VIEWER: OBLIQUE MPR + THICK-SLAB MIP / MinIP
+# ------------------------------------------------------
+SLAB_MODES = ("mpr", "mip", "minip", "avg")
+
+
+def _vector(args, name, default=None):
+    value = args.get(name)
+    if value is None:
+        if default is None:
+            raise ValueError(f"Missing {name}")
+        return np.asarray(default, dtype=np.float64)
+    vec = np.asarray([float(v) for v in value.split(",")], dtype=np.float64)
+    if vec.shape != (3,):
+        raise ValueError(f"{name} must be three comma-separated numbers (z,y,x)")
+    return vec
+
+
+def parse_reformat_geometry(args):
+    """
+    Plane and slab of a reformat, in voxel (z, y, x) units. origin is the
+    centre of the output image; u / v are the step per output column /
+    row and their cross product is the slab normal. units=mm measures
+    all of them in millimetres from voxel (0, 0, 0).
+    """
+    units = args.get("units", "voxel")
+    if units not in ("voxel", "mm"):
+        raise ValueError("Invalid units")
+    width, height = (int(n) for n in args.get("size", "512,512").split(","))
+    if not (0 < width <= MAX_REFORMAT_SIZE and 0 < height <= MAX_REFORMAT_SIZE):
+        raise ValueError(f"size must be 1..{MAX_REFORMAT_SIZE} per side")
+    thickness = float(args.get("thickness", 0))
+    mode = args.get("mode", "mip" if thickness > 0 else "mpr")
+    if mode not in SLAB_MODES:
+        raise ValueError(f"Invalid mode (one of {', '.join(SLAB_MODES)})")
+    if thickness < 0:
+        raise ValueError("thickness must be >= 0")
+    return {
+        "origin": _vector(args, "origin"),
+        "u": _vector(args, "u", (0, 0, 1)),
+        "v": _vector(args, "v", (0, 1, 0)),
+        "size": (width, height),
+        "thickness": thickness,
+        "mode": mode,
+        "units": units,
+    }
+
+
+def reformat_key(geom):
+    return ("reformat", geom["units"], geom["mode"], geom["size"], geom["thickness"]) + tuple(
+        tuple(np.round(geom[k], 4).tolist()) for k in ("origin", "u", "v")
+    )
+
+
+def reformat_volume(vol, geom, kind="ct"):
+    """
+    Sample vol on an oblique plane (trilinear; nearest for label maps)
+    and, for a slab, reduce the samples along the normal block by block.
+    A single plane is sampled with vol.sample(), which for a brick store
+    reads only the bricks the plane passes through. A slab is sampled in
+    bands of REFORMAT_BAND_ROWS output rows, each from one read of the
+    box of the volume the band's part of the slab spans. Returns a
+    float32 (height, width) plane; outside the volume it is air (-1024)
+    for CT and 0 for labels.
+    """
+    scale = np.asarray(vol.spacing, dtype=np.float64) if geom["units"] == "mm" else np.ones(3)
+    # the slab normal is perpendicular to the plane in geom's units (mm
+    # or voxels), then converted to a voxel step per unit of thickness
+    normal = np.cross(geom["u"], geom["v"])
+    if not np.linalg.norm(normal):
+        raise ValueError("u and v must not be parallel")
+    step = (normal / np.linalg.norm(normal) / scale).astype(np.float32)
+    origin, u, v = geom["origin"] / scale, geom["u"] / scale, geom["v"] / scale
+
+    # one sample per voxel-length step across the slab
+    depth = geom["thickness"] * float(np.linalg.norm(step))
+    mode = geom["mode"] if depth > 0 else "mpr"
+    count = int(np.ceil(depth)) + 1 if mode != "mpr" else 1
+    half = geom["thickness"] / 2 if count > 1 else 0.0
+    offsets = np.linspace(-half, half, count).astype(np.float32)
+
+    width, height = geom["size"]
+    cols = (np.arange(width) - (width - 1) / 2).astype(np.float32)
+    rows = (np.arange(height) - (height - 1) / 2).astype(np.float32)
+    band_rows = height if count == 1 else REFORMAT_BAND_ROWS
+    out = np.empty((height, width), np.float32)
+    for r0 in range(0, height, band_rows):
+        band = rows[r0:r0 + band_rows]
+        # (3, rows*W) voxel coordinates of this band of the plane
+        plane = (origin.astype(np.float32)[:, None, None]
+                 + u.astype(np.float32)[:, None, None] * cols[None, None, :]
+                 + v.astype(np.float32)[:, None, None] * band[None, :, None]).reshape(3, -1)
+        out[r0:r0 + len(band)] = _reformat_band(vol, plane, step, offsets, mode, kind).reshape(
+            len(band), width)
+    return out
+
+
+def _reformat_band(vol, plane, step, offsets, mode, kind):
+    order = 0 if kind == "seg" else 1
+    fill = 0.0 if kind == "seg" else -1024.0
+    if len(offsets) > 1:
+        # a slab samples its box densely: read it once for every block
+        ends = np.concatenate([plane + step[:, None] * offsets[0], plane + step[:, None] * offsets[-1]],
+                              axis=1)
+        lo = np.maximum(np.floor(ends.min(axis=1)), 0).astype(int)
+        hi = np.minimum(np.floor(ends.max(axis=1)) + 2, vol.shape).astype(int)
+        if np.any(hi <= lo):
+            return np.full(plane.shape[1], fill, np.float32)    # band misses the volume
+        source = ArrayVolumeHandle(vol.read(tuple(slice(a, b) for a, b in zip(lo, hi))))
+        plane = plane - lo.astype(np.float32)[:, None]
+    else:
+        source = vol
+
+    reduce = {"mip": np.fmax, "minip": np.fmin, "avg": None, "mpr": np.fmax}[mode]
+    result = None
+    total = np.zeros(plane.shape[1], np.float32) if mode == "avg" else None
+    hits = np.zeros(plane.shape[1], np.int32) if mode == "avg" else None
+
+    for b0 in range(0, len(offsets), REFORMAT_BLOCK):
+        block = offsets[b0:b0 + REFORMAT_BLOCK]
+        coords = (plane[:, None, :] + step[:, None, None] * block[None, :, None])
+        samples = source.sample(coords.reshape(3, -1), order).reshape(len(block), -1)
+        if mode == "avg":
+            valid = ~np.isnan(samples)
+            total += np.where(valid, samples, 0).sum(axis=0)
+            hits += valid.sum(axis=0, dtype=np.int32)
+            continue
+        # NaN (outside) samples are ignored by fmax / fmin
+        partial = reduce.reduce(samples, axis=0)
+        result = partial if result is None else reduce(result, partial)
+
+    if mode == "avg":
+        result = np.where(hits > 0, total / np.maximum(hits, 1), np.nan).astype(np.float32)
+    result[np.isnan(result)] = fill
+    return result
+
+
+def _render_reformat(path, params, geom):
+    kind = params["layer"]
+    vol = get_seg_volume(path) if kind == "seg" else get_ct_volume(path)
+    plane = reformat_volume(vol, geom, kind)
+    if kind == "seg":
+        plane = plane.astype(vol.dtype)
+    return _render_slice(plane, params, None)
+
+
+@app.route("/viewer/reformat", methods=["GET"])
+def viewer_reformat():
+    """
+    Oblique multiplanar reformat, optionally as a thick-slab projection,
+    rendered like /viewer/slice-image.
+    Query: path, origin=z,y,x (image centre), u=z,y,x / v=z,y,x (step per
+           column / row; default axial), size=W,H, units=voxel|mm,
+           thickness (along u x v; 0 = single plane),
+           mode=mpr|mip|minip|avg (default mip for slabs),
+           plus layer, window, codec, level, quality, dtype, labels.
+    """
+    try:
+        path = request.args["path"]
+        params = parse_slice_params(request.args, request.accept_mimetypes, needs_axis=False)
+        geom = parse_reformat_geometry(request.args)
+
+        sig = path_signature(path)
+        key = slice_cache_key(sig, params, reformat_key(geom))
+        etag = slice_etag(key)
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            rendered = RENDER_CACHE.get(key, lambda: _render_reformat(path, params, geom))
+            resp = Response(rendered.body, mimetype=rendered.mimetype)
+            if params["codec"] == "raw":
+                resp.headers["X-Slice-Shape"] = ",".join(str(n) for n in rendered.shape)
+                resp.headers["X-Slice-Dtype"] = rendered.dtype
+
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = f"private, max-age={SLICE_MAX_AGE}"
+        return resp
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+# ------------------------------------------------------
+#  VIEWER: WEBSOCKET SLICE CHANNEL (latest wins)
+# ------------------------------------------------------
+class SliceChannel:
+    """
+    Slice requests of one viewer session. Each (layer, axis) slot keeps
+    only its newest request, and a single render thread serves the slots
+    in turn, so positions the slider has already left are never rendered.
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self._send_lock = threading.Lock()
+        self._slots = OrderedDict()     # (layer, axis) -> request message
+        self._cond = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, msg):
+        slot = (msg.get("layer", "ct"), msg.get("axis"))
+        with self._cond:
+            if slot in self._slots:
+                self.dropped += 1
+            self._slots[slot] = msg
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def send(self, frame):
+        with self._send_lock:
+            self._send(frame)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._slots and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                _, msg = self._slots.popitem(last=False)
+            try:
+                frame = self._render(msg)
+            except Exception as e:
+                frame = json.dumps({"id": msg.get("id"), "error": str(e)})
+            try:
+                self.send(frame)
+            except Exception:
+                self.close()    # socket went away
+                return
+
+    def _render(self, msg):
+        """
+        Binary frame: little-endian uint32 header length, JSON header,
+        then the encoded slice.
+        """
+        args = MultiDict(msg)
+        path = args["path"]
+        params = parse_slice_params(args, MIMEAccept())
+
+        sig = path_signature(path)
+        vol = get_seg_volume(path) if params["layer"] == "seg" else get_ct_volume(path)
+        length = vol.shape[VIEW_AXES[params["axis"]]]
+        index = max(0, min(length - 1, int(args["index"])))
+
+        rendered = render_slice(path, sig, params, index)
+        if PREFETCH_SLICES > 0:
+            schedule_prefetch(path, sig, params, index, length)
+
+        header = json.dumps({
+            "id": msg.get("id"),
+            "layer": params["layer"],
+            "axis": params["axis"],
+            "index": index,
+            "mimetype": rendered.mimetype,
+            "shape": list(rendered.shape),
+            "dtype": rendered.dtype,
+            "box": rendered.box,
+        }).encode()
+        return struct.pack("<I", len(header)) + header + rendered.body
+
+
+if HAVE_SOCK:
+    @sock.route("/viewer/ws")
+    def viewer_ws(ws):
+        """
+        Client sends JSON text messages with the /viewer/slice-image query
+        fields (plus an optional "id"); replies are SliceChannel frames.
+        """
+        channel = SliceChannel(ws.send)
+        try:
+            while True:
+                data = ws.receive()
+                if data is None:
+                    break
+                try:
+                    channel.submit(json.loads(data))
+                except ValueError:
+                    channel.send(json.dumps({"error": "Invalid JSON message"}))
+        finally:
+            channel.close()
+
+
 # ------------------------------------------------------
 #  3D SEGMENTATION MESH
 # ------------------------------------------------------
+def mask_bbox(seg):
+    """Inclusive-exclusive (lo, hi) bounds of the non-zero voxels, or None."""
+    bounds = []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        hit = np.flatnonzero(seg.any(axis=other))
+        if hit.size == 0:
+            return None
+        bounds.append((int(hit[0]), int(hit[-1]) + 1))
+    return bounds
+
+
+def _marching_cubes_slab(shm_name, offset, shape, z0, z1, step_size):
+    """
+    Process-pool worker: marching cubes over planes z0..z1 of the mask
+    stored at byte offset in a shared-memory block.
+    """
+    from skimage import measure
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        slab = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset)[z0:z1 + 1]
+        if slab.min() == slab.max():
+            # entirely outside or inside the mask: no surface here
+            return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.int64)
+        verts, faces, _, _ = measure.marching_cubes(slab, level=0.5, step_size=step_size)
+        verts[:, 0] += z0
+        return verts, faces
+    finally:
+        shm.close()
+
+
+_MESH_POOL = None
+_MESH_POOL_LOCK = threading.Lock()
+
+
+def _mesh_pool():
+    global _MESH_POOL
+    with _MESH_POOL_LOCK:
+        if _MESH_POOL is None:
+            # not fork: the server runs Flask threads (locks held by
+            # another thread would stay locked in the child)
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _MESH_POOL = ProcessPoolExecutor(max_workers=MESH_WORKERS,
+                                             mp_context=multiprocessing.get_context(method))
+        return _MESH_POOL
+
+
+def weld_seams(parts, seams):
+    """
+    Concatenate per-slab meshes and merge the duplicate vertices that
+    neighbouring slabs both emit on their shared z planes.
+    """
+    offsets = np.cumsum([0] + [len(v) for v, _ in parts])
+    verts = np.concatenate([v for v, _ in parts]).astype(np.float32)
+    faces = np.concatenate([f + off for (_, f), off in zip(parts, offsets)]).astype(np.int64)
+
+    # Seam vertices lie exactly on an integer plane and are computed
+    # from the same two voxels in both slabs, so they compare equal.
+    on_seam = np.flatnonzero(np.isin(verts[:, 0], np.asarray(seams, dtype=np.float32)))
+    remap = np.arange(len(verts))
+    if on_seam.size:
+        _, first, inverse = np.unique(verts[on_seam], axis=0, return_index=True, return_inverse=True)
+        remap[on_seam] = on_seam[first][inverse.reshape(-1)]
+
+    keep = remap == np.arange(len(verts))
+    new_index = np.cumsum(keep) - 1
+    return verts[keep], new_index[remap[faces]]
+
+
+def _slab_bounds(depth, step_size, workers):
+    """z-slabs on the step grid over depth planes; neighbours share one plane."""
+    planes = max(step_size, (depth // (workers * 2) // step_size) * step_size)
+    return [(z0, min(depth - 1, z0 + planes)) for z0 in range(0, depth - 1, planes)]
+
+
+def parallel_surfaces(vols, step_size=1, workers=None, split_voxels=0):
+    """
+    marching_cubes(vol, 0.5) for every volume in vols at once: all of them
+    are copied into one shared-memory block, those of at least split_voxels
+    voxels are split into z-slabs, and every slab of every volume is
+    meshed across the process pool. Returns one welded (verts, faces) per
+    volume.
+    """
+    workers = workers or MESH_WORKERS
+    offsets = np.cumsum([0] + [vol.nbytes for vol in vols])
+    bounds = [
+        _slab_bounds(vol.shape[0], step_size, workers) if vol.size >= split_voxels
+        else [(0, vol.shape[0] - 1)]
+        for vol in vols
+    ]
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(offsets[-1])))
+    try:
+        for vol, offset in zip(vols, offsets):
+            np.ndarray(vol.shape, dtype=np.uint8, buffer=shm.buf, offset=offset)[...] = vol
+        pool = _mesh_pool()
+        futures = [
+            [pool.submit(_marching_cubes_slab, shm.name, int(offset), vol.shape, z0, z1, step_size)
+             for z0, z1 in slabs]
+            for vol, offset, slabs in zip(vols, offsets, bounds)
+        ]
+        parts = [[f.result() for f in slab_futures] for slab_futures in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return [
+        weld_seams(vol_parts, [z1 for _, z1 in slabs[:-1]])
+        for vol_parts, slabs in zip(parts, bounds)
+    ]
+
+
+def parallel_marching_cubes(vol, step_size=1, workers=None):
+    """
+    marching_cubes(vol, 0.5) split into z-slabs that share their boundary
+    plane, run across a process pool on a shared-memory copy of vol and
+    welded into one mesh.
+    """
+    return parallel_surfaces([vol], step_size, workers)[0]
+
+
+def mesh_input(seg, step_size=1):
+    """
+    Bounding-box crop of seg, zero-padded so the surface is closed and each
+    axis length - 1 is a multiple of step_size (marching_cubes drops a
+    trailing partial step). Returns (uint8 crop, voxel origin of the crop).
+    """
+    bbox = mask_bbox(seg)
+    if bbox is None:
+        raise ValueError("Segmentation is empty (all zeros).")
+
+    crop = seg[tuple(slice(lo, hi) for lo, hi in bbox)]
+    pad = [(1, 1 + (-(hi - lo + 1) % step_size)) for lo, hi in bbox]
+    crop = np.pad(crop, pad).astype(np.uint8, copy=False)
+    return crop, np.array([lo - 1 for lo, _ in bbox])
+
+
+def build_mesh(seg, step_size=1, target_faces=None):
+    """
+    One closed surface per label, each from marching cubes over that
+    label's bounding box. With a process pool all labels are meshed at
+    once, large ones split further into z-slabs. Optionally
+    decimated so the whole mesh has ~target_faces, shared between labels
+    in proportion to their face counts.
+    Returns float32 (N, 3) vertices in voxel (z, y, x), uint32 (M, 3) faces
+    ordered by label, and uint32 (G, 3) groups of (label, first face, faces).
+    """
+    from scipy import ndimage
+    from skimage import measure
+
+    labels, crops, origins = [], [], []
+    for label, box in enumerate(ndimage.find_objects(seg), 1):
+        if box is None:
+            continue
+        crop, origin = mesh_input(seg[box] == label, step_size)
+        labels.append(label)
+        crops.append(crop)
+        origins.append(origin + [sl.start for sl in box])
+
+    if MESH_WORKERS > 1 and (len(crops) > 1 or sum(c.size for c in crops) >= PARALLEL_MESH_MIN_VOXELS):
+        meshes = parallel_surfaces(crops, step_size, split_voxels=PARALLEL_MESH_MIN_VOXELS)
+    else:
+        meshes = [measure.marching_cubes(crop, level=0.5, step_size=step_size)[:2] for crop in crops]
+
+    surfaces = []
+    for label, (verts, faces), origin in zip(labels, meshes, origins):
+        if len(verts):
+            surfaces.append((label, verts + origin.astype(verts.dtype), faces))
+    if not surfaces:
+        raise ValueError("Segmentation is empty (all zeros).")
+
+    total = sum(len(faces) for _, _, faces in surfaces)
+    if target_faces and HAVE_SIMPLIFY and total > target_faces:
+        import fast_simplification
+
+        decimated = []
+        for label, verts, faces in surfaces:
+            keep = target_faces * len(faces) / total
+            if len(faces) > keep >= 4:
+                verts, faces = fast_simplification.simplify(
+                    verts, faces, target_reduction=1.0 - keep / len(faces)
+                )
+            decimated.append((label, verts, faces))
+        surfaces = decimated
+
+    offsets = np.cumsum([0] + [len(v) for _, v, _ in surfaces])
+    starts = np.cumsum([0] + [len(f) for _, _, f in surfaces])
+    verts = np.concatenate([v for _, v, _ in surfaces]).astype(np.float32)
+    faces = np.concatenate([f + off for (_, _, f), off in zip(surfaces, offsets)]).astype(np.uint32)
+    groups = np.array(
+        [(label, start, len(f)) for (label, _, f), start in zip(surfaces, starts)], dtype=np.uint32
+    )
+    return verts, faces, groups
+
+
+def select_labels(verts, faces, groups, labels):
+    """Sub-mesh of the given labels, with unused vertices dropped."""
+    if labels is None:
+        return verts, faces, groups
+    picked = [g for g in groups if int(g[0]) in labels]
+    if not picked:
+        raise ValueError(f"None of the labels {list(labels)} are in the segmentation.")
+    faces = np.concatenate([faces[start:start + count] for _, start, count in picked])
+    used, faces = np.unique(faces, return_inverse=True)
+    starts = np.cumsum([0] + [int(count) for _, _, count in picked])
+    groups = np.array([(g[0], start, g[2]) for g, start in zip(picked, starts)], dtype=np.uint32)
+    return verts[used], faces.reshape(-1, 3).astype(np.uint32), groups
+
+
+def mesh_groups(groups):
+    """JSON description of mesh groups, with the overlay colour of each label."""
+    return [
+        {"label": int(label), "start": int(start), "count": int(count),
+         "color": "#%02x%02x%02x" % label_color(label)}
+        for label, start, count in groups
+    ]
+
+
+def parse_mesh_params(data):
+    step_size = data.get("step_size", 1)
+    if data.get("level"):
+        if data["level"] not in MESH_LODS:
+            raise ValueError(f"Unknown mesh level: {data['level']}")
+        step_size = MESH_LODS[data["level"]]
+    params = {
+        "step_size": max(1, int(step_size)),
+        "target_faces": int(data["target_faces"]) if data.get("target_faces") else None,
+    }
+    if params["target_faces"] and not HAVE_SIMPLIFY:
+        params["target_faces"] = None   # decimation unavailable; serve full mesh
+    return params
+
+
+class CachedMesh:
+    """Mesh of every label of a segmentation, as kept in MESH_CACHE."""
+
+    def __init__(self, verts, faces, groups):
+        self.verts = verts
+        self.faces = faces
+        self.groups = groups
+        self.nbytes = verts.nbytes + faces.nbytes + groups.nbytes
+
+
+def get_mesh(seg_path, params, labels=None):
+    """
+    Mesh of every label in seg_path, cut down to the requested labels.
+    Built meshes are kept in MESH_CACHE and on disk next to the volume
+    store, keyed by the segmentation's mtime/size and the mesh
+    parameters; concurrent requests for the same mesh share one build.
+    """
+    sig = path_signature(seg_path)
+    key = ("mesh",) + sig + (tuple(sorted(params.items())),)
+    mesh = MESH_CACHE.get(key, lambda: _load_mesh(seg_path, sig, params))
+    return select_labels(mesh.verts, mesh.faces, mesh.groups, labels)
+
+
+def _load_mesh(seg_path, sig, params):
+    digest = hashlib.sha1(repr((sig, sorted(params.items()))).encode()).hexdigest()[:16]
+    cache_path = os.path.join(store_dir_for(seg_path), f"mesh-{digest}.npz")
+
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cached:
+                return CachedMesh(cached["vertices"], cached["faces"], cached["groups"])
+        except Exception:
+            pass    # unreadable or old cache entry: rebuild it
+
+    seg = get_seg_volume(seg_path).read()
+    mesh = CachedMesh(*build_mesh(seg, **params))
+
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}-{threading.get_ident()}.npz"
+    try:
+        np.savez(tmp_path, vertices=mesh.verts, faces=mesh.faces, groups=mesh.groups)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass    # read-only location: serve uncached
+    return mesh
+
+
+def mesh_to_glb(verts, faces, groups):
+    """
+    Minimal binary glTF 2.0: one indexed triangle primitive per label,
+    each with a material in the label's overlay colour.
+    """
+    positions = np.ascontiguousarray(verts, dtype="<f4").tobytes()
+    indices = np.ascontiguousarray(faces, dtype="<u4").tobytes()
+    gltf = {
+        "asset": {"version": "2.0"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [
+            {"attributes": {"POSITION": 0}, "indices": i + 1, "material": i}
+            for i in range(len(groups))
+        ]}],
+        "materials": [
+            {"name": f"label {int(label)}",
+             "pbrMetallicRoughness": {
+                 "baseColorFactor": [c / 255 for c in label_color(label)] + [1.0],
+                 "metallicFactor": 0.0}}
+            for label, _, _ in groups
+        ],
+        "buffers": [{"byteLength": len(positions) + len(indices)}],
+        "bufferViews": [
+            {"buffer": 0, "byteOffset": 0, "byteLength": len(positions), "target": 34962},
+            {"buffer": 0, "byteOffset": len(positions), "byteLength": len(indices), "target": 34963},
+        ],
+        "accessors": [
+            {"bufferView": 0, "componentType": 5126, "count": len(verts), "type": "VEC3",
+             "min": verts.min(axis=0).tolist(), "max": verts.max(axis=0).tolist()},
+        ] + [
+            {"bufferView": 1, "byteOffset": int(start) * 12, "componentType": 5125,
+             "count": int(count) * 3, "type": "SCALAR"}
+            for _, start, count in groups
+        ],
+    }
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode()
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    bin_chunk = positions + indices     # both 4-byte aligned already
+
+    total = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+    return b"".join([
+        struct.pack("<4sII", b"glTF", 2, total),
+        struct.pack("<I4s", len(json_chunk), b"JSON"), json_chunk,
+        struct.pack("<I4s", len(bin_chunk), b"BIN\0"), bin_chunk,
+    ])
+
+
+def packed_mesh(seg_path, params, units, labels=None):
+    """Mesh as float32 (x, y, z) vertices in mm or voxels, uint32 faces and groups."""
+    verts, faces, groups = get_mesh(seg_path, params, labels)
+    if units == "mm":
+        verts = verts * np.asarray(get_seg_volume(seg_path).spacing, dtype=np.float32)
+    verts = np.ascontiguousarray(verts[:, ::-1], dtype="<f4")     # (z, y, x) -> (x, y, z)
+    return verts, faces.astype("<u4"), groups
+
+
+LOD_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mesh-lod")
+# segmentation signatures whose coarse mesh was already queued, oldest first
+_WARMED_LODS = OrderedDict()
+_WARMED_LODS_MAX = 256
+_WARM_LOCK = threading.Lock()
+
+
+def warm_mesh_lods(seg_path):
+    """
+    Build and cache the coarse mesh level in the background, so opening
+    the 3D view shows something at once. Finer levels are built when the
+    viewer asks for them; a request arriving while the coarse build runs
+    waits for it through MESH_CACHE instead of building it again.
+    """
+    sig = path_signature(seg_path)
+    with _WARM_LOCK:
+        if sig in _WARMED_LODS:
+            return
+        _WARMED_LODS[sig] = True
+        if len(_WARMED_LODS) > _WARMED_LODS_MAX:
+            _WARMED_LODS.popitem(last=False)
+
+    def build():
+        try:
+            get_mesh(seg_path, {"step_size": MESH_LODS["coarse"], "target_faces": None})
+        except Exception:
+            pass    # reported when the viewer asks for the mesh
+    LOD_POOL.submit(build)
+
+
 @app.route("/viewer/seg3d", methods=["POST"])
 def viewer_seg3d():
     try:
         data = request.get_json()
         seg_path = data["seg_path"]
 
-        seg = load_seg_volume(seg_path)
-        if seg.max() == 0:
-            return jsonify({"error": "Segmentation is empty (all zeros)."}), 400
-
-        verts, faces, normals, values = measure.marching_cubes(seg, level=0.5)
-        if verts.shape[0] == 0:
-            return jsonify({"error": "Marching cubes produced no vertices."}), 400
+        labels = parse_labels(data.get("labels"))
+        verts, faces, groups = get_mesh(seg_path, parse_mesh_params(data), labels)
 
         return jsonify({
             "vertices": verts.tolist(),
-            "faces": faces.tolist()
+            "faces": faces.tolist(),
+            "labels": mesh_groups(groups),
         })
 
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 
+@app.route("/viewer/seg3d-mesh", methods=["POST"])
+def viewer_seg3d_mesh():
+    """
+    Packed mesh for direct GPU upload.
+    Request: { seg_path, step_size=1 or level=coarse|medium|full, target_faces,
+               units=mm|voxel, format=bin|glb, labels=[...] }
+    bin: float32 (x, y, z) vertices followed by uint32 triangle indices,
+         counts in X-Mesh-Vertices / X-Mesh-Faces, and the faces of each
+         label in X-Mesh-Groups as "label:first:count,...".
+    glb: one primitive and material per label.
+    """
+    try:
+        data = request.get_json()
+        seg_path = data["seg_path"]
+        units = data.get("units", "mm")
+        fmt = data.get("format", "bin")
+        if units not in ("mm", "voxel"):
+            return jsonify({"error": "Invalid units"}), 400
+        if fmt not in ("bin", "glb"):
+            return jsonify({"error": "Invalid format"}), 400
+
+        labels = parse_labels(data.get("labels"))
+        verts, faces, groups = packed_mesh(seg_path, parse_mesh_params(data), units, labels)
+
+        if fmt == "glb":
+            resp = Response(mesh_to_glb(verts, faces, groups), mimetype="model/gltf-binary")
+        else:
+            resp = Response(verts.tobytes() + faces.tobytes(), mimetype="application/octet-stream")
+        resp.headers["X-Mesh-Vertices"] = str(len(verts))
+        resp.headers["X-Mesh-Faces"] = str(len(faces))
+        resp.headers["X-Mesh-Groups"] = ",".join(":".join(str(int(v)) for v in g) for g in groups)
+        return resp
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/viewer/seg3d-stream", methods=["POST"])
+def viewer_seg3d_stream():
+    """
+    Every LOD level in one streamed response, coarsest first, so the
+    viewer can show a mesh as soon as the first frame arrives.
+    Request: { seg_path, units=mm|voxel, target_faces, labels=[...] }
+    Frame: little-endian uint32 header length, JSON header
+    { level, step_size, vertices, faces, labels: [{ label, start, count,
+    color }] } (or { level, error }), then
+    float32 (x, y, z) vertices and uint32 triangle indices.
+    """
+    data = request.get_json()
+    seg_path = data.get("seg_path", "")
+    units = data.get("units", "mm")
+    if units not in ("mm", "voxel"):
+        return jsonify({"error": "Invalid units"}), 400
+    try:
+        path_signature(seg_path)
+        labels = parse_labels(data.get("labels"))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+    def frame(header, body=b""):
+        header = json.dumps(header).encode()
+        return struct.pack("<I", len(header)) + header + body
+
+    def generate():
+        for level, step_size in MESH_LODS.items():
+            try:
+                params = parse_mesh_params(dict(data, level=level))
+                verts, faces, groups = packed_mesh(seg_path, params, units, labels)
+            except Exception as e:
+                yield frame({"level": level, "error": str(e)})
+                return
+            yield frame(
+                {"level": level, "step_size": step_size,
+                 "vertices": len(verts), "faces": len(faces), "labels": mesh_groups(groups)},
+                verts.tobytes() + faces.tobytes(),
+            )
+
+    return Response(generate(), mimetype="application/octet-stream")
+
+
+# ------------------------------------------------------
+#  UPLOAD CATALOG
+# ------------------------------------------------------
+# One row per case: every volume file (NIfTI / NRRD / .npy / DICOM ZIP)
+# and every DICOM folder, with the individual .dcm files folded into
+# their folder. Directories are re-listed only when their mtime changes,
+# so a sync costs one stat per directory instead of a walk over every
+# DICOM instance.
+
+CASE_EXTENSIONS = {".nii.gz": "nifti", ".nii": "nifti", ".nrrd": "nrrd", ".npy": "npy", ".zip": "zip"}
+CATALOG_VERSION = 2
+
+_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS items (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    modality TEXT,
+    shape TEXT,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS items_dir ON items (dir);
+"""
+
+
+def case_kind(name):
+    low = name.lower()
+    for ext, kind in CASE_EXTENSIONS.items():
+        if low.endswith(ext):
+            return kind
+    return None
+
+
+def describe_case(path, kind):
+    """
+    (DICOM modality, [D, H, W]) from headers only, or Nones if unknown.
+    Non-DICOM sources have no modality.
+    """
+    try:
+        with open(os.path.join(store_dir_for(path), "header.json")) as fh:
+            header = json.load(fh)
+        # stores written before the modality was recorded: ask the index
+        if header.get("modality") or kind not in ("dicom", "zip"):
+            return header.get("modality"), header["shape"]
+    except (OSError, ValueError, KeyError):
+        pass
+    try:
+        if kind in ("dicom", "zip"):
+            summary = dicom_ingest.indexed_summary(path)
+            return (summary[0], list(summary[1])) if summary else (None, None)
+        if kind == "npy":
+            return None, list(np.load(path, mmap_mode="r").shape)
+        if kind == "nifti" and HAVE_NIB:
+            import nibabel as nib
+
+            return None, list(nib.load(path).shape[:3])
+        if kind == "nrrd":
+            import SimpleITK as sitk
+
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(path)
+            reader.ReadImageInformation()
+            return None, list(reversed(reader.GetSize()))
+    except Exception:
+        pass
+    return None, None
+
+
+class UploadCatalog:
+    """SQLite index of the cases under root, kept current by sync()."""
+
+    def __init__(self, root, db_path):
+        self.root = os.path.realpath(root)
+        self.db_path = db_path
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+        self._last_sync = 0.0
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_CATALOG_SCHEMA)
+            if conn.execute("PRAGMA user_version").fetchone()[0] < CATALOG_VERSION:
+                # v1: modality used to be the volume store kind; v2: single
+                # DICOM files are catalogued. Describe everything again.
+                with conn:
+                    conn.execute("UPDATE items SET mtime_ns = NULL")
+                    conn.execute("UPDATE dirs SET mtime_ns = NULL")
+                    conn.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+        return conn
+
+    def touch(self, path):
+        """Mark the directory holding path for a re-list on the next sync."""
+        with self._db() as db:
+            db.execute("UPDATE dirs SET mtime_ns = NULL WHERE path = ?",
+                       (os.path.dirname(os.path.realpath(path)),))
+        self._last_sync = 0.0
+
+    def sync(self, force=False):
+        """Re-list every directory whose mtime changed since the last sync."""
+        if not force and time.monotonic() - self._last_sync < CATALOG_RESCAN_SECONDS:
+            return
+        with self._sync_lock:
+            db = self._db()
+            known = dict(db.execute("SELECT path, mtime_ns FROM dirs").fetchall())
+            if self.root not in known:
+                known[self.root] = None
+                with db:
+                    db.execute("INSERT INTO dirs (path, parent, mtime_ns) VALUES (?, NULL, NULL)",
+                               (self.root,))
+            pending, rescanned = [self.root], set()
+            while pending:
+                path = pending.pop()
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except OSError:
+                    self._forget(db, path)
+                    continue
+                if mtime != known.get(path):
+                    pending.extend(self._scan_dir(db, path, mtime))
+                    rescanned.add(path)
+                else:
+                    pending.extend(r[0] for r in db.execute(
+                        "SELECT path FROM dirs WHERE parent = ?", (path,)))
+            self._describe_pending(db, rescanned)
+            self._last_sync = time.monotonic()
+
+    def _describe_pending(self, db, rescanned):
+        """
+        Retry cases without a shape once their parent directory changed:
+        the DICOM header index and the brick store of a case are written
+        next to it, not inside it.
+        """
+        rows = db.execute("SELECT path, kind FROM items WHERE shape IS NULL").fetchall()
+        with db:
+            for row in rows:
+                if os.path.dirname(row["path"]) not in rescanned:
+                    continue
+                modality, shape = describe_case(row["path"], row["kind"])
+                if shape:
+                    db.execute("UPDATE items SET modality = ?, shape = ? WHERE path = ?",
+                               (modality, json.dumps(shape), row["path"]))
+
+    def _forget(self, db, path):
+        """Drop a directory and everything catalogued under it."""
+        below = path.rstrip(os.sep) + os.sep
+        with db:
+            for table, column in (("dirs", "path"), ("items", "path")):
+                db.execute(f"DELETE FROM {table} WHERE {column} = ? OR "
+                           f"({column} >= ? AND {column} < ?)", (path, below, below + "\uffff"))
+
+    def _scan_dir(self, db, path, mtime):
+        subdirs, cases, dicom_size, dicom_mtime = [], {}, 0, 0
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if STORE_SUFFIX not in entry.name:
+                        subdirs.append(entry.path)
+                    continue
+                name = entry.name
+                if name.endswith(dicom_ingest.INDEX_SUFFIX):
+                    continue
+                st = entry.stat()
+                if name.lower().endswith(".dcm"):
+                    dicom_size += st.st_size
+                    dicom_mtime = max(dicom_mtime, st.st_mtime_ns)
+                    # single slices stay listed (PNG/JPEG conversion), as
+                    # kind "dcm" next to their folder's "dicom" case
+                    cases[entry.path] = ("file", "dcm", st.st_size, st.st_mtime_ns)
+                elif case_kind(name):
+                    cases[entry.path] = ("file", case_kind(name), st.st_size, st.st_mtime_ns)
+        if dicom_size and path != self.root:
+            cases[path] = ("folder", "dicom", dicom_size, dicom_mtime)
+
+        old = {r["path"]: r["mtime_ns"] for r in db.execute(
+            "SELECT path, mtime_ns FROM items WHERE (dir = ? AND type = 'file') OR path = ?",
+            (path, path))}
+        with db:
+            for gone in set(old) - set(cases):
+                db.execute("DELETE FROM items WHERE path = ?", (gone,))
+            for case_path, (type_, kind, size, case_mtime) in cases.items():
+                if old.get(case_path) == case_mtime:
+                    continue
+                modality, shape = describe_case(case_path, kind)
+                db.execute(
+                    "INSERT OR REPLACE INTO items (path, dir, name, type, kind, modality, shape, size, mtime_ns)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (case_path, os.path.dirname(case_path), os.path.basename(case_path), type_, kind,
+                     modality, json.dumps(shape) if shape else None, size, case_mtime),
+                )
+            db.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?)",
+                       (path, None if path == self.root else os.path.dirname(path), mtime))
+            known = {r[0] for r in db.execute("SELECT path FROM dirs WHERE parent = ?", (path,))}
+            for sub in set(subdirs) - known:
+                db.execute("INSERT INTO dirs (path, parent, mtime_ns) VALUES (?, ?, NULL)", (sub, path))
+        for gone in known - set(subdirs):
+            self._forget(db, gone)
+        return subdirs
+
+    def query(self, prefix=None, type_=None, kind=None, modality=None, search=None,
+              offset=0, limit=None, files=False):
+        """
+        (rows, total) of catalogued cases, ordered by path. Single DICOM
+        files (kind "dcm") are left out unless files is set or asked for
+        by kind.
+        """
+        where, args = [], []
+        if not files and not kind:
+            where.append("kind != 'dcm'")
+        if prefix:
+            where.append("path >= ? AND path < ?")
+            args += [prefix, prefix + "\uffff"]
+        for column, value in (("type", type_), ("kind", kind), ("modality", modality)):
+            if value:
+                where.append(f"{column} = ?")
+                args.append(value)
+        if search:
+            where.append("instr(lower(name), ?) > 0")
+            args.append(search.lower())
+        clause = (" WHERE " + " AND ".join(where)) if where else ""
+        db = self._db()
+        total = db.execute(f"SELECT COUNT(*) FROM items{clause}", args).fetchone()[0]
+        rows = db.execute(
+            f"SELECT * FROM items{clause} ORDER BY path LIMIT ? OFFSET ?",
+            args + [-1 if limit is None else limit, offset],
+        ).fetchall()
+        return rows, total
+
+
+CATALOG = UploadCatalog(UPLOAD_FOLDER, CATALOG_DB)
+
+
 # ------------------------------------------------------
 #  UPLOAD & LIST
 # ------------------------------------------------------
+UPLOADS = upload_store.UploadStore(UPLOAD_OBJECTS)
+
+
+def place_upload(digest, object_path, relpath):
+    """Link a stored object to UPLOAD_FOLDER/relpath and refresh what depends on it."""
+    save_path = upload_store.resolve_under(UPLOAD_FOLDER, relpath)
+    upload_store.link_object(object_path, save_path)
+    invalidate_caches(save_path)
+    CATALOG.touch(save_path)
+    return save_path
+
+
+def _place_chunked_upload(digest, object_path, meta):
+    # "path" keeps the folder structure of folder uploads
+    return {"path": place_upload(digest, object_path, meta.get("path") or meta["filename"])}
+
+
+# no known_digests: the client picks where the object is linked, so it
+# has to send the bytes rather than name a digest it may only have heard of
+app.register_blueprint(upload_store.upload_blueprint(UPLOADS, _place_chunked_upload))
+
+
 @app.route("/upload-folder", methods=["POST"])
 def upload_folder():
     if "files" not in request.files:
@@ -366,11 +2973,12 @@ def upload_folder():
     files = request.files.getlist("files")
     stored = []
 
-    for f in files:
-        save_path = os.path.join(UPLOAD_FOLDER, f.filename)
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        f.save(save_path)
-        stored.append(save_path)
+    try:
+        for f in files:
+            digest, object_path = UPLOADS.put_stream(f.stream, f.filename)
+            stored.append(place_upload(digest, object_path, f.filename))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     return jsonify({"message": f"Uploaded {len(stored)} files"})
 
@@ -380,21 +2988,56 @@ def upload_file():
     if "file" not in request.files:
         return jsonify({"error": "No file"}), 400
     f = request.files["file"]
-    save_path = os.path.join(UPLOAD_FOLDER, f.filename)
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-    f.save(save_path)
-    return jsonify({"message": "File uploaded"})
+    try:
+        digest, object_path = UPLOADS.put_stream(f.stream, f.filename)
+        save_path = place_upload(digest, object_path, f.filename)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"message": "File uploaded", "path": save_path, "sha256": digest})
 
 
 @app.route("/list-items", methods=["GET"])
 def list_items():
+    """
+    Uploaded cases from the catalog, ordered by path.
+    Query (all optional): prefix (absolute, or relative to the upload
+    folder), type=file|folder, kind=nifti|nrrd|npy|zip|dicom|dcm, modality,
+    q (substring of the name), offset, limit, rescan=1 (sync now),
+    files=1 (also list the single files of DICOM folders, as kind "dcm").
+    Response: { items: [{ path, type, kind, modality, shape, size,
+                thumbnail? }], total, offset, limit }
+    """
+    try:
+        args = request.args
+        CATALOG.sync(force=args.get("rescan") == "1")
+
+        prefix = args.get("prefix")
+        if prefix and not os.path.isabs(prefix):
+            prefix = os.path.join(CATALOG.root, prefix)
+        offset = max(0, args.get("offset", 0, type=int))
+        limit = args.get("limit", type=int)
+        rows, total = CATALOG.query(
+            prefix=prefix, type_=args.get("type"), kind=args.get("kind"),
+            modality=args.get("modality"), search=args.get("q"),
+            offset=offset, limit=limit, files=args.get("files") == "1",
+        )
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
     items = []
-    for root, dirs, files in os.walk(UPLOAD_FOLDER):
-        for d in dirs:
-            items.append({"path": os.path.join(root, d), "type": "folder"})
-        for f in files:
-            items.append({"path": os.path.join(root, f), "type": "file"})
-    return jsonify({"items": items})
+    for row in rows:
+        item = {
+            "path": row["path"],
+            "type": row["type"],
+            "kind": row["kind"],
+            "modality": row["modality"],
+            "shape": json.loads(row["shape"]) if row["shape"] else None,
+            "size": row["size"],
+        }
+        if has_thumbnail(row["path"]):
+            item["thumbnail"] = "/viewer/thumbnail?" + urlencode({"path": row["path"]})
+        items.append(item)
+    return jsonify({"items": items, "total": total, "offset": offset, "limit": limit})
 
 
 # ------------------------------------------------------
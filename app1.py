@@ -1,23 +1,34 @@
 # This code is for segmentation
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 import os
+import json
+import contextlib
+import glob
+import hashlib
+import importlib.util
 import uuid
 import shutil
+import sqlite3
 import tempfile
+import time
 import zipfile
 import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
+import numpy as np
 import SimpleITK as sitk
-import dicom2nifti
-from totalsegmentator.python_api import totalsegmentator
 
-try:
-    import torch
-    HAS_TORCH = True
-except ImportError:
-    HAS_TORCH = False
+import dicom_ingest
+import inference_worker
+import upload_store
+
+# torch and TotalSegmentator are only imported by the inference worker
+# processes, scipy.ndimage on first use: the service starts serving
+# without them
 
 # ---------------------------------------------------------------------
 # Flask app + config
@@ -32,18 +43,43 @@ app.config["MAX_CONTENT_LENGTH"] = 2 * 1024 * 1024 * 1024  # 2 GB
 UPLOAD_DIR = "/mnt/external/Testing project/pythonProject2/upload"
 RESULT_BASE_DIR = "/mnt/external/Testing project/pythonProject2/upload/result"
 
+# Uploaded bytes by SHA-256 (shared with the viewer)
+UPLOAD_OBJECTS = os.environ.get("UPLOAD_OBJECTS", UPLOAD_DIR.rstrip(os.sep) + ".objects")
+
+# Persistent job store; queued jobs survive a restart
+JOBS_DB = os.environ.get("TOTALSEG_JOBS_DB", os.path.join(RESULT_BASE_DIR, "jobs.sqlite"))
+
+# Concurrent TotalSegmentator runs per device, and the CPU threads each
+# run may use (torch intra-op threads, resampling/saving workers). Every
+# slot has its own resident inference worker process (inference_worker).
+def cuda_visible() -> bool:
+    """
+    Whether the workers will find a CUDA GPU, judged without importing
+    torch here: torch is installed and an NVIDIA device is visible.
+    """
+    if importlib.util.find_spec("torch") is None:
+        return False
+    if os.environ.get("CUDA_VISIBLE_DEVICES", "0").strip() in ("", "-1"):
+        return False
+    return bool(glob.glob("/dev/nvidia[0-9]*"))
+
+
+GPU_SLOTS = int(os.environ.get("TOTALSEG_GPU_SLOTS", 1 if cuda_visible() else 0))
+CPU_SLOTS = int(os.environ.get("TOTALSEG_CPU_SLOTS", 1))
+TORCH_THREADS = int(os.environ.get(
+    "TOTALSEG_TORCH_THREADS", max(1, (os.cpu_count() or 1) // max(1, GPU_SLOTS + CPU_SLOTS))
+))
+
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(RESULT_BASE_DIR, exist_ok=True)
 
-# In-memory job registry
-# JOBS[case_id] = {
-#   "status": "string",
-#   "error": None or "error msg",
-#   "zip_path": "/path/to/zip" or None,
-#   "original_name": "patient-1.nrrd"
-# }
-JOBS = {}
-JOBS_LOCK = threading.Lock()
+UPLOADS = upload_store.UploadStore(UPLOAD_OBJECTS)
+# uploads here are only referenced by digest in /api/totalseg_start, which
+# picks the case folder itself, so a known digest may skip the upload
+app.register_blueprint(upload_store.upload_blueprint(UPLOADS, known_digests=True))
+
+# One start at a time, so identical requests share one job
+START_LOCK = threading.Lock()
 
 # Lung lobe labels used by the "total" model
 LUNG_LOBE_CLASSES = [
@@ -54,21 +90,386 @@ LUNG_LOBE_CLASSES = [
     "lung_lower_lobe_right",
 ]
 
+# TotalSegmentator arguments that decide the result; part of the cache key.
+# The final result uses the 3 mm model unless a request asks for the 1.5 mm
+# one ("fast": false); the preview stage gives earlier, coarser feedback.
+SEG_PARAMS = {
+    "task": "total",
+    "roi_subset": LUNG_LOBE_CLASSES,   # only lung lobes
+    "fast": True,                      # 3 mm model (low memory); False: 1.5 mm
+    "body_seg": True,
+}
+
+# Preview stage: the 6 mm model on a downsampled input cropped to the
+# body, published while the final run is still going
+PREVIEW_ENABLED = os.environ.get("TOTALSEG_PREVIEW", "1") != "0"
+PREVIEW_SPACING = float(os.environ.get("TOTALSEG_PREVIEW_SPACING", 6.0))   # mm
+PREVIEW_OVERRIDES = {"fast": False, "fastest": True}
+PREVIEW_DIRNAME = "preview"     # under the case result dir
+BODY_HU = -500      # voxels above this count as body when cropping
+
+# Thorax ROI: only a padded box around the lungs goes to inference. Air
+# (< LUNG_HU) is found on a ROI_SPACING copy; the big air pockets inside
+# the body are the lungs and airways.
+ROI_ENABLED = os.environ.get("TOTALSEG_ROI", "1") != "0"
+ROI_SPACING = 4.0           # mm, detection grid
+ROI_PAD_MM = float(os.environ.get("TOTALSEG_ROI_PAD_MM", 20.0))
+LUNG_HU = -400
+MIN_LUNG_ML = 100.0         # smaller air pockets (bowel gas, ...) are ignored
+ROI_MIN_GAIN = 0.9          # crop only if it keeps less than this share of voxels
+
+# Result masks are written gzip-compressed, straight from the in-memory
+# label arrays, and downloads stream them as a stored (not deflated) ZIP
+EXPORT_DEFAULTS = {"layout": "separate", "format": "nrrd"}
+EXPORT_LAYOUTS = ("separate", "packed")     # one file per lobe | one uint8 label map
+EXPORT_FORMATS = {"nrrd": ".nrrd", "nifti": ".nii.gz"}
+EXPORT_DIRNAME = "masks"        # under the case (and preview) result dir
+PACKED_NAME = "lung_lobes"
+EXPORT_THREADS = int(os.environ.get("TOTALSEG_EXPORT_THREADS", min(4, os.cpu_count() or 1)))
+
+# Progress: the stages of a job in order, and how long a stage is assumed
+# to take on a device (seconds) until finished jobs give a median
+STAGES = ("convert", "roi", "preview", "inference", "export")
+WORKER_STAGES = ("preview", "inference")   # run in the slot's inference worker
+DEFAULT_STAGE_SECONDS = {
+    ("preview", "gpu"): 20.0,
+    ("preview", "cpu"): 90.0,
+    ("inference", "gpu"): 180.0,
+    ("inference", "cpu"): 1200.0,
+}
+OTHER_STAGE_SECONDS = 10.0
+STAGE_HISTORY_JOBS = 50         # finished jobs the medians are taken over
+EVENTS_REFRESH_SECONDS = 5.0    # SSE resends progress at least this often
+CHANGE_POLL_SECONDS = 1.0       # job writes of other processes show up this fast
+
 
 # ---------------------------------------------------------------------
 # Helper functions
 # ---------------------------------------------------------------------
+class JobCancelled(Exception):
+    pass
+
+
 def update_job_status(case_id: str, status: str, error: str | None = None):
     """
     Update status for a job.
     If error is not None, also set the error field.
     """
-    with JOBS_LOCK:
-        if case_id not in JOBS:
-            JOBS[case_id] = {}
-        JOBS[case_id]["status"] = status
-        if error is not None:  # only set error when explicitly provided
-            JOBS[case_id]["error"] = error
+    fields = {"status": status}
+    if error is not None:  # only set error when explicitly provided
+        fields["error"] = error
+    JOBS.update(case_id, **fields)
+
+
+@contextlib.contextmanager
+def job_stage(case_id: str, stage: str, worker: inference_worker.InferenceWorker):
+    """
+    Record one stage of a job in its timings: start and end time, the
+    slot's device, outcome and peak RSS. Stages in the inference worker
+    measure that process; the others this one (together with whatever
+    other slots run here at the same time). The body may add fields to
+    the yielded dict, e.g. voxels.
+    """
+    if stage not in WORKER_STAGES:
+        inference_worker.reset_peak_rss()
+    JOBS.start_stage(case_id, stage, worker.device)
+    info = {}
+    outcome = "error"
+    try:
+        yield info
+        outcome = "ok"
+    finally:
+        if outcome != "ok" and JOBS.get(case_id)["cancel_requested"]:
+            outcome = "cancelled"
+        peak = worker.peak_rss_mb() if stage in WORKER_STAGES else inference_worker.peak_rss_mb()
+        JOBS.end_stage(case_id, outcome, peak_rss_mb=peak, **info)
+
+
+def segmentation_params(values) -> dict:
+    """
+    SEG_PARAMS with the overrides a request may make ("fast").
+    """
+    params = dict(SEG_PARAMS)
+    fast = values.get("fast")
+    if fast is not None:
+        params["fast"] = str(fast).lower() not in ("0", "false", "no")
+    return params
+
+
+def export_options(values) -> dict:
+    """
+    EXPORT_DEFAULTS with the request's "layout" / "format" overrides.
+    Raises ValueError for values we cannot write.
+    """
+    export = dict(EXPORT_DEFAULTS)
+    for option in export:
+        if values.get(option):
+            export[option] = str(values[option]).lower()
+    if export["layout"] not in EXPORT_LAYOUTS:
+        raise ValueError(f"layout must be one of: {', '.join(EXPORT_LAYOUTS)}")
+    if export["format"] not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+    return export
+
+
+def result_key(input_sha256: str, params: dict, export: dict | None = None) -> str:
+    """
+    Cache key of a segmentation: the input's content hash plus the
+    parameters that change the output.
+    """
+    key = {"input": input_sha256, "params": params}
+    if export and export != EXPORT_DEFAULTS:
+        # the default export keeps the keys of results cached before it was an option
+        key["export"] = export
+    blob = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def resample_to_spacing(img: sitk.Image, spacing_mm: float) -> sitk.Image:
+    """
+    Linear resample to isotropic spacing_mm, same origin and direction.
+    Axes already coarser than spacing_mm are left as they are.
+    """
+    spacing = [max(s, spacing_mm) for s in img.GetSpacing()]
+    size = [max(1, int(round(n * s / t))) for n, s, t in zip(img.GetSize(), img.GetSpacing(), spacing)]
+    return sitk.Resample(
+        img, size, sitk.Transform(), sitk.sitkLinear, img.GetOrigin(), spacing,
+        img.GetDirection(), float(BODY_HU * 2), img.GetPixelID(),
+    )
+
+
+def crop_to_mask(img: sitk.Image, mask: np.ndarray, pad: int = 1) -> sitk.Image:
+    """
+    Crop img (array order z, y, x = mask order) to the bounding box of
+    mask plus pad voxels; the whole image if mask is empty.
+    """
+    if not mask.any():
+        return img
+    lo, hi = [], []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        idx = np.flatnonzero(mask.any(axis=other))
+        lo.append(max(0, idx[0] - pad))
+        hi.append(min(mask.shape[axis], idx[-1] + 1 + pad))
+    # SimpleITK indexes x, y, z
+    return img[lo[2]:hi[2], lo[1]:hi[1], lo[0]:hi[0]]
+
+
+def detect_thorax(img: sitk.Image) -> tuple[tuple, tuple] | None:
+    """
+    (lo, hi) voxel bounds, z/y/x order with hi exclusive, of the lungs
+    plus ROI_PAD_MM in img; None if no lung-sized air was found.
+    Air components touching the in-plane border are outside the body;
+    of the rest, those of at least MIN_LUNG_ML and a tenth of the
+    largest are kept (both lungs, joined or not by the airways).
+    """
+    from scipy import ndimage
+
+    small = resample_to_spacing(img, ROI_SPACING)
+    air = sitk.GetArrayViewFromImage(small) < LUNG_HU
+    labels, n = ndimage.label(air)
+    if n == 0:
+        return None
+
+    outside = np.unique(np.concatenate([
+        labels[:, 0, :].ravel(), labels[:, -1, :].ravel(),
+        labels[:, :, 0].ravel(), labels[:, :, -1].ravel(),
+    ]))
+    sizes = np.bincount(labels.ravel(), minlength=n + 1).astype(np.float64)
+    sizes[0] = 0
+    sizes[outside] = 0
+    sizes *= np.prod(small.GetSpacing()) / 1000.0           # ml
+    keep = (sizes >= MIN_LUNG_ML) & (sizes >= 0.1 * sizes.max())
+    if not keep.any():
+        return None
+
+    lung = keep[labels]
+    small_spacing = np.array(small.GetSpacing()[::-1])     # z, y, x
+    full_spacing = np.array(img.GetSpacing()[::-1])
+    full_shape = np.array(img.GetSize()[::-1])
+    lo, hi = [], []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        idx = np.flatnonzero(lung.any(axis=other))
+        # voxel i of the small grid spans (i -/+ 0.5) * small spacing
+        start = (idx[0] - 0.5) * small_spacing[axis] - ROI_PAD_MM
+        stop = (idx[-1] + 0.5) * small_spacing[axis] + ROI_PAD_MM
+        lo.append(int(max(0, np.floor(start / full_spacing[axis]))))
+        hi.append(int(min(full_shape[axis], np.ceil(stop / full_spacing[axis]) + 1)))
+    return tuple(lo), tuple(hi)
+
+
+def crop_to_thorax(case_id: str, input_nii: str) -> tuple[sitk.Image, dict | None]:
+    """
+    The inference input: input_nii cropped to its thorax ROI, or whole
+    if none was found or the crop would save little. The returned ROI
+    dict (box + full-image geometry) is what export_lung_masks needs; it is
+    also recorded on the job with the voxel share and timing.
+    """
+    start = time.perf_counter()
+    img = sitk.ReadImage(input_nii)
+    box = detect_thorax(img) if ROI_ENABLED else None
+    full = int(np.prod(img.GetSize()))
+    kept = int(np.prod(np.subtract(box[1], box[0]))) if box else full
+    seconds = time.perf_counter() - start
+    if box is None or kept >= ROI_MIN_GAIN * full:
+        JOBS.update(case_id, roi=json.dumps({"box": None, "fraction": 1.0, "seconds": seconds}))
+        return img, None
+
+    (z0, y0, x0), (z1, y1, x1) = box
+    roi = {
+        "box": [list(box[0]), list(box[1])],
+        "size": list(img.GetSize()),
+        "spacing": list(img.GetSpacing()),
+        "origin": list(img.GetOrigin()),
+        "direction": list(img.GetDirection()),
+    }
+    JOBS.update(case_id, roi=json.dumps({
+        "box": roi["box"], "fraction": kept / full, "seconds": seconds,
+    }))
+    # SimpleITK indexes x, y, z; slicing keeps the physical position
+    return img[x0:x1, y0:y1, z0:z1], roi
+
+
+def make_preview_input(img: sitk.Image, tmp_dir: str) -> str:
+    """
+    Downsample the (ROI) input to PREVIEW_SPACING and crop it to the
+    body. The preview masks are resampled back onto img afterwards.
+    """
+    small = resample_to_spacing(img, PREVIEW_SPACING)
+    body = sitk.GetArrayViewFromImage(small) > BODY_HU
+    preview_nii = os.path.join(tmp_dir, "preview_input.nii.gz")
+    sitk.WriteImage(crop_to_mask(small, body), preview_nii)
+    return preview_nii
+
+
+def _mask_name(filename: str) -> str | None:
+    # TotalSegmentator lung files start with "lung_..."
+    for ext in (".nii.gz", ".nii"):
+        if filename.startswith("lung_") and filename.endswith(ext):
+            return filename[:-len(ext)]
+    return None
+
+
+def load_lung_masks(mask_dir: str, reference: sitk.Image | None = None) -> dict[str, sitk.Image]:
+    """
+    Read the lung_* masks TotalSegmentator wrote to mask_dir (not its
+    subdirectories), in parallel. With a reference, e.g. for the coarse
+    preview masks, each is put on that grid (smooth upsampling: linear
+    interpolation, then threshold at 0.5).
+    """
+    paths = {}
+    for f in sorted(os.listdir(mask_dir)):
+        name = _mask_name(f)
+        if name is not None:
+            paths[name] = os.path.join(mask_dir, f)
+    if not paths:
+        raise RuntimeError("Segmentation produced no lung masks.")
+
+    def read(path):
+        mask = sitk.ReadImage(path)
+        if reference is not None:
+            mask = sitk.Resample(sitk.Cast(mask, sitk.sitkFloat32), reference,
+                                 sitk.Transform(), sitk.sitkLinear, 0.0) > 0.5
+        return mask
+
+    with ThreadPoolExecutor(max_workers=EXPORT_THREADS) as pool:
+        return dict(zip(paths, pool.map(read, paths.values())))
+
+
+def export_lung_masks(masks: dict[str, sitk.Image], roi: dict | None, out_dir: str,
+                      export: dict) -> list[str]:
+    """
+    Write the masks to out_dir as gzip-compressed NRRD / NIfTI, pasted
+    back into the full input geometry if inference ran on the ROI:
+    - layout "packed": one uint8 label map (lobe i of LUNG_LOBE_CLASSES
+      is label i + 1) and labels.json naming the labels
+    - layout "separate": one binary mask per lobe, written in parallel
+    Returns the written paths.
+    """
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    ext = EXPORT_FORMATS[export["format"]]
+    grid = next(iter(masks.values()))
+
+    def write(name, values):
+        # values: uint8 array (z, y, x) on the grid of the masks
+        if roi is None:
+            out = sitk.GetImageFromArray(values)
+            out.CopyInformation(grid)
+        else:
+            (z0, y0, x0), (z1, y1, x1) = roi["box"]
+            full = np.zeros(roi["size"][::-1], dtype=np.uint8)
+            full[z0:z1, y0:y1, x0:x1] = values
+            out = sitk.GetImageFromArray(full)
+            out.SetSpacing(roi["spacing"])
+            out.SetOrigin(roi["origin"])
+            out.SetDirection(roi["direction"])
+        path = os.path.join(out_dir, name + ext)
+        sitk.WriteImage(out, path, useCompression=True)
+        return path
+
+    if export["layout"] == "packed":
+        labels = np.zeros(grid.GetSize()[::-1], dtype=np.uint8)
+        names = {}
+        order = LUNG_LOBE_CLASSES + sorted(set(masks) - set(LUNG_LOBE_CLASSES))
+        for value, name in enumerate(order, start=1):
+            if name in masks:
+                labels[sitk.GetArrayViewFromImage(masks[name]) > 0] = value
+                names[str(value)] = name
+        labels_path = os.path.join(out_dir, "labels.json")
+        with open(labels_path, "w") as fh:
+            json.dump(names, fh, indent=1)
+        return [write(PACKED_NAME, labels), labels_path]
+
+    def write_mask(name):
+        return write(name, (sitk.GetArrayViewFromImage(masks[name]) > 0).astype(np.uint8))
+
+    with ThreadPoolExecutor(max_workers=EXPORT_THREADS) as pool:
+        return list(pool.map(write_mask, masks))
+
+
+class _ZipSink:
+    """
+    Write-only file for zipfile; stream_zip hands on what was written.
+    Not seekable, so zipfile writes sizes in data descriptors.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(paths: list[str]):
+    """
+    Yield a ZIP of paths (by base name) while it is being built. Entries
+    are stored, not deflated: the masks are gzip-compressed already.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zipf:
+        for path in paths:
+            info = zipfile.ZipInfo.from_file(path, os.path.basename(path))
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, "rb") as src, zipf.open(info, "w") as dst:
+                while True:
+                    buf = src.read(upload_store.COPY_BUFFER)
+                    if not buf:
+                        break
+                    dst.write(buf)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
 
 
 def convert_nrrd_to_nifti(input_path: str, tmp_dir: str) -> str:
@@ -81,95 +482,112 @@ def convert_nrrd_to_nifti(input_path: str, tmp_dir: str) -> str:
     return nifti_path
 
 
-def convert_nii_to_nrrd(nii_path: str, out_dir: str) -> str:
+def convert_dicom_to_nifti(dicom_path: str, tmp_dir: str) -> str:
     """
-    Convert NIfTI (.nii or .nii.gz) to NRRD.
-    Output filename keeps base + .nrrd.
+    Convert a DICOM ZIP or folder to NIfTI (.nii.gz), reading ZIP members
+    in place and decoding slices in parallel (see dicom_ingest).
     """
-    img = sitk.ReadImage(nii_path)
-    base = os.path.basename(nii_path)
-    if base.endswith(".nii.gz"):
-        base = base[:-7]
-    elif base.endswith(".nii"):
-        base = base[:-4]
-    filename = base + ".nrrd"
-    out_path = os.path.join(out_dir, filename)
-    sitk.WriteImage(img, out_path)
-    return out_path
+    series = dicom_ingest.load_series(dicom_path)
+    nifti_path = os.path.join(tmp_dir, "input_converted.nii.gz")
+    sitk.WriteImage(series.to_sitk(), nifti_path)
+    return nifti_path
 
 
-def run_totalseg_lung(input_nii: str, case_result_dir: str, case_id: str):
+def run_totalseg_lung(input_nii: str, case_result_dir: str, case_id: str,
+                      params: dict, worker: inference_worker.InferenceWorker,
+                      stage: str = "refine"):
     """
-    Run TotalSegmentator for lung lobes:
-    - Try GPU first (if available)
-    - On any GPU error, fall back to CPU
-    Only raise an exception if both GPU and CPU fail.
+    Run TotalSegmentator for lung lobes in the slot's resident worker
+    process, on that slot's device. A GPU failure is raised to the
+    caller, which hands the job to a CPU slot (or retries on CPU itself
+    when there is none).
     """
-    gpu_error_msg = None
-
-    # ----------------- Try GPU first, if PyTorch + CUDA available -----------------
-    if HAS_TORCH and torch.cuda.is_available():
+    warm = worker.is_warm(params)
+    JOBS.update(case_id, worker_state="warm" if warm else "cold")
+    model = "model loaded" if warm else "loading model"
+    if stage == "preview":
         update_job_status(
             case_id,
-            "Running lung segmentation on GPU (low-memory mode)..."
+            f"Running quick preview segmentation on {worker.device.upper()} ({model})..."
         )
-        try:
-            totalsegmentator(
-                input=input_nii,
-                output=case_result_dir,
-                task="total",
-                roi_subset=LUNG_LOBE_CLASSES,   # only lung lobes
-                fast=True,                      # lower resolution (less memory, faster)
-                body_seg=True,
-                force_split=True,               # process in parts, safer for VRAM/RAM
-                preview=False,
-                device="gpu",
-                verbose=True,
-            )
-            return  # success on GPU
-        except Exception as e:
-            gpu_error_msg = str(e)
-            # Log GPU error in status text only, not as fatal error
-            update_job_status(
-                case_id,
-                "GPU failed (likely low VRAM). Falling back to CPU...",
-            )
+    else:
+        resolution = "3 mm model" if params.get("fast") else "1.5 mm model"
+        update_job_status(
+            case_id,
+            f"Running lung segmentation on {worker.device.upper()} ({resolution}, {model})..."
+        )
+    worker.run(case_id, input_nii, case_result_dir, params)
 
-    # ----------------- Fall back to CPU -----------------
-    update_job_status(
-        case_id,
-        "Running lung segmentation on CPU (this may take 10–30 minutes)..."
-    )
 
+def retry_on_cpu(case_id: str, input_nii: str, case_result_dir: str, params: dict,
+                 voxels: int, gpu_worker: inference_worker.InferenceWorker):
+    """
+    Re-run inference of a job whose GPU run failed when there is no CPU
+    slot to hand it to: in a temporary CPU worker owned by the GPU slot.
+    """
+    cpu_worker = inference_worker.InferenceWorker("cpu", TORCH_THREADS)
+    SCHEDULER.running[case_id] = cpu_worker     # so cancel kills this one
     try:
-        totalsegmentator(
-            input=input_nii,
-            output=case_result_dir,
-            task="total",
-            roi_subset=LUNG_LOBE_CLASSES,
-            fast=True,
-            body_seg=True,
-            force_split=True,
-            preview=False,
-            device="cpu",
-            verbose=True,
-        )
-        # success on CPU, make sure no error is stored
-        update_job_status(case_id, "Lung segmentation on CPU completed.")
-    except Exception as cpu_err:
-        # If CPU also fails, now it's a real error
-        combined_msg = f"GPU error: {gpu_error_msg}; CPU error: {cpu_err}" if gpu_error_msg else str(cpu_err)
-        raise RuntimeError(combined_msg)
+        with job_stage(case_id, "inference", cpu_worker) as info:
+            info["voxels"] = voxels
+            run_totalseg_lung(input_nii, case_result_dir, case_id, params, cpu_worker)
+    except Exception as e:
+        check_cancelled(case_id)
+        raise RuntimeError(f"GPU error: {JOBS.get(case_id)['gpu_error']}; CPU error: {e}")
+    finally:
+        cpu_worker.stop()
+        SCHEDULER.running[case_id] = gpu_worker
+
+
+def run_preview(case_id: str, input_img: sitk.Image, roi: dict | None, tmp_dir: str,
+                case_result_dir: str, params: dict, export: dict,
+                worker: inference_worker.InferenceWorker):
+    """
+    Stage one: segment a body-cropped PREVIEW_SPACING copy of the (ROI)
+    input with the 6 mm model, resample the masks back to the input grid
+    and publish them as the preview download. A failed preview only
+    costs the early result; the final stage still runs.
+    """
+    JOBS.update(case_id, preview_state="running")
+    preview_dir = os.path.join(case_result_dir, PREVIEW_DIRNAME)
+    shutil.rmtree(preview_dir, ignore_errors=True)
+    os.makedirs(preview_dir)
+    try:
+        with job_stage(case_id, "preview", worker):
+            update_job_status(case_id, "Preparing quick preview...")
+            preview_nii = make_preview_input(input_img, tmp_dir)
+            run_totalseg_lung(preview_nii, preview_dir, case_id,
+                              dict(params, **PREVIEW_OVERRIDES), worker, stage="preview")
+            masks_dir = os.path.join(preview_dir, EXPORT_DIRNAME)
+            export_lung_masks(load_lung_masks(preview_dir, reference=input_img), roi, masks_dir, export)
+    except Exception as e:
+        check_cancelled(case_id)
+        JOBS.update(case_id, preview_state="error", preview_error=str(e))
+        return
+    JOBS.update(case_id, preview_state="finished", preview_masks_dir=masks_dir)
 
 
-def process_case(case_id: str, uploaded_path: str, original_filename: str):
+def check_cancelled(case_id: str):
     """
-    Background worker:
+    Stop a running job between stages once cancellation was requested.
+    """
+    job = JOBS.get(case_id)
+    if job and job["cancel_requested"]:
+        raise JobCancelled()
+
+
+def process_case(case_id: str, uploaded_path: str, original_filename: str,
+                 params: dict, export: dict, worker: inference_worker.InferenceWorker):
+    """
+    Run one job in its scheduler slot:
     - convert input to NIfTI if needed
-    - run TotalSegmentator (lung-only, GPU first → CPU fallback)
-    - convert lung masks to NRRD
-    - create ZIP file
-    - update JOBS with status + zip_path
+    - crop to the thorax ROI
+    - quick preview: publish provisional masks from the 6 mm model
+    - run TotalSegmentator (lung-only) in the slot's worker
+    - write the masks, pasted back into the input geometry, as export asks
+    - record state + masks_dir in the job store (downloads zip it on the fly)
+    A failure on the GPU re-queues the job for a CPU slot, or retries
+    it in a temporary CPU worker when CPU_SLOTS is 0.
     """
     tmp_dir = tempfile.mkdtemp(prefix=f"totalseg_{case_id}_")
     case_result_dir = os.path.join(RESULT_BASE_DIR, case_id)
@@ -183,98 +601,442 @@ def process_case(case_id: str, uploaded_path: str, original_filename: str):
         # -------------------------------------------------
         # 1. Convert input to NIfTI (.nii / .nii.gz)
         # -------------------------------------------------
-        if filename_lower.endswith((".nii", ".nii.gz")):
-            input_nii = uploaded_path
-
-        elif filename_lower.endswith(".nrrd"):
-            update_job_status(case_id, "Converting NRRD to NIfTI...")
-            input_nii = convert_nrrd_to_nifti(uploaded_path, tmp_dir)
-
-        elif filename_lower.endswith(".zip"):
-            # DICOM ZIP -> NIfTI
-            update_job_status(case_id, "Extracting DICOM ZIP and converting to NIfTI...")
-
-            dicom_dir = os.path.join(tmp_dir, "dicom")
-            os.makedirs(dicom_dir, exist_ok=True)
-            with zipfile.ZipFile(uploaded_path, "r") as zip_ref:
-                zip_ref.extractall(dicom_dir)
-
-            nifti_dir = os.path.join(tmp_dir, "nifti")
-            os.makedirs(nifti_dir, exist_ok=True)
-
-            dicom2nifti.convert_directory(dicom_dir, nifti_dir, reorient=True)
-
-            nii_files = [
-                f for f in os.listdir(nifti_dir)
-                if f.endswith(".nii.gz") or f.endswith(".nii")
-            ]
-            if not nii_files:
-                raise RuntimeError("DICOM to NIfTI conversion failed: no NIfTI files found.")
-
-            input_nii = os.path.join(nifti_dir, nii_files[0])
-
-        else:
-            raise RuntimeError(
-                "Unsupported file type. Please upload NIfTI (.nii / .nii.gz), "
-                "NRRD (.nrrd) or DICOM ZIP (.zip)."
-            )
+        with job_stage(case_id, "convert", worker):
+            if filename_lower.endswith((".nii", ".nii.gz")):
+                input_nii = uploaded_path
+
+            elif filename_lower.endswith(".nrrd"):
+                update_job_status(case_id, "Converting NRRD to NIfTI...")
+                input_nii = convert_nrrd_to_nifti(uploaded_path, tmp_dir)
+
+            elif filename_lower.endswith(".zip"):
+                # DICOM ZIP -> NIfTI, read straight from the archive
+                update_job_status(case_id, "Reading DICOM ZIP and converting to NIfTI...")
+                try:
+                    input_nii = convert_dicom_to_nifti(uploaded_path, tmp_dir)
+                except ValueError as e:
+                    raise RuntimeError(f"DICOM to NIfTI conversion failed: {e}")
+
+            else:
+                raise RuntimeError(
+                    "Unsupported file type. Please upload NIfTI (.nii / .nii.gz), "
+                    "NRRD (.nrrd) or DICOM ZIP (.zip)."
+                )
 
         # -------------------------------------------------
-        # 2. Run TotalSegmentator (lung-only, GPU→CPU)
+        # 2. Crop to the thorax; inference only sees the ROI
         # -------------------------------------------------
-        run_totalseg_lung(input_nii, case_result_dir, case_id)
+        with job_stage(case_id, "roi", worker) as info:
+            update_job_status(case_id, "Locating the lungs...")
+            input_img, roi = crop_to_thorax(case_id, input_nii)
+            if roi is not None:
+                input_nii = os.path.join(tmp_dir, "input_roi.nii.gz")
+                sitk.WriteImage(input_img, input_nii)
+            info["voxels"] = int(np.prod(roi["size"] if roi else input_img.GetSize()))
 
         # -------------------------------------------------
-        # 3. Convert lung masks to NRRD
+        # 3. Quick preview (skipped when re-run after a GPU failure)
         # -------------------------------------------------
-        update_job_status(case_id, "Converting lung masks to NRRD...")
-
-        nrrd_dir = os.path.join(case_result_dir, "nrrd_masks")
-        os.makedirs(nrrd_dir, exist_ok=True)
-
-        for root, _, files in os.walk(case_result_dir):
-            for f in files:
-                # only convert the lung masks
-                if not (f.endswith(".nii") or f.endswith(".nii.gz")):
-                    continue
-
-                base = os.path.basename(f)
-                # TotalSegmentator lung files start with "lung_..."
-                if not base.startswith("lung_"):
-                    continue
-
-                nii_file = os.path.join(root, f)
-                convert_nii_to_nrrd(nii_file, nrrd_dir)
+        check_cancelled(case_id)
+        if PREVIEW_ENABLED and JOBS.get(case_id)["preview_state"] != "finished":
+            run_preview(case_id, input_img, roi, tmp_dir, case_result_dir, params, export, worker)
+            check_cancelled(case_id)
+        inferred_voxels = int(np.prod(input_img.GetSize()))
+        del input_img
 
         # -------------------------------------------------
-        # 4. Create ZIP with NRRD masks
+        # 4. Run TotalSegmentator (lung-only)
         # -------------------------------------------------
-        update_job_status(case_id, "Creating ZIP file...")
-
-        zip_name = f"{case_id}_lungs_nrrd.zip"
-        zip_path = os.path.join(case_result_dir, zip_name)
-
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for f in os.listdir(nrrd_dir):
-                file_path = os.path.join(nrrd_dir, f)
-                zipf.write(file_path, arcname=f)
-
-        if not os.path.exists(zip_path):
-            raise RuntimeError("ZIP file creation failed.")
+        JOBS.update(case_id, refine_state="running")
+        try:
+            with job_stage(case_id, "inference", worker) as info:
+                info["voxels"] = inferred_voxels
+                run_totalseg_lung(input_nii, case_result_dir, case_id, params, worker)
+        except Exception as e:
+            # killed worker: the job was cancelled while running
+            check_cancelled(case_id)
+            if worker.device != "gpu":
+                gpu_error = JOBS.get(case_id)["gpu_error"]
+                raise RuntimeError(f"GPU error: {gpu_error}; CPU error: {e}" if gpu_error else str(e))
+            if CPU_SLOTS > 0:
+                # Log GPU error in status text only, not as fatal error
+                JOBS.requeue(case_id, device="cpu", gpu_error=str(e), refine_state="pending",
+                             status="GPU failed (likely low VRAM). Waiting for a CPU slot...")
+                return
+            JOBS.update(case_id, gpu_error=str(e),
+                        status="GPU failed (likely low VRAM). Retrying on CPU...")
+            retry_on_cpu(case_id, input_nii, case_result_dir, params, inferred_voxels, worker)
+        check_cancelled(case_id)
 
-        with JOBS_LOCK:
-            JOBS[case_id]["zip_path"] = zip_path
+        # -------------------------------------------------
+        # 5. Write the lung masks in the full input geometry
+        # -------------------------------------------------
+        with job_stage(case_id, "export", worker):
+            update_job_status(case_id, "Writing lung masks...")
+            masks_dir = os.path.join(case_result_dir, EXPORT_DIRNAME)
+            export_lung_masks(load_lung_masks(case_result_dir), roi, masks_dir, export)
 
-        update_job_status(case_id, "finished")
+        JOBS.update(case_id, state="finished", status="finished", refine_state="finished",
+                    masks_dir=masks_dir, finished=time.time())
 
+    except JobCancelled:
+        JOBS.update(case_id, state="cancelled", status="cancelled", finished=time.time())
     except Exception as e:
         # Real failure (CPU also failed or pre/post steps crashed)
-        update_job_status(case_id, "error", str(e))
+        JOBS.update(case_id, state="error", status="error", refine_state="error", error=str(e),
+                    finished=time.time())
     finally:
-        # Clean up temporary directory; keep case_result_dir for the ZIP
+        # Clean up temporary directory; keep case_result_dir for the download
         shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
+# ---------------------------------------------------------------------
+# Job store + scheduler
+# ---------------------------------------------------------------------
+# Job lifecycle ("state"): queued -> running -> finished | error | cancelled.
+# "status" stays the human-readable progress text shown by the frontend.
+# "device" is NULL while any slot may take the job, "cpu" once it has to
+# run on a CPU slot.
+_JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    case_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    status TEXT,
+    error TEXT,
+    gpu_error TEXT,
+    original_name TEXT,
+    input_path TEXT,
+    params TEXT,
+    result_key TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    device TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    export TEXT,
+    masks_dir TEXT,
+    zip_path TEXT,              -- prebuilt ZIP of results from before masks_dir
+    worker_state TEXT,
+    preview_state TEXT,
+    preview_error TEXT,
+    preview_masks_dir TEXT,
+    refine_state TEXT,
+    roi TEXT,
+    stage TEXT,
+    timings TEXT,
+    rev INTEGER,                -- bumped by every write, for change waiters
+    seq INTEGER,
+    created REAL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority DESC, seq);
+CREATE INDEX IF NOT EXISTS jobs_result ON jobs (result_key, state);
+"""
+
+_JOBS_ADDED_COLUMNS = ("worker_state", "preview_state", "preview_error", "preview_masks_dir",
+                       "refine_state", "roi", "export", "masks_dir", "stage", "timings",
+                       "rev INTEGER")
+
+_BUMP_REV = "rev = COALESCE(rev, 0) + 1"
+
+ACTIVE_STATES = ("queued", "running")
+
+
+class JobStore:
+    """
+    SQLite-backed job registry shared by the API handlers and the slots.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._claim_lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._versions = {}         # case_id -> writes seen in this process
+        self._estimates = (0.0, {})     # (computed at, stage_estimates())
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_JOBS_SCHEMA)
+            # job stores created by earlier versions lack the newer columns
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column in _JOBS_ADDED_COLUMNS:
+                name, _, type_ = column.partition(" ")
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {type_ or 'TEXT'}")
+        return conn
+
+    def create(self, case_id: str, **fields):
+        fields.update(case_id=case_id, created=time.time(), rev=1)
+        with self._db() as db:
+            # seq keeps FIFO order within a priority, also across restarts
+            fields["seq"] = db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM jobs").fetchone()[0]
+            columns = ", ".join(fields)
+            marks = ", ".join("?" for _ in fields)
+            db.execute(f"INSERT INTO jobs ({columns}) VALUES ({marks})", list(fields.values()))
+        self._notify(case_id)
+
+    def get(self, case_id: str) -> dict | None:
+        row = self._db().execute("SELECT * FROM jobs WHERE case_id = ?", (case_id,)).fetchone()
+        return dict(row) if row else None
+
+    def update(self, case_id: str, **fields):
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._db() as db:
+            db.execute(f"UPDATE jobs SET {assignments}, {_BUMP_REV} WHERE case_id = ?",
+                       list(fields.values()) + [case_id])
+        self._notify(case_id)
+
+    def _notify(self, case_id: str):
+        with self._changed:
+            self._versions[case_id] = self._versions.get(case_id, 0) + 1
+            self._changed.notify_all()
+
+    def wait_for_change(self, case_id: str, seen: int | None, timeout: float) -> int | None:
+        """
+        Block until the job's rev differs from `seen` or timeout passed
+        (at once for seen=None); returns the current rev. Writes from
+        this process wake the waiter at once; those of other processes
+        sharing the database are noticed within CHANGE_POLL_SECONDS.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._changed:
+                local = self._versions.get(case_id, 0)
+            row = self._db().execute("SELECT rev FROM jobs WHERE case_id = ?", (case_id,)).fetchone()
+            rev = row["rev"] if row else None
+            remaining = deadline - time.monotonic()
+            if seen is None or rev != seen or remaining <= 0:
+                return rev
+            with self._changed:
+                self._changed.wait_for(lambda: self._versions.get(case_id, 0) != local,
+                                       min(remaining, CHANGE_POLL_SECONDS))
+
+    def start_stage(self, case_id: str, stage: str, device: str):
+        """
+        Append a running entry for stage to the job's timings.
+        """
+        timings = json.loads(self.get(case_id)["timings"] or "[]")
+        timings.append({"stage": stage, "device": device, "start": time.time(), "end": None})
+        self.update(case_id, stage=stage, timings=json.dumps(timings))
+
+    def end_stage(self, case_id: str, outcome: str, **info):
+        """
+        Close the running timings entry: end time, outcome (ok, error,
+        cancelled) and info such as peak_rss_mb and voxels.
+        """
+        timings = json.loads(self.get(case_id)["timings"] or "[]")
+        if timings and timings[-1]["end"] is None:
+            timings[-1].update(info, end=time.time(), outcome=outcome)
+            self.update(case_id, timings=json.dumps(timings))
+
+    def stage_estimates(self) -> dict:
+        """
+        Median seconds per (stage, device) of the successful stages of
+        the last STAGE_HISTORY_JOBS finished jobs; recomputed once a
+        minute at most.
+        """
+        computed, estimates = self._estimates
+        if time.time() - computed < 60:
+            return estimates
+        rows = self._db().execute(
+            "SELECT timings FROM jobs WHERE state = 'finished' AND timings IS NOT NULL "
+            "ORDER BY finished DESC LIMIT ?",
+            (STAGE_HISTORY_JOBS,),
+        ).fetchall()
+        seconds = {}
+        for row in rows:
+            for entry in json.loads(row["timings"]):
+                if entry.get("outcome") == "ok":
+                    seconds.setdefault((entry["stage"], entry["device"]), []).append(
+                        entry["end"] - entry["start"])
+        estimates = {key: float(np.median(values)) for key, values in seconds.items()}
+        self._estimates = (time.time(), estimates)
+        return estimates
+
+    def requeue(self, case_id: str, **fields):
+        """
+        Put a job back in the queue at its original place.
+        """
+        self.update(case_id, state="queued", started=None, **fields)
+        SCHEDULER.wake()
+
+    def find(self, result_key: str, states) -> dict | None:
+        """
+        Most recent job for this input + parameters in one of `states`.
+        """
+        marks = ", ".join("?" for _ in states)
+        row = self._db().execute(
+            f"SELECT * FROM jobs WHERE result_key = ? AND state IN ({marks}) "
+            "ORDER BY seq DESC LIMIT 1",
+            [result_key, *states],
+        ).fetchone()
+        return dict(row) if row else None
+
+    def queue_position(self, job: dict) -> int | None:
+        """
+        1-based place of a queued job in the dispatch order, else None.
+        """
+        if job["state"] != "queued":
+            return None
+        ahead = self._db().execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND "
+            "(priority > ? OR (priority = ? AND seq < ?))",
+            (job["priority"], job["priority"], job["seq"]),
+        ).fetchone()[0]
+        return ahead + 1
+
+    def claim(self, device: str, any_job: bool = True) -> dict | None:
+        """
+        Take the next queued job a slot of `device` may run, or None.
+        GPU slots skip jobs that must run on CPU. CPU slots take those
+        first, and the others only with any_job (no GPU slot is free).
+        """
+        if device == "gpu":
+            condition = "device IS NULL"
+        elif any_job:
+            condition = "1"
+        else:
+            condition = "device = 'cpu'"
+        with self._claim_lock:
+            db = self._db()
+            row = db.execute(
+                f"SELECT case_id FROM jobs WHERE state = 'queued' AND {condition} "
+                "ORDER BY device IS NULL, priority DESC, seq LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            with db:
+                claimed = db.execute(
+                    f"UPDATE jobs SET state = 'running', started = ?, {_BUMP_REV} "
+                    "WHERE case_id = ? AND state = 'queued'",
+                    (time.time(), row["case_id"]),
+                ).rowcount
+        if claimed:
+            self._notify(row["case_id"])
+        return self.get(row["case_id"]) if claimed else None
+
+    def cancel(self, case_id: str) -> dict | None:
+        """
+        Cancel a queued job at once, or flag a running one with
+        cancel_requested (its slot notices); returns the job afterwards.
+        """
+        with self._claim_lock:
+            with self._db() as db:
+                db.execute(
+                    f"UPDATE jobs SET state = 'cancelled', status = 'cancelled', finished = ?, {_BUMP_REV} "
+                    "WHERE case_id = ? AND state = 'queued'",
+                    (time.time(), case_id),
+                )
+                db.execute(
+                    f"UPDATE jobs SET cancel_requested = 1, status = 'Cancelling...', {_BUMP_REV} "
+                    "WHERE case_id = ? AND state = 'running'",
+                    (case_id,),
+                )
+        self._notify(case_id)
+        return self.get(case_id)
+
+    def recover(self):
+        """
+        After a restart, jobs that were running are queued again.
+        """
+        with self._db() as db:
+            db.execute(
+                f"UPDATE jobs SET state = 'queued', started = NULL, {_BUMP_REV}, "
+                "status = 'Re-queued after a server restart' WHERE state = 'running'"
+            )
+
+
+class JobScheduler:
+    """
+    One thread per GPU / CPU slot, each feeding its own resident
+    inference worker with jobs pulled from the store in priority + FIFO
+    order.
+    """
+
+    def __init__(self, store: JobStore, gpu_slots: int, cpu_slots: int):
+        self.store = store
+        self.workers = [
+            inference_worker.InferenceWorker(device, TORCH_THREADS)
+            for device in ["gpu"] * gpu_slots + ["cpu"] * cpu_slots
+        ]
+        self.running = {}           # case_id -> worker running it
+        self._wake = threading.Condition()
+        self._started = False
+
+    def start(self):
+        with self._wake:
+            if self._started:
+                return
+            self._started = True
+        self.store.recover()
+        for i, worker in enumerate(self.workers):
+            threading.Thread(
+                target=self._slot_loop, args=(worker,), name=f"totalseg-{worker.device}-{i}", daemon=True,
+            ).start()
+
+    def wake(self):
+        with self._wake:
+            self._wake.notify_all()
+
+    def gpu_free(self) -> bool:
+        """
+        Whether a GPU slot is idle. CPU slots leave jobs any slot may run
+        to the GPU while one is, and help out once all are busy.
+        """
+        busy = sum(1 for w in list(self.running.values()) if w.device == "gpu")
+        return busy < sum(1 for w in self.workers if w.device == "gpu")
+
+    def _slot_loop(self, worker: inference_worker.InferenceWorker):
+        while True:
+            # (re)start the worker while idle so imports are done before a case arrives
+            worker.start()
+            job = self.store.claim(worker.device, any_job=not self.gpu_free())
+            if job is None:
+                with self._wake:
+                    self._wake.wait(timeout=5)
+                continue
+            self.running[job["case_id"]] = worker
+            try:
+                export = json.loads(job["export"]) if job["export"] else EXPORT_DEFAULTS
+                process_case(job["case_id"], job["input_path"], job["original_name"],
+                             json.loads(job["params"]), export, worker)
+            finally:
+                self.running.pop(job["case_id"], None)
+
+    def submit(self, case_id: str, **fields):
+        self.store.create(case_id, state="queued", status="Queued",
+                          preview_state="pending" if PREVIEW_ENABLED else "skipped",
+                          refine_state="pending", **fields)
+        self.wake()
+
+    def cancel(self, case_id: str) -> dict | None:
+        """
+        Drop a queued job at once. A running job's worker process is
+        killed (the slot starts a fresh one); between stages the job
+        stops at its next check.
+        """
+        job = self.store.cancel(case_id)
+        if job is not None and job["state"] == "running":
+            worker = self.running.get(case_id)
+            if worker is not None:
+                worker.kill()
+        return job
+
+
+JOBS = JobStore(JOBS_DB)
+SCHEDULER = JobScheduler(JOBS, GPU_SLOTS, CPU_SLOTS)
+
+
+@app.before_request
+def _start_scheduler():
+    # started lazily so the debug reloader's watcher process runs no slots
+    SCHEDULER.start()
+
+
 # ---------------------------------------------------------------------
 # API endpoints
 # ---------------------------------------------------------------------
@@ -282,86 +1044,322 @@ def process_case(case_id: str, uploaded_path: str, original_filename: str):
 def totalseg_start():
     """
     Start a new lung segmentation job.
-    Request: multipart/form-data with "file"
-    Response: { "case_id": "...", "status": "started" }
+    Request: multipart/form-data with "file", or (after a chunked upload
+             to /uploads) JSON / form fields "sha256" + "filename".
+             Optional "fast" (default true: the 3 mm model; false
+             runs the 1.5 mm one), "priority" (higher runs first),
+             "layout" ("separate": one file per lobe, or "packed": one
+             uint8 label map + labels.json) and "format" ("nrrd" or "nifti").
+    Response: { "case_id": "...", "status": "started", "queue_position": n }
+              { "case_id": "...", "status": "finished", "cached": true }
+              when this input was already segmented with these parameters
     """
-    if "file" not in request.files:
+    values = request.get_json(silent=True) or request.form
+
+    if "file" in request.files:
+        file = request.files["file"]
+        if file.filename == "":
+            return jsonify({"error": "Empty filename"}), 400
+        original_name = file.filename
+        input_sha256, object_path = UPLOADS.put_stream(file.stream, original_name)
+    elif values.get("sha256") and values.get("filename"):
+        original_name = values["filename"]
+        input_sha256 = values["sha256"].lower()
+        object_path = UPLOADS.find(input_sha256)
+        if object_path is None:
+            return jsonify({"error": "Upload not found"}), 404
+    else:
         return jsonify({"error": "No file uploaded"}), 400
 
-    file = request.files["file"]
-    if file.filename == "":
-        return jsonify({"error": "Empty filename"}), 400
+    params = segmentation_params(values)
+    try:
+        export = export_options(values)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        priority = int(values.get("priority", 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "priority must be an integer"}), 400
+    key = result_key(input_sha256, params, export)
+
+    with START_LOCK:
+        cached = JOBS.find(key, ("finished",))
+        if cached is not None and _result_dir(cached, "final") is not None:
+            return jsonify({"case_id": cached["case_id"], "status": "finished", "cached": True}), 200
+
+        # same input + parameters already queued or running: share that job
+        active = JOBS.find(key, ACTIVE_STATES)
+        if active is not None:
+            return jsonify({"case_id": active["case_id"], "status": "started"}), 200
+
+        case_id = str(uuid.uuid4())[:8]
+        case_upload_dir = os.path.join(UPLOAD_DIR, case_id)
+        uploaded_path = upload_store.link_object(
+            object_path, upload_store.resolve_under(case_upload_dir, os.path.basename(original_name))
+        )
+        SCHEDULER.submit(
+            case_id,
+            original_name=original_name,
+            input_path=uploaded_path,
+            params=json.dumps(params),
+            export=json.dumps(export),
+            result_key=key,
+            priority=priority,
+        )
 
-    case_id = str(uuid.uuid4())[:8]
-    original_name = file.filename
+    job = JOBS.get(case_id)
+    return jsonify({"case_id": case_id, "status": "started",
+                    "queue_position": JOBS.queue_position(job)}), 200
 
-    case_upload_dir = os.path.join(UPLOAD_DIR, case_id)
-    os.makedirs(case_upload_dir, exist_ok=True)
 
-    uploaded_path = os.path.join(case_upload_dir, original_name)
-    file.save(uploaded_path)
+def _expected_seconds(stage: str, device: str, estimates: dict) -> float:
+    if (stage, device) in estimates:
+        return estimates[(stage, device)]
+    return DEFAULT_STAGE_SECONDS.get((stage, device), OTHER_STAGE_SECONDS)
 
-    with JOBS_LOCK:
-        JOBS[case_id] = {
-            "status": "started",
-            "error": None,
-            "zip_path": None,
-            "original_name": original_name,
-        }
 
-    # Start background worker thread
-    worker = threading.Thread(
-        target=process_case,
-        args=(case_id, uploaded_path, original_name),
-        daemon=True,
+def job_progress(job: dict) -> dict:
+    """
+    Where a job is: stage, percent of the stage and of the whole job,
+    elapsed and estimated remaining seconds, the slot's device
+    (cpu_fallback once the GPU run failed) and peak RSS of the current
+    run so far. Remaining time comes from the median stage durations of
+    recent jobs on that device (DEFAULT_STAGE_SECONDS until there are
+    any), so percentages are estimates too.
+    """
+    progress = {
+        "stage": job["state"] if job["state"] != "running" else job["stage"],
+        "stage_percent": None, "percent": None, "elapsed": None, "stage_elapsed": None,
+        "eta": None, "device": job["device"], "cpu_fallback": job["gpu_error"] is not None,
+        "peak_rss_mb": None,
+    }
+    if job["state"] == "queued" or job["started"] is None:
+        progress["percent"] = 0.0
+        return progress
+
+    # timings of this run (an earlier GPU run is in there too)
+    run = [t for t in json.loads(job["timings"] or "[]") if t["start"] >= job["started"]]
+    peaks = [t["peak_rss_mb"] for t in run if t.get("peak_rss_mb") is not None]
+    if run:
+        progress["device"] = run[-1]["device"]
+
+    if job["state"] != "running":
+        end = job["finished"] or time.time()
+        progress.update(elapsed=end - job["started"], eta=0.0,
+                        peak_rss_mb=max(peaks) if peaks else None)
+        if job["state"] == "finished":
+            progress.update(stage_percent=100.0, percent=100.0)
+        return progress
+
+    now = time.time()
+    estimates = JOBS.stage_estimates()
+    device = progress["device"]
+    current = run[-1] if run else {"stage": STAGES[0], "start": now, "end": None}
+    stage = current["stage"]
+    if current["end"] is None:
+        stage_elapsed = now - current["start"]
+        expected = _expected_seconds(stage, device, estimates)
+        remaining = max(expected - stage_elapsed, 0.0)
+        stage_percent = min(99.0, 100.0 * stage_elapsed / expected)
+        worker = SCHEDULER.running.get(job["case_id"])
+        if stage in WORKER_STAGES and worker is not None:
+            peaks.append(worker.peak_rss_mb())
+        elif stage not in WORKER_STAGES:
+            peaks.append(inference_worker.peak_rss_mb())
+    else:
+        # between two stages
+        stage_elapsed, remaining, stage_percent = current["end"] - current["start"], 0.0, 100.0
+    for later in STAGES[STAGES.index(stage) + 1:]:
+        if later == "preview" and job["preview_state"] not in ("pending", "running"):
+            continue
+        remaining += _expected_seconds(later, device, estimates)
+
+    elapsed = now - job["started"]
+    peaks = [p for p in peaks if p is not None]
+    progress.update(
+        stage=stage,
+        stage_percent=round(stage_percent, 1),
+        percent=round(min(99.0, 100.0 * elapsed / max(elapsed + remaining, 1e-6)), 1),
+        elapsed=elapsed,
+        stage_elapsed=stage_elapsed,
+        eta=remaining,
+        peak_rss_mb=max(peaks) if peaks else None,
     )
-    worker.start()
-
-    return jsonify({"case_id": case_id, "status": "started"}), 200
+    return progress
+
+
+def job_status(job: dict) -> dict:
+    return {
+        "case_id": job["case_id"],
+        "status": job["status"],
+        "error": job["error"],
+        "state": job["state"],
+        "queue_position": JOBS.queue_position(job),
+        "device": job["device"],
+        "worker": job["worker_state"],
+        "stages": {
+            "preview": {
+                "state": job["preview_state"],
+                "error": job["preview_error"],
+                "download": job["state"] != "finished" and _result_dir(job, "preview") is not None,
+            },
+            "refine": {"state": job["refine_state"]},
+        },
+        "roi": json.loads(job["roi"]) if job["roi"] else None,
+        "progress": job_progress(job),
+        "timings": json.loads(job["timings"]) if job["timings"] else [],
+    }
 
 
 @app.route("/api/totalseg_status/<case_id>", methods=["GET"])
 def totalseg_status(case_id):
     """
     Get status of a lung segmentation job.
-    Response: { "case_id": "...", "status": "...", "error": "..." }
+    Response: { "case_id": "...", "status": "...", "error": "...",
+                "state": "queued|running|finished|error|cancelled",
+                "queue_position": 1-based or null, "device": "gpu|cpu|null",
+                "worker": "warm|cold|null" (model already loaded in the
+                slot's worker when the job started),
+                "stages": { "preview": { state, error, download },
+                            "refine": { state } },
+                "roi": { box: [[z0, y0, x0], [z1, y1, x1]] or null,
+                         fraction: share of voxels inferred, seconds },
+                "progress": { stage, stage_percent, percent, elapsed,
+                              stage_elapsed, eta (seconds), device,
+                              cpu_fallback, peak_rss_mb },
+                "timings": [{ stage, device, start, end, outcome,
+                              peak_rss_mb, voxels? }] }
+    Stage states: pending, running, finished, error (skipped for a
+    disabled preview). preview.download is true while the preview ZIP
+    is what /api/totalseg_download serves. Progress stages: convert,
+    roi, preview, inference, export (queued / finished / error /
+    cancelled outside a run).
     """
-    with JOBS_LOCK:
-        job = JOBS.get(case_id)
+    job = JOBS.get(case_id)
 
     if not job:
         return jsonify({"error": "Job not found"}), 404
 
-    return jsonify({
-        "case_id": case_id,
-        "status": job.get("status"),
-        "error": job.get("error"),
-    })
+    return jsonify(job_status(job))
+
+
+@app.route("/api/totalseg_events/<case_id>", methods=["GET"])
+def totalseg_events(case_id):
+    """
+    Server-Sent Events instead of polling /api/totalseg_status: a
+    "progress" event with the same payload whenever the job changes
+    (within CHANGE_POLL_SECONDS when another process sharing the job
+    database changed it), and at least every EVENTS_REFRESH_SECONDS
+    while it is queued or running. Ends with an "end" event once the
+    job finished, failed or was cancelled.
+    """
+    if JOBS.get(case_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def events():
+        seen = None
+        while True:
+            seen = JOBS.wait_for_change(case_id, seen, EVENTS_REFRESH_SECONDS)
+            job = JOBS.get(case_id)
+            yield f"event: progress\ndata: {json.dumps(job_status(job))}\n\n"
+            if job["state"] not in ACTIVE_STATES:
+                yield "event: end\ndata: {}\n\n"
+                return
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/api/totalseg_workers", methods=["GET"])
+def totalseg_workers():
+    """
+    State of each slot's inference worker.
+    Response: { "workers": [{ device, state: "warm|cold", alive, pid, cases,
+                              generation, rss_mb }] }
+    """
+    return jsonify({"workers": [worker.describe() for worker in SCHEDULER.workers]})
+
+
+@app.route("/api/totalseg_cancel/<case_id>", methods=["POST"])
+def totalseg_cancel(case_id):
+    """
+    Cancel a queued or running job.
+    Response: { "case_id": "...", "state": "...", "status": "..." }
+    """
+    job = SCHEDULER.cancel(case_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"case_id": case_id, "state": job["state"], "status": job["status"]})
+
+
+def _result_dir(job: dict, stage: str) -> str | None:
+    """
+    Directory holding the written masks of a stage ("preview" or
+    "final") once it finished, else None.
+    """
+    if stage == "preview":
+        path = job["preview_masks_dir"] if job["preview_state"] == "finished" else None
+    else:
+        path = job["masks_dir"] if job["state"] == "finished" else None
+    return path if path and os.path.isdir(path) else None
+
+
+def _zip_response(result_dir: str, download_name: str, stage: str) -> Response:
+    paths = sorted(os.path.join(result_dir, f) for f in os.listdir(result_dir))
+    response = Response(stream_zip(paths), mimetype="application/zip")
+    try:
+        download_name.encode("ascii")
+        names = {"filename": download_name}
+    except UnicodeEncodeError:
+        # as send_file does: ASCII fallback plus the RFC 5987 UTF-8 name
+        simple = unicodedata.normalize("NFKD", download_name).encode("ascii", "ignore").decode("ascii")
+        names = {"filename": simple, "filename*": "UTF-8''" + quote(download_name, safe="!#$&+^`|~")}
+    response.headers.set("Content-Disposition", "attachment", **names)
+    response.headers["X-Result-Stage"] = stage
+    response.headers["Access-Control-Expose-Headers"] = "X-Result-Stage, Content-Disposition"
+    return response
 
 
 @app.route("/api/totalseg_download/<case_id>", methods=["GET"])
 def totalseg_download(case_id):
     """
-    Download the ZIP of lung NRRD masks for a finished job.
+    Download the ZIP of lung masks for a finished job, or the preview
+    masks while the final run is still going (X-Result-Stage:
+    preview | final). The ZIP is streamed while it is built, from the
+    gzip-compressed masks, stored without further compression.
     """
-    with JOBS_LOCK:
-        job = JOBS.get(case_id)
+    job = JOBS.get(case_id)
 
     if not job:
         return jsonify({"error": "Job not found"}), 404
 
-    if job.get("status") != "finished":
-        return jsonify({"error": "Job not finished yet"}), 400
+    base_name = (job["original_name"] or case_id).rsplit(".", 1)[0]
+    export = json.loads(job["export"]) if job["export"] else EXPORT_DEFAULTS
+    suffix = f"lungs_{export['format']}"
 
-    zip_path = job.get("zip_path")
-    if not zip_path or not os.path.exists(zip_path):
-        return jsonify({"error": "ZIP file not found"}), 500
+    if job["state"] != "finished":
+        preview_dir = _result_dir(job, "preview")
+        if job["state"] not in ACTIVE_STATES or preview_dir is None:
+            return jsonify({"error": "Job not finished yet"}), 400
+        return _zip_response(preview_dir, f"{base_name}_{suffix}_preview.zip", "preview")
 
-    base_name = job.get("original_name", case_id).rsplit(".", 1)[0]
-    download_name = f"{base_name}_lungs_nrrd.zip"
-    return send_file(zip_path, as_attachment=True, download_name=download_name)
+    result_dir = _result_dir(job, "final")
+    if result_dir is not None:
+        return _zip_response(result_dir, f"{base_name}_{suffix}.zip", "final")
+
+    # finished before masks were kept unzipped
+    zip_path = job["zip_path"]
+    if not zip_path or not os.path.exists(zip_path):
+        return jsonify({"error": "Result files not found"}), 500
+    response = send_file(zip_path, as_attachment=True, download_name=f"{base_name}_lungs_nrrd.zip")
+    response.headers["X-Result-Stage"] = "final"
+    response.headers["Access-Control-Expose-Headers"] = "X-Result-Stage"
+    return response
 
 
 if __name__ == "__main__":
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        # serving process of the debug reloader: resume recovered jobs now
+        SCHEDULER.start()
     # Make sure only one server uses port 5000
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,102 @@
+# Benchmark: single marching_cubes call vs. parallel slab meshing (app.py)
+#
+#   python bench_mesh.py                      # synthetic spheres and lobes
+#   python bench_mesh.py lung.nrrd lobes/     # plus real masks (any viewer format)
+#
+# For every mask the cropped, padded volume is meshed both ways; the
+# script checks that the welded result has the same vertices and faces
+# and is watertight, and prints the timings. The synthetic lobes are a
+# CT-sized stand-in (two lungs cut into five lobes by oblique fissures)
+# for when no real lung masks are at hand.
+
+import sys
+import time
+
+import numpy as np
+from skimage import measure
+
+import app
+
+
+def sphere_mask(n, radius_frac=0.45):
+    z, y, x = np.ogrid[:n, :n, :n]
+    c = (n - 1) / 2.0
+    r = radius_frac * n
+    return ((z - c) ** 2 + (y - c) ** 2 + (x - c) ** 2 < r * r).astype(np.uint8)
+
+
+def lobe_mask(shape=(400, 512, 512), spacing=(0.8, 0.7, 0.7)):
+    """uint8 label map of five lung lobes (1-2 left, 3-5 right)."""
+    d, h, w = shape
+    z = (np.arange(d) * spacing[0] - d * spacing[0] / 2)[:, None, None]
+    y = ((np.arange(h) - h / 2) * spacing[1])[None, :, None]
+    x = ((np.arange(w) - w / 2) * spacing[2])[None, None, :]
+    seg = np.zeros(shape, np.uint8)
+    for side, labels in ((1, (1, 2)), (-1, (3, 4, 5))):
+        lung = ((x - side * 75) / 60.0) ** 2 + ((y + 10) / 80.0) ** 2 + (z / 140.0) ** 2 < 1.0
+        # oblique fissure, plus the horizontal one on the right
+        upper = z > 0.6 * y - 10
+        seg[lung & upper] = labels[0]
+        seg[lung & ~upper] = labels[-1]
+        if len(labels) == 3:
+            seg[lung & upper & (z < 40) & (y < 0)] = labels[1]
+    return seg
+
+
+def is_watertight(faces):
+    edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+    _, counts = np.unique(edges, axis=0, return_counts=True)
+    return bool((counts == 2).all())
+
+
+def same_mesh(a_verts, a_faces, b_verts, b_faces):
+    if a_verts.shape != b_verts.shape or a_faces.shape != b_faces.shape:
+        return False
+    tri_a = np.sort(np.round(a_verts[a_faces], 4).reshape(len(a_faces), -1), axis=0)
+    tri_b = np.sort(np.round(b_verts[b_faces], 4).reshape(len(b_faces), -1), axis=0)
+    return np.array_equal(np.sort(tri_a.view([("", tri_a.dtype)] * 9), axis=0),
+                          np.sort(tri_b.view([("", tri_b.dtype)] * 9), axis=0))
+
+
+def timed(fn, repeat=3):
+    best, result = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, result
+
+
+def bench(name, seg, step_size=1):
+    vol, _ = app.mesh_input(seg, step_size)
+    app.parallel_marching_cubes(sphere_mask(16))    # start the pool outside the timing
+
+    t_single, (sv, sf, _, _) = timed(lambda: measure.marching_cubes(vol, level=0.5, step_size=step_size))
+    t_par, (pv, pf) = timed(lambda: app.parallel_marching_cubes(vol, step_size))
+
+    print(f"{name:<28} {str(vol.shape):<18} step={step_size} "
+          f"single={t_single:7.2f}s  parallel={t_par:7.2f}s  x{t_single / t_par:4.1f}  "
+          f"faces={len(pf):>9}  same={same_mesh(sv, sf, pv, pf)}  "
+          f"watertight={is_watertight(pf)}")
+
+
+def main(paths):
+    print(f"workers={app.MESH_WORKERS}")
+    for n in (128, 256, 384):
+        bench(f"sphere {n}^3", sphere_mask(n))
+    bench("sphere 384^3", sphere_mask(384), step_size=2)
+
+    lobes = lobe_mask()
+    bench("lobes: both lungs", (lobes > 0).astype(np.uint8))
+    bench("lobes: right lower lobe", (lobes == 5).astype(np.uint8))
+    bench("lobes: right lower lobe", (lobes == 5).astype(np.uint8), step_size=2)
+
+    for path in paths:
+        seg = app.load_seg_volume(path).read()
+        bench(path[-28:], seg)
+        bench(path[-28:], seg, step_size=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
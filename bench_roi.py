@@ -0,0 +1,151 @@
+# Benchmark: thorax ROI cropping before lung segmentation (app1.py)
+#
+#   python bench_roi.py                       # synthetic phantoms only
+#   python bench_roi.py ct1.nii.gz ct2.nrrd   # plus real scans
+#   python bench_roi.py --infer ct.nii.gz     # also time TotalSegmentator, full vs ROI
+#
+# For every scan the script times the lung/air detector, reports how
+# many voxels the crop keeps, and estimates the inference saving as the
+# number of nnU-Net sliding-window patches at 1.5 mm (128^3 patches,
+# 50% overlap), which is what the full-resolution run's time scales with.
+# With --infer the real runs are timed too, and the pasted-back masks
+# are compared with the full-scan masks.
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+import app1
+
+MODEL_SPACING = 1.5
+PATCH = 128
+
+
+def phantom(shape, spacing, lung_z, gas_pockets=0, seed=0):
+    """
+    CT-like volume (HU): outside air, an elliptic body with a table under
+    it, two lungs joined by a trachea inside lung_z (fractions of the
+    height), and optional bowel gas pockets below them.
+    """
+    rng = np.random.default_rng(seed)
+    d, h, w = shape
+    sz, sy, sx = spacing
+    z = (np.arange(d) * sz)[:, None, None]
+    y = ((np.arange(h) - h / 2) * sy)[None, :, None]
+    x = ((np.arange(w) - w / 2) * sx)[None, None, :]
+
+    vol = np.full(shape, -1000, dtype=np.int16)
+    body = (x / 170.0) ** 2 + (y / 120.0) ** 2 < 1.0
+    vol[np.broadcast_to(body, shape)] = 40
+    vol[:, int(h / 2 + 130 / sy):int(h / 2 + 145 / sy), :] = 300           # table
+
+    z0, z1 = lung_z[0] * d * sz, lung_z[1] * d * sz
+    zc, zr = (z0 + z1) / 2, (z1 - z0) / 2
+    for side in (-1, 1):
+        lung = (((x - side * 75) / 60.0) ** 2 + ((y + 10) / 80.0) ** 2 + ((z - zc) / zr) ** 2) < 1.0
+        vol[lung] = -850
+    trachea = (x ** 2 + (y + 30) ** 2 < 9 ** 2) & (z > zc)
+    vol[np.broadcast_to(trachea, shape)] = -950
+
+    for _ in range(gas_pockets):
+        cz = rng.uniform(0.05, max(0.06, lung_z[0] - 0.05)) * d * sz
+        cy, cx = rng.uniform(-60, 60), rng.uniform(-100, 100)
+        r = rng.uniform(12, 22)
+        vol[((x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2) < r * r] = -900
+
+    vol += rng.normal(0, 15, shape).astype(np.int16)
+    img = sitk.GetImageFromArray(vol)
+    img.SetSpacing(spacing[::-1])
+    return img
+
+
+def patches(img):
+    """Sliding-window patches nnU-Net needs for img at MODEL_SPACING."""
+    total = 1
+    for n, s in zip(img.GetSize(), img.GetSpacing()):
+        m = int(round(n * s / MODEL_SPACING))
+        total *= 1 if m <= PATCH else int(np.ceil((m - PATCH) / (PATCH / 2))) + 1
+    return total
+
+
+def crop(img, box):
+    (z0, y0, x0), (z1, y1, x1) = box
+    return img[x0:x1, y0:y1, z0:z1]
+
+
+def infer(path, out_dir):
+    from totalsegmentator.python_api import totalsegmentator
+
+    t0 = time.perf_counter()
+    totalsegmentator(input=path, output=out_dir, **app1.SEG_PARAMS, force_split=True,
+                     preview=False, device="gpu" if app1.GPU_SLOTS else "cpu", quiet=True)
+    return time.perf_counter() - t0
+
+
+def bench(name, img, run_inference=False):
+    t0 = time.perf_counter()
+    box = app1.detect_thorax(img)
+    t_detect = time.perf_counter() - t0
+
+    full_vox = int(np.prod(img.GetSize()))
+    if box is None:
+        print(f"{name:<30} {str(img.GetSize()):<18} detect={t_detect:6.2f}s  no lungs found, no crop")
+        return
+    roi = crop(img, box)
+    roi_vox = int(np.prod(roi.GetSize()))
+    print(f"{name:<30} {str(img.GetSize()):<18} detect={t_detect:6.2f}s  "
+          f"roi={str(roi.GetSize()):<18} voxels={roi_vox / full_vox:6.1%}  "
+          f"patches={patches(img):>4} -> {patches(roi):>4}")
+
+    if not run_inference:
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        full_nii = os.path.join(tmp, "full.nii.gz")
+        roi_nii = os.path.join(tmp, "roi.nii.gz")
+        sitk.WriteImage(img, full_nii)
+        sitk.WriteImage(roi, roi_nii)
+        os.makedirs(os.path.join(tmp, "full"))
+        os.makedirs(os.path.join(tmp, "roi"))
+        t_full = infer(full_nii, os.path.join(tmp, "full"))
+        t_roi = infer(roi_nii, os.path.join(tmp, "roi"))
+        pasted = app1.export_lung_masks(app1.load_lung_masks(os.path.join(tmp, "roi")), {
+            "box": box, "size": list(img.GetSize()), "spacing": list(img.GetSpacing()),
+            "origin": list(img.GetOrigin()), "direction": list(img.GetDirection()),
+        }, os.path.join(tmp, "pasted"), app1.EXPORT_DEFAULTS)
+        full = app1.load_lung_masks(os.path.join(tmp, "full"))
+        dice = []
+        for path in pasted:
+            name = os.path.basename(path)[:-len(".nrrd")]
+            if name not in full:
+                continue
+            a = sitk.GetArrayFromImage(full[name]) > 0
+            b = sitk.GetArrayFromImage(sitk.ReadImage(path)) > 0
+            dice.append(2 * (a & b).sum() / max(1, a.sum() + b.sum()))
+        print(f"{'':<30} inference full={t_full:7.1f}s  roi={t_roi:7.1f}s  x{t_full / t_roi:4.1f}  "
+              f"min dice={min(dice) if dice else float('nan'):.4f}")
+
+
+def main(args):
+    run_inference = "--infer" in args
+    paths = [a for a in args if a != "--infer"]
+
+    bench("phantom chest", phantom((240, 512, 512), (1.25, 0.7, 0.7), (0.15, 0.95)))
+    bench("phantom chest-abdomen", phantom((400, 512, 512), (1.5, 0.75, 0.75), (0.55, 0.95),
+                                           gas_pockets=6))
+    bench("phantom abdomen-pelvis", phantom((320, 512, 512), (1.5, 0.75, 0.75), (0.9, 1.2),
+                                            gas_pockets=8))
+
+    for path in paths:
+        if os.path.isdir(path) or path.lower().endswith(".zip"):
+            img = app1.dicom_ingest.load_series(path).to_sitk()
+        else:
+            img = sitk.ReadImage(path)
+        bench(path[-30:], img, run_inference)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
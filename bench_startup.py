@@ -0,0 +1,128 @@
+# Benchmark: startup cost of the viewer (app.py) and the segmentation
+# service (app1.py)
+#
+#   python bench_startup.py                   # 5 cold starts of each service
+#   python bench_startup.py --runs=10
+#   python bench_startup.py --max-import=1.0 --max-first-response=2.0
+#
+# Every run is a fresh interpreter that imports the service, reports the
+# import time and which heavy modules the import pulled in, and then
+# serves on a free local port. The first response is timed from process
+# start until GET /list-items (app.py) or GET /api/totalseg_workers
+# (app1.py) answers 200. The script prints median and worst times and
+# the slowest direct imports of each service. It exits with 1 when a
+# limit is exceeded or a heavy module is imported at startup, so it can
+# be run as a regression check.
+
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+# must only load on first use (inference workers import torch & co.)
+HEAVY = ("torch", "totalsegmentator", "nnunetv2", "dicom2nifti", "scipy.ndimage",
+         "skimage", "pydicom", "nibabel", "fast_simplification")
+SERVICES = {
+    # module: (first request, modules that must stay unloaded)
+    "app": ("/list-items?limit=1", HEAVY + ("SimpleITK",)),
+    "app1": ("/api/totalseg_workers", HEAVY),
+}
+# no inference worker processes: this measures the service itself
+ENV = {"TOTALSEG_GPU_SLOTS": "0", "TOTALSEG_CPU_SLOTS": "0"}
+START_TIMEOUT = 60.0
+
+RUNNER = """
+import sys, time
+t0 = time.perf_counter()
+import {module} as service
+seconds = time.perf_counter() - t0
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print("import", seconds, ",".join(heavy) or "-", flush=True)
+service.app.run(host="127.0.0.1", port={port}, threaded=True, use_reloader=False)
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_once(module, path, heavy):
+    """(import seconds, first response seconds, heavy modules imported)."""
+    port = free_port()
+    code = RUNNER.format(module=module, heavy=heavy, port=port)
+    here = os.path.dirname(os.path.abspath(__file__))
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", code], cwd=here, env=dict(os.environ, **ENV),
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"{module} exited with code {proc.returncode}")
+            if time.perf_counter() - t0 > START_TIMEOUT:
+                raise RuntimeError(f"{module} did not answer within {START_TIMEOUT:.0f}s")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=5) as res:
+                    if res.status == 200:
+                        break
+            except OSError:
+                time.sleep(0.01)
+        first_response = time.perf_counter() - t0
+        _, seconds, loaded = proc.stdout.readline().split()
+    finally:
+        proc.kill()
+        proc.wait()
+    return float(seconds), first_response, [] if loaded == "-" else loaded.split(",")
+
+
+def import_profile(module, top=6):
+    """Slowest direct imports of module (cumulative seconds), from -X importtime."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                         env=dict(os.environ, **ENV), capture_output=True, text=True).stderr
+    direct = []
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # "  name": two spaces of indent = imported by the module itself
+        if name.startswith("   ") and not name.startswith("    ") and cumulative.strip().isdigit():
+            direct.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(direct, reverse=True)[:top]
+
+
+def main(args):
+    options = dict(a.lstrip("-").split("=", 1) for a in args if "=" in a)
+    runs = int(options.get("runs", 5))
+    max_import = float(options["max-import"]) if "max-import" in options else None
+    max_first = float(options["max-first-response"]) if "max-first-response" in options else None
+
+    failed = False
+    for module, (path, heavy) in SERVICES.items():
+        results = [start_once(module, path, heavy) for _ in range(runs)]
+        imports = [r[0] for r in results]
+        firsts = [r[1] for r in results]
+        loaded = sorted({m for r in results for m in r[2]})
+        print(f"{module + '.py':<9} import median={statistics.median(imports):6.3f}s max={max(imports):6.3f}s  "
+              f"first response median={statistics.median(firsts):6.3f}s max={max(firsts):6.3f}s  "
+              f"GET {path}")
+        print(f"{'':<9} heavy modules at startup: {', '.join(loaded) or 'none'}")
+        print(f"{'':<9} slowest imports: "
+              + ", ".join(f"{name} {seconds:.3f}s" for seconds, name in import_profile(module)))
+        if loaded:
+            failed = True
+        if max_import is not None and max(imports) > max_import:
+            print(f"{'':<9} import exceeds {max_import:.3f}s")
+            failed = True
+        if max_first is not None and max(firsts) > max_first:
+            print(f"{'':<9} first response exceeds {max_first:.3f}s")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,82 @@
+// Resumable chunked uploads against the /uploads routes of app.py and
+// app1.py (see upload_store.py).
+//
+// The session id is remembered in localStorage per file (name, size,
+// lastModified), so retrying after a dropped connection or a page
+// reload continues from the server's offset instead of starting over.
+
+import axios from 'axios'
+
+const MAX_RETRIES = 5
+
+function sessionKey(base, file, path) {
+  return `upload:${base}:${path}:${file.size}:${file.lastModified}`
+}
+
+async function resumeOffset(base, uploadId) {
+  try {
+    const res = await axios.get(`${base}/uploads/${uploadId}`)
+    return res.data.offset
+  } catch (err) {
+    return null // expired or finished: start a new session
+  }
+}
+
+function sleep(ms) {
+  return new Promise((resolve) => setTimeout(resolve, ms))
+}
+
+/**
+ * Upload one File in chunks. `path` is the destination relative to the
+ * upload folder (defaults to the file name; folder uploads pass
+ * webkitRelativePath). onProgress(sentBytes, totalBytes) is optional.
+ * Resolves with the server's completion response ({ sha256, path?, ... }).
+ */
+export async function uploadFile(base, file, { path, onProgress } = {}) {
+  const dest = path || file.name
+  const key = sessionKey(base, file, dest)
+
+  let uploadId = localStorage.getItem(key)
+  let offset = uploadId ? await resumeOffset(base, uploadId) : null
+  let chunkSize = 8 * 1024 * 1024
+
+  if (offset === null) {
+    const res = await axios.post(`${base}/uploads`, {
+      filename: file.name,
+      size: file.size,
+      path: dest
+    })
+    if (res.data.complete) return res.data
+    uploadId = res.data.upload_id
+    offset = res.data.offset
+    chunkSize = res.data.chunk_size || chunkSize
+    localStorage.setItem(key, uploadId)
+  }
+
+  let failures = 0
+  while (offset < file.size) {
+    const chunk = file.slice(offset, Math.min(offset + chunkSize, file.size))
+    try {
+      const res = await axios.put(`${base}/uploads/${uploadId}?offset=${offset}`, chunk, {
+        headers: { 'Content-Type': 'application/octet-stream' }
+      })
+      offset = res.data.offset
+      failures = 0
+      onProgress && onProgress(offset, file.size)
+    } catch (err) {
+      if (err.response && err.response.status === 409) {
+        offset = err.response.data.offset // server has more/less than we thought
+        continue
+      }
+      if (++failures > MAX_RETRIES) throw err
+      await sleep(500 * 2 ** failures)
+      const serverOffset = await resumeOffset(base, uploadId)
+      if (serverOffset === null) throw err
+      offset = serverOffset
+    }
+  }
+
+  const res = await axios.post(`${base}/uploads/${uploadId}/complete`)
+  localStorage.removeItem(key)
+  return res.data
+}
@@ -0,0 +1,342 @@
+# DICOM ingestion shared by the viewer (app.py) and the segmentation
+# service (app1.py).
+#
+# A series is read from a folder or straight from a ZIP (no extraction).
+# Headers are parsed once into "<path>.dcmindex.json" next to the source,
+# keyed by each file's size and mtime (CRC for ZIP members), so reopening
+# a study, or a folder that gained a few files, only parses what changed.
+# Pixel data is decoded across a thread pool into one preallocated
+# (D, H, W) array, int16 whenever the stored values fit. pydicom and
+# SimpleITK are imported on first use, so importing this module is cheap
+# and an indexed study can be summarised without them.
+
+import io
+import json
+import os
+import threading
+import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+INDEX_SUFFIX = ".dcmindex.json"
+INDEX_VERSION = 2
+DECODE_WORKERS = int(os.environ.get("DICOM_DECODE_WORKERS", min(8, os.cpu_count() or 1)))
+
+
+# ------------------------------------------------------
+#  SOURCES
+# ------------------------------------------------------
+class DicomSource:
+    """Files directly inside a folder, or every member of a ZIP archive."""
+
+    def __init__(self, path):
+        self.path = path
+        self.is_zip = os.path.isfile(path) and zipfile.is_zipfile(path)
+        if not self.is_zip and not os.path.isdir(path):
+            raise ValueError(f"Not a DICOM folder or ZIP: {path}")
+        self._local = threading.local()     # one ZipFile handle per thread
+        self._zips = []
+        self._zips_lock = threading.Lock()
+
+    def _zip(self):
+        zf = getattr(self._local, "zip", None)
+        if zf is None:
+            zf = self._local.zip = zipfile.ZipFile(self.path)
+            with self._zips_lock:
+                self._zips.append(zf)
+        return zf
+
+    def close(self):
+        """Close the ZIP handles of all threads; later reads reopen them."""
+        with self._zips_lock:
+            zips, self._zips = self._zips, []
+            self._local = threading.local()
+        for zf in zips:
+            zf.close()
+
+    def members(self):
+        """name -> stamp that changes whenever the member's content may have."""
+        if self.is_zip:
+            return {
+                info.filename: [info.file_size, info.CRC]
+                for info in self._zip().infolist() if not info.is_dir()
+            }
+        stamps = {}
+        for name in sorted(os.listdir(self.path)):
+            full = os.path.join(self.path, name)
+            if name.endswith(INDEX_SUFFIX) or not os.path.isfile(full):
+                continue
+            st = os.stat(full)
+            stamps[name] = [st.st_size, st.st_mtime_ns]
+        return stamps
+
+    def open(self, name):
+        if self.is_zip:
+            return self._zip().open(name)
+        return open(os.path.join(self.path, name), "rb")
+
+    def read(self, name):
+        with self.open(name) as fh:
+            return fh.read()
+
+    def local_path(self, name):
+        """Filesystem path of a member, or None inside a ZIP."""
+        return None if self.is_zip else os.path.join(self.path, name)
+
+
+# ------------------------------------------------------
+#  HEADER INDEX
+# ------------------------------------------------------
+def _floats(value, n):
+    try:
+        out = [float(v) for v in value]
+    except (TypeError, ValueError):
+        return None
+    return out if len(out) == n else None
+
+
+def read_header(fp):
+    """Fields needed to sort and decode one image, or None for non-images."""
+    import pydicom
+
+    try:
+        ds = pydicom.dcmread(fp, stop_before_pixels=True, force=True)
+    except Exception:
+        return None
+    if "Rows" not in ds or "Columns" not in ds or "SeriesInstanceUID" not in ds:
+        return None
+    return {
+        "series": str(ds.SeriesInstanceUID),
+        "modality": str(getattr(ds, "Modality", "") or ""),
+        "instance": int(getattr(ds, "InstanceNumber", 0) or 0),
+        "position": _floats(getattr(ds, "ImagePositionPatient", None), 3),
+        "orientation": _floats(getattr(ds, "ImageOrientationPatient", None), 6),
+        "pixel_spacing": _floats(getattr(ds, "PixelSpacing", None), 2) or [1.0, 1.0],
+        "thickness": float(getattr(ds, "SliceThickness", 0) or 0),
+        "slope": float(getattr(ds, "RescaleSlope", 1) or 1),
+        "intercept": float(getattr(ds, "RescaleIntercept", 0) or 0),
+        "rows": int(ds.Rows),
+        "cols": int(ds.Columns),
+        "bits_stored": int(getattr(ds, "BitsStored", 16) or 16),
+        "signed": int(getattr(ds, "PixelRepresentation", 0) or 0) == 1,
+        "frames": int(getattr(ds, "NumberOfFrames", 1) or 1),
+    }
+
+
+def index_path(path):
+    return os.path.realpath(path).rstrip(os.sep) + INDEX_SUFFIX
+
+
+def _load_index(path):
+    try:
+        with open(index_path(path)) as fh:
+            index = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    return index.get("entries", {}) if index.get("version") == INDEX_VERSION else {}
+
+
+def _save_index(path, entries):
+    target = index_path(path)
+    tmp = f"{target}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        with open(tmp, "w") as fh:
+            json.dump({"version": INDEX_VERSION, "entries": entries}, fh)
+        os.replace(tmp, target)
+    except OSError:
+        pass    # read-only location: the next open scans again
+
+
+def scan(source, workers=None):
+    """
+    Header of every member (None for non-DICOM files), reusing the
+    persistent index for members whose stamp is unchanged.
+    """
+    old = _load_index(source.path)
+    try:
+        stamps = source.members()
+        entries = {name: old[name] for name, stamp in stamps.items()
+                   if name in old and old[name]["stamp"] == stamp}
+        todo = [name for name in stamps if name not in entries]
+
+        def parse(name):
+            with source.open(name) as fh:
+                return name, read_header(fh)
+
+        if todo:
+            with ThreadPoolExecutor(max_workers=workers or DECODE_WORKERS) as pool:
+                for name, header in pool.map(parse, todo):
+                    entries[name] = {"stamp": stamps[name], "header": header}
+    finally:
+        source.close()
+    if todo or len(entries) != len(old):
+        _save_index(source.path, entries)
+    return {name: entry["header"] for name, entry in entries.items()}
+
+
+# ------------------------------------------------------
+#  SERIES
+# ------------------------------------------------------
+def indexed_summary(path):
+    """
+    (modality, (D, H, W)) of the main series from an existing index
+    only, without touching the DICOM files; None if not indexed yet.
+    """
+    headers = {n: e["header"] for n, e in _load_index(path).items()}
+    try:
+        images = select_series(headers)
+    except ValueError:
+        return None
+    first = images[0][1]
+    return first.get("modality") or None, (len(images), first["rows"], first["cols"])
+
+
+def _normal(orientation):
+    row, col = np.asarray(orientation[:3]), np.asarray(orientation[3:])
+    return np.cross(row, col)
+
+
+def select_series(headers, series_uid=None):
+    """
+    (name, header) slices of one series in stacking order: the requested
+    series, or the one with the most single-frame images.
+    """
+    images = [(n, h) for n, h in headers.items() if h is not None and h["frames"] == 1]
+    if not images:
+        raise ValueError("No DICOM images found.")
+    if series_uid is None:
+        series_uid = Counter(h["series"] for _, h in images).most_common(1)[0][0]
+    images = [(n, h) for n, h in images if h["series"] == series_uid]
+    if not images:
+        raise ValueError(f"Series not found: {series_uid}")
+
+    # localizers etc. with a different matrix are not part of the stack
+    size = Counter((h["rows"], h["cols"]) for _, h in images).most_common(1)[0][0]
+    images = [(n, h) for n, h in images if (h["rows"], h["cols"]) == size]
+
+    first = images[0][1]
+    if first["orientation"] and all(h["position"] for _, h in images):
+        normal = _normal(first["orientation"])
+        images.sort(key=lambda item: float(np.dot(normal, item[1]["position"])))
+    else:
+        images.sort(key=lambda item: (item[1]["instance"], item[0]))
+    return images
+
+
+class DicomSeries:
+    """
+    A decoded series: stored pixel values (D, H, W) plus the rescale that
+    turns them into HU, and the geometry needed to write NIfTI/NRRD.
+    """
+
+    def __init__(self, pixels, spacing, slope, intercept, origin, direction, series_uid,
+                 modality=None):
+        self.pixels = pixels
+        self.spacing = spacing          # (z, y, x) mm
+        self.slope = slope
+        self.intercept = intercept
+        self.origin = origin            # patient (x, y, z) of the first voxel
+        self.direction = direction      # 3x3, columns = x, y, z axis directions
+        self.series_uid = series_uid
+        self.modality = modality        # DICOM Modality, e.g. "CT"
+
+    def rescaled(self):
+        if self.slope == 1 and self.intercept == 0:
+            return self.pixels
+        values = self.pixels * np.float32(self.slope) + np.float32(self.intercept)
+        if float(self.slope).is_integer() and float(self.intercept).is_integer():
+            info = np.iinfo(np.int16)
+            if values.min() >= info.min and values.max() <= info.max:
+                return values.astype(np.int16)
+        return values
+
+    def to_sitk(self):
+        import SimpleITK as sitk
+
+        img = sitk.GetImageFromArray(self.rescaled())
+        img.SetSpacing(tuple(float(s) for s in reversed(self.spacing)))
+        img.SetOrigin(tuple(float(v) for v in self.origin))
+        img.SetDirection(tuple(float(v) for v in np.asarray(self.direction).ravel()))
+        return img
+
+
+def _slice_spacing(images):
+    first = images[0][1]
+    if len(images) > 1 and first["orientation"] and all(h["position"] for _, h in images):
+        normal = _normal(first["orientation"])
+        along = np.array([np.dot(normal, h["position"]) for _, h in images])
+        steps = np.diff(along)
+        if steps.size and np.median(steps) > 0:
+            return float(np.median(steps))
+    return first["thickness"] or 1.0
+
+
+def _pixel_dtype(images):
+    """int16 if every stored value fits, float32 (rescaled per slice) otherwise."""
+    same_rescale = len({(h["slope"], h["intercept"]) for _, h in images}) == 1
+    fits = all(h["signed"] and h["bits_stored"] <= 16 or not h["signed"] and h["bits_stored"] <= 15
+               for _, h in images)
+    return np.dtype(np.int16) if same_rescale and fits else np.dtype(np.float32)
+
+
+def _decode(source, name):
+    import pydicom
+
+    data = source.read(name)
+    try:
+        return pydicom.dcmread(io.BytesIO(data), force=True).pixel_array
+    except Exception:
+        # compressed transfer syntax without a pydicom handler: GDCM can
+        local = source.local_path(name)
+        if local is None:
+            raise
+        import SimpleITK as sitk
+
+        return sitk.GetArrayFromImage(sitk.ReadImage(local))[0]
+
+
+def load_series(path, series_uid=None, workers=None):
+    """
+    Decode one series of a DICOM folder or ZIP into a DicomSeries,
+    slices in parallel into a preallocated array.
+    """
+    source = DicomSource(path)
+    try:
+        images = select_series(scan(source, workers), series_uid)
+        first = images[0][1]
+
+        dtype = _pixel_dtype(images)
+        pixels = np.empty((len(images), first["rows"], first["cols"]), dtype=dtype)
+
+        def decode(i):
+            name, header = images[i]
+            arr = _decode(source, name)
+            if dtype == np.float32:
+                arr = arr * np.float32(header["slope"]) + np.float32(header["intercept"])
+            pixels[i] = arr
+
+        with ThreadPoolExecutor(max_workers=workers or DECODE_WORKERS) as pool:
+            list(pool.map(decode, range(len(images))))
+    finally:
+        source.close()
+
+    if dtype == np.float32:
+        slope, intercept = 1.0, 0.0
+    else:
+        slope, intercept = first["slope"], first["intercept"]
+
+    row_spacing, col_spacing = first["pixel_spacing"]
+    orientation = first["orientation"] or [1, 0, 0, 0, 1, 0]
+    direction = np.stack([orientation[:3], orientation[3:], _normal(orientation)], axis=1)
+    return DicomSeries(
+        pixels,
+        (_slice_spacing(images), row_spacing, col_spacing),
+        slope,
+        intercept,
+        first["position"] or [0.0, 0.0, 0.0],
+        direction,
+        first["series"],
+        first.get("modality") or None,
+    )
@@ -0,0 +1,311 @@
+# Long-lived TotalSegmentator process for one scheduler slot of the
+# segmentation service (app1.py).
+#
+# Importing torch / nnU-Net, creating the CUDA context and loading the
+# model weights used to happen again for every case. A worker process
+# does it once and then takes cases from a queue one after another,
+# keeping the loaded predictors for the next case. It retires itself
+# after TOTALSEG_WORKER_MAX_CASES cases, when its resident memory passes
+# TOTALSEG_WORKER_MAX_RSS_MB, or after a failed case, and the slot
+# starts a fresh (cold) one.
+#
+# Workers are forked from a forkserver process that imported the main
+# module and TOTALSEG_WORKER_PRELOAD (torch) once, so a fresh worker does
+# not import them again. The forkserver never initialises CUDA, so each
+# worker still creates its own CUDA context. Native thread pools (OpenMP,
+# OpenBLAS, MKL) size themselves when those modules are imported, which
+# happens in the forkserver, so their limits go into the environment
+# before the forkserver starts (see limit_native_threads).
+
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+MAX_CASES = int(os.environ.get("TOTALSEG_WORKER_MAX_CASES", 50))
+MAX_RSS_MB = float(os.environ.get("TOTALSEG_WORKER_MAX_RSS_MB", 16384))
+POLL_SECONDS = 1.0
+STOP_SECONDS = 10.0
+PRELOAD = [m for m in os.environ.get("TOTALSEG_WORKER_PRELOAD", "torch").split(",") if m]
+THREAD_ENV = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+# not fork: the parent runs Flask threads and CUDA must start clean
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _CONTEXT = multiprocessing.get_context("forkserver")
+    # modules that fail to import are skipped by the forkserver
+    _CONTEXT.set_forkserver_preload(["__main__", __name__, *PRELOAD])
+else:
+    _CONTEXT = multiprocessing.get_context("spawn")
+
+
+_thread_limit_lock = threading.Lock()
+_thread_limit = None
+
+
+def limit_native_threads(threads):
+    """
+    Put the per-slot thread count into the environment the forkserver (or
+    a spawned worker) starts with. The forkserver starts once and keeps
+    the first count; every slot uses the same one (TOTALSEG_TORCH_THREADS).
+    The service process itself has loaded numpy already, so its own pools
+    are not affected.
+    """
+    global _thread_limit
+    with _thread_limit_lock:
+        if _thread_limit is None:
+            for name in THREAD_ENV:
+                os.environ[name] = str(threads)
+            _thread_limit = threads
+
+
+class WorkerLost(RuntimeError):
+    """The worker process exited without finishing the case (killed or crashed)."""
+
+
+def params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def peak_rss_mb(pid="self"):
+    """
+    Peak resident memory (VmHWM, MB) of a process since it started or
+    since reset_peak_rss(); None where /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Start measuring this process's peak RSS afresh (Linux >= 4.0)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+
+# ------------------------------------------------------
+#  CHILD PROCESS
+# ------------------------------------------------------
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _keep_predictors_resident():
+    """
+    TotalSegmentator builds a new nnUNetPredictor per call, which reads
+    the checkpoint from disk and rebuilds the network. Remember what
+    initialize_from_trained_model_folder produced per (model folder,
+    folds, checkpoint) and hand the same network and weights to later
+    predictors. Without a matching nnU-Net this does nothing and every
+    case loads the model as before.
+    """
+    try:
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    except ImportError:
+        return False
+    original = getattr(nnUNetPredictor, "initialize_from_trained_model_folder", None)
+    if original is None or not hasattr(nnUNetPredictor, "manual_initialization"):
+        return False
+    loaded = {}
+
+    def initialize(self, model_training_output_dir, use_folds, checkpoint_name="checkpoint_final.pth"):
+        key = (model_training_output_dir, tuple(use_folds or ()), checkpoint_name)
+        if key not in loaded:
+            captured = {}
+            manual = self.manual_initialization
+
+            def capture(*args, **kwargs):
+                captured["args"] = (args, kwargs)
+                return manual(*args, **kwargs)
+
+            self.manual_initialization = capture
+            try:
+                original(self, model_training_output_dir, use_folds, checkpoint_name)
+            finally:
+                del self.manual_initialization
+            if "args" not in captured:
+                return None
+            loaded[key] = captured["args"]
+        args, kwargs = loaded[key]
+        self.manual_initialization(*args, **kwargs)
+
+    nnUNetPredictor.initialize_from_trained_model_folder = initialize
+    return True
+
+
+def _serve(device, threads, requests, responses):
+    # OpenMP/BLAS pools were sized from THREAD_ENV when the forkserver
+    # imported them; torch's intra-op pool can still be set here
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        torch = None
+    from totalsegmentator.python_api import totalsegmentator
+
+    responses.put({"type": "ready", "pid": os.getpid(), "resident": _keep_predictors_resident()})
+
+    served = 0
+    while True:
+        task = requests.get()
+        if task is None:
+            return
+        start = time.perf_counter()
+        error = None
+        reset_peak_rss()        # so the peak reported is this case's
+        try:
+            totalsegmentator(
+                input=task["input"],
+                output=task["output"],
+                **task["params"],
+                force_split=True,               # process in parts, safer for VRAM/RAM
+                preview=False,
+                device=device,
+                nr_thr_resamp=1,
+                nr_thr_saving=min(6, threads),
+                verbose=True,
+            )
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        if torch is not None and device == "gpu" and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        served += 1
+        rss = _rss_mb()
+        # after a failure (e.g. CUDA OOM) the process state is suspect
+        recycle = error is not None or served >= MAX_CASES or rss > MAX_RSS_MB
+        responses.put({
+            "type": "done",
+            "case_id": task["case_id"],
+            "error": error,
+            "seconds": time.perf_counter() - start,
+            "rss_mb": rss,
+            "peak_rss_mb": peak_rss_mb(),
+            "recycle": recycle,
+        })
+        if recycle:
+            return
+
+
+# ------------------------------------------------------
+#  PARENT SIDE
+# ------------------------------------------------------
+class InferenceWorker:
+    """
+    Handle on the worker process of one slot. Not thread-safe: each slot
+    thread owns its worker and runs one case at a time through it.
+    """
+
+    def __init__(self, device, threads):
+        self.device = device
+        self.threads = threads
+        self.process = None
+        self.cases = 0              # served by the current process
+        self.generation = 0         # processes started so far
+        self.loaded = set()         # params_key of models already used
+        self.rss_mb = None
+        self.last_peak_rss_mb = None    # of the last finished case
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def is_warm(self, params):
+        return self.alive and params_key(params) in self.loaded
+
+    def start(self):
+        """Start the process (imports run in the background) if it is not running."""
+        if self.alive:
+            return
+        limit_native_threads(self.threads)
+        self._requests = _CONTEXT.Queue()
+        self._responses = _CONTEXT.Queue()
+        self.process = _CONTEXT.Process(
+            target=_serve,
+            args=(self.device, self.threads, self._requests, self._responses),
+            name=f"totalseg-worker-{self.device}",
+            daemon=True,
+        )
+        self.process.start()
+        self.cases = 0
+        self.generation += 1
+        self.loaded = set()
+
+    def run(self, case_id, input_path, output_dir, params):
+        """
+        Segment one case; returns the worker's report. Raises
+        RuntimeError for a failed case and WorkerLost if the process died.
+        """
+        self.start()
+        self._requests.put({
+            "case_id": case_id, "input": input_path, "output": output_dir, "params": params,
+        })
+        while True:
+            try:
+                msg = self._responses.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    code = self.process.exitcode
+                    self.process = None
+                    raise WorkerLost(f"Inference worker exited (code {code})")
+                continue
+            if msg["type"] != "done":
+                continue
+            self.cases += 1
+            self.rss_mb = msg["rss_mb"]
+            self.last_peak_rss_mb = msg["peak_rss_mb"]
+            if msg["recycle"]:
+                self.process.join(STOP_SECONDS)
+                self.process = None
+            if msg["error"] is not None:
+                raise RuntimeError(msg["error"])
+            self.loaded.add(params_key(params))
+            return msg
+
+    def peak_rss_mb(self):
+        """Peak RSS (MB) of the case running now, else of the last case."""
+        if self.alive:
+            peak = peak_rss_mb(self.process.pid)
+            if peak is not None:
+                return peak
+        return self.last_peak_rss_mb
+
+    def kill(self):
+        """Stop the process at once, e.g. to cancel the case it is running."""
+        if self.process is not None:
+            self.process.kill()
+
+    def stop(self):
+        if not self.alive:
+            return
+        self._requests.put(None)
+        self.process.join(STOP_SECONDS)
+        if self.process.is_alive():
+            self.process.kill()
+        self.process = None
+
+    def describe(self):
+        return {
+            "device": self.device,
+            "state": "warm" if self.alive and self.loaded else "cold",
+            "alive": self.alive,
+            "pid": self.process.pid if self.alive else None,
+            "cases": self.cases,
+            "generation": self.generation,
+            "rss_mb": self.rss_mb,
+        }
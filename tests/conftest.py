@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules live next to this folder, not in an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,106 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from app import ByteLRUCache
+
+
+def block(nbytes):
+    return np.zeros(nbytes, np.uint8)
+
+
+def key(name):
+    return ("ct", f"/data/{name}", 0, 0)
+
+
+def test_evicts_least_recently_used_first():
+    cache = ByteLRUCache(300)
+    for name in "abc":
+        cache.get(key(name), lambda: block(100))
+    cache.get(key("a"), lambda: pytest.fail("a should still be cached"))
+
+    cache.get(key("d"), lambda: block(100))
+
+    assert key("b") not in cache
+    assert all(key(name) in cache for name in "acd")
+    assert cache.stats()["bytes"] == 300
+    assert cache.stats()["evictions"] == 1
+
+
+def test_value_larger_than_the_cache_is_served_uncached():
+    cache = ByteLRUCache(100)
+    cache.get(key("a"), lambda: block(50))
+
+    assert len(cache.get(key("big"), lambda: block(200))) == 200
+    assert key("big") not in cache
+    assert key("a") in cache
+
+
+def test_concurrent_gets_share_one_load():
+    cache = ByteLRUCache(1000)
+    calls = []
+    release = threading.Event()
+
+    def load():
+        calls.append(1)
+        release.wait(5)
+        return block(10)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(key("a"), load)))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    while cache.stats()["coalesced"] < 7:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    assert cache.stats()["misses"] == 1
+
+
+def test_failed_load_reaches_every_waiter_and_is_not_cached():
+    cache = ByteLRUCache(1000)
+    release = threading.Event()
+
+    def load():
+        release.wait(5)
+        raise OSError("unreadable")
+
+    errors = []
+
+    def get():
+        try:
+            cache.get(key("a"), load)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=get) for _ in range(4)]
+    for t in threads:
+        t.start()
+    while cache.stats()["coalesced"] < 3:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(errors) == 4
+    assert key("a") not in cache
+    assert len(cache.get(key("a"), lambda: block(10))) == 10
+
+
+def test_invalidate_drops_files_inside_a_folder():
+    cache = ByteLRUCache(1000)
+    cache.get(("ct", "/data/study", 0, 0), lambda: block(10))
+    cache.get(("seg", "/data/study/seg.nrrd", 0, 0), lambda: block(10))
+    cache.get(("ct", "/data/other.nrrd", 0, 0), lambda: block(10))
+
+    cache.invalidate("/data/study")
+
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] == 10
@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+
+from app1 import JobScheduler, JobStore
+from inference_worker import InferenceWorker
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite"))
+
+
+def queue(store, *jobs):
+    for case_id, priority, device in jobs:
+        store.create(case_id, state="queued", status="Queued", priority=priority, device=device)
+
+
+def test_claim_order_priority_then_fifo(store):
+    queue(store, ("a", 0, None), ("b", 5, None), ("c", 0, None), ("d", 5, None))
+
+    claimed = [store.claim("gpu")["case_id"] for _ in range(4)]
+
+    assert claimed == ["b", "d", "a", "c"]
+    assert store.claim("gpu") is None
+    assert all(store.get(c)["state"] == "running" for c in claimed)
+
+
+def test_gpu_slots_skip_cpu_only_jobs(store):
+    queue(store, ("cpu-job", 9, "cpu"), ("any", 0, None))
+
+    assert store.claim("gpu")["case_id"] == "any"
+    assert store.claim("gpu") is None
+
+
+def test_cpu_slots_take_cpu_jobs_first_and_others_only_when_allowed(store):
+    queue(store, ("any", 9, None), ("cpu-job", 0, "cpu"))
+
+    assert store.claim("cpu", any_job=False)["case_id"] == "cpu-job"
+    assert store.claim("cpu", any_job=False) is None
+    assert store.claim("cpu", any_job=True)["case_id"] == "any"
+
+
+def test_concurrent_claims_never_hand_out_a_job_twice(store):
+    queue(store, *((f"job{i}", 0, None) for i in range(20)))
+    claimed = []
+
+    def slot():
+        while (job := store.claim("cpu")) is not None:
+            claimed.append(job["case_id"])
+
+    threads = [threading.Thread(target=slot) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(claimed) == sorted(f"job{i}" for i in range(20))
+
+
+def test_cancel_queued_running_and_finished(store):
+    queue(store, ("queued", 0, None), ("running", 1, None), ("done", 0, None))
+    store.claim("gpu")
+    store.update("done", state="finished", status="Done")
+
+    assert store.cancel("queued")["state"] == "cancelled"
+    running = store.cancel("running")
+    assert running["state"] == "running"
+    assert running["cancel_requested"] == 1
+    assert store.cancel("done")["state"] == "finished"
+    assert store.cancel("missing") is None
+    assert store.claim("gpu") is None
+
+
+def test_scheduler_cancel_kills_the_running_worker(store):
+    scheduler = JobScheduler(store, 0, 0)
+    killed = []
+    worker = InferenceWorker("cpu", 1)
+    worker.kill = lambda: killed.append(True)
+    queue(store, ("a", 0, None), ("b", 0, None))
+    scheduler.running["a"] = worker
+    store.claim("cpu")
+
+    scheduler.cancel("b")
+    assert killed == []
+    scheduler.cancel("a")
+    assert killed == [True]
+
+
+def test_gpu_free_counts_busy_gpu_slots(store):
+    scheduler = JobScheduler(store, 1, 1)
+    gpu, cpu = scheduler.workers
+
+    assert scheduler.gpu_free()
+    scheduler.running["a"] = cpu
+    assert scheduler.gpu_free()
+    scheduler.running["b"] = gpu
+    assert not scheduler.gpu_free()
@@ -0,0 +1,65 @@
+import numpy as np
+from skimage import measure
+
+import app
+
+
+def ball(n, radius_frac=0.4):
+    z, y, x = np.ogrid[:n, :n, :n]
+    c = (n - 1) / 2.0
+    return ((z - c) ** 2 + (y - c) ** 2 + (x - c) ** 2 < (radius_frac * n) ** 2).astype(np.uint8)
+
+
+def triangles(verts, faces):
+    tri = np.round(verts[faces], 4).reshape(len(faces), -1)
+    return tri[np.lexsort(tri.T[::-1])]
+
+
+def is_watertight(faces):
+    edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+    _, counts = np.unique(edges, axis=0, return_counts=True)
+    return bool((counts == 2).all())
+
+
+def test_welded_slabs_match_a_single_marching_cubes_call():
+    for step_size in (1, 2):
+        vol, _ = app.mesh_input(ball(48), step_size)
+        verts, faces, _, _ = measure.marching_cubes(vol, level=0.5, step_size=step_size)
+
+        p_verts, p_faces = app.parallel_marching_cubes(vol, step_size, workers=4)
+
+        assert p_verts.shape == verts.shape
+        assert p_faces.shape == faces.shape
+        assert np.array_equal(triangles(p_verts, p_faces), triangles(verts, faces))
+        assert is_watertight(p_faces)
+
+
+def test_weld_seams_merges_only_shared_plane_vertices():
+    lower = (np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0]], np.float32), np.array([[0, 1, 2]]))
+    upper = (np.array([[1, 0, 0], [1, 1, 0], [2, 0, 0]], np.float32), np.array([[0, 1, 2]]))
+
+    verts, faces = app.weld_seams([lower, upper], seams=[1])
+
+    assert len(verts) == 4
+    assert faces.tolist() == [[0, 1, 2], [1, 2, 3]]
+
+
+def test_build_mesh_in_parallel_matches_serial(monkeypatch):
+    seg = np.zeros((40, 40, 40), np.uint8)
+    seg[4:20, 4:36, 4:36] = 1
+    seg[20:36, 4:36, 4:36] = 2
+    seg[10:30, 10:30, 10:20] = 3
+
+    monkeypatch.setattr(app, "MESH_WORKERS", 1)
+    s_verts, s_faces, s_groups = app.build_mesh(seg)
+    monkeypatch.setattr(app, "MESH_WORKERS", 4)
+    monkeypatch.setattr(app, "PARALLEL_MESH_MIN_VOXELS", 1000)
+    p_verts, p_faces, p_groups = app.build_mesh(seg)
+
+    assert np.array_equal(s_groups, p_groups)
+    assert len(p_verts) == len(s_verts)
+    for _, start, count in p_groups:
+        label_faces = slice(start, start + count)
+        assert np.array_equal(triangles(p_verts, p_faces[label_faces]),
+                              triangles(s_verts, s_faces[label_faces]))
+        assert is_watertight(p_faces[label_faces])
@@ -0,0 +1,77 @@
+import hashlib
+import io
+
+import pytest
+from flask import Flask
+
+import upload_store
+from upload_store import UploadConflict, UploadStore
+
+DATA = bytes(range(256)) * 64
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+def test_resume_after_restart_and_store_by_digest(tmp_path):
+    store = UploadStore(str(tmp_path))
+    upload_id = store.begin("scan.nii.gz", len(DATA), sha256=DIGEST.upper())["upload_id"]
+    store.append(upload_id, 0, io.BytesIO(DATA[:5000]))
+
+    # a new store has no hasher in memory: it rehashes the partial file
+    store = UploadStore(str(tmp_path))
+    assert store.session(upload_id)["offset"] == 5000
+    with pytest.raises(UploadConflict) as conflict:
+        store.append(upload_id, 4000, io.BytesIO(DATA[4000:]))
+    assert conflict.value.offset == 5000
+    store.append(upload_id, 5000, io.BytesIO(DATA[5000:]))
+
+    digest, path, meta = store.finish(upload_id)
+    assert digest == DIGEST
+    assert path.endswith(DIGEST + ".nii.gz")
+    assert open(path, "rb").read() == DATA
+    assert store.find(DIGEST) == path
+    assert store.session(upload_id) is None
+
+
+def test_digest_mismatch_discards_the_upload(tmp_path):
+    store = UploadStore(str(tmp_path))
+    upload_id = store.begin("scan.nii", len(DATA), sha256="0" * 64)["upload_id"]
+    store.append(upload_id, 0, io.BytesIO(DATA))
+
+    with pytest.raises(ValueError):
+        store.finish(upload_id)
+    assert store.session(upload_id) is None
+    assert store.find(DIGEST) is None
+
+
+def test_same_content_is_stored_once(tmp_path):
+    store = UploadStore(str(tmp_path))
+    first = store.put_stream(io.BytesIO(DATA), "a.nii")
+    upload_id = store.begin("b.nii", len(DATA))["upload_id"]
+    store.append(upload_id, 0, io.BytesIO(DATA))
+
+    assert store.finish(upload_id)[:2] == first
+
+
+def test_http_session_keeps_only_documented_fields(tmp_path):
+    completed = []
+    app = Flask(__name__)
+    app.register_blueprint(upload_store.upload_blueprint(
+        UploadStore(str(tmp_path)), lambda digest, path, meta: completed.append(meta)))
+    client = app.test_client()
+
+    created = client.post("/uploads", json={
+        "filename": "a.nii", "size": len(DATA), "sha256": DIGEST,
+        "path": "study/a.nii", "self": 1, "upload_id": "x", "offset": 7,
+    })
+    assert created.status_code == 200
+    upload_id = created.get_json()["upload_id"]
+    assert client.put(f"/uploads/{upload_id}?offset=0", data=DATA[:1000]).get_json() == {"offset": 1000}
+    assert client.put(f"/uploads/{upload_id}?offset=0", data=DATA[:1000]).status_code == 409
+    assert client.get(f"/uploads/{upload_id}").get_json()["offset"] == 1000
+    client.put(f"/uploads/{upload_id}?offset=1000", data=DATA[1000:])
+
+    done = client.post(f"/uploads/{upload_id}/complete").get_json()
+    assert done["sha256"] == DIGEST
+    assert completed[0]["path"] == "study/a.nii"
+    assert completed[0]["upload_id"] == upload_id
+    assert "self" not in completed[0]
@@ -0,0 +1,358 @@
+# Content-addressed upload storage shared by the viewer (app.py) and the
+# segmentation service (app1.py).
+#
+# Uploads arrive either in one multipart request or as a resumable
+# session of raw chunks (POST /uploads, PUT /uploads/<id>?offset=N,
+# POST /uploads/<id>/complete). Either way the bytes are hashed while
+# they are written, once, and the finished file is kept as
+# objects/<sha[:2]>/<sha256><ext>, so the same study uploaded twice is
+# stored once and is recognised by its digest.
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from flask import Blueprint, jsonify, request
+
+CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+UPLOAD_EXPIRE_SECONDS = float(os.environ.get("UPLOAD_EXPIRE_SECONDS", 24 * 3600))
+COPY_BUFFER = 1024 * 1024
+
+
+class UploadConflict(Exception):
+    """A chunk did not start where the stored upload ends."""
+
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+def file_extension(filename):
+    low = filename.lower()
+    if low.endswith(".nii.gz"):
+        return ".nii.gz"
+    return os.path.splitext(low)[1]
+
+
+def resolve_under(root, relpath):
+    """root/relpath, refusing absolute paths and '..' escapes."""
+    rel = os.path.normpath(relpath.replace("\\", "/")).lstrip("/")
+    if not rel or rel == "." or rel.startswith(".."):
+        raise ValueError(f"Invalid upload path: {relpath}")
+    return os.path.join(root, rel)
+
+
+def link_object(object_path, dest):
+    """
+    Make dest name the stored object: a hard link when both live on one
+    filesystem, a copy otherwise. An existing dest is replaced, never
+    written through, so the object itself is not modified.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        if os.path.samefile(object_path, dest):
+            return dest
+    except OSError:
+        pass
+    tmp = f"{dest}.tmp-{uuid.uuid4().hex[:8]}"
+    try:
+        os.link(object_path, tmp)
+    except OSError:
+        shutil.copyfile(object_path, tmp)
+    os.replace(tmp, dest)
+    return dest
+
+
+class UploadStore:
+    """Objects by SHA-256 plus in-progress upload sessions, under root."""
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.partial_dir = os.path.join(root, "partial")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._session_locks = {}
+        self._hashers = {}      # upload_id -> (offset, sha256 state)
+
+    # ---------------- objects ----------------
+    def object_path(self, digest, ext=""):
+        return os.path.join(self.objects_dir, digest[:2], digest + ext)
+
+    def find(self, digest):
+        """Path of the stored object with this digest, or None."""
+        digest = (digest or "").lower()
+        if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+            return None
+        shard = os.path.join(self.objects_dir, digest[:2])
+        try:
+            names = os.listdir(shard)
+        except OSError:
+            return None
+        for name in names:
+            if name.startswith(digest) and ".tmp-" not in name:
+                return os.path.join(shard, name)
+        return None
+
+    def _commit(self, tmp_path, digest, filename):
+        """Move a fully written temp file into place; keeps an existing copy."""
+        existing = self.find(digest)
+        if existing:
+            os.remove(tmp_path)
+            return existing
+        path = self.object_path(digest, file_extension(filename))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return path
+
+    def put_stream(self, stream, filename):
+        """Store a whole stream (e.g. a multipart file): (digest, path)."""
+        tmp = os.path.join(self.partial_dir, f"direct-{uuid.uuid4().hex}.part")
+        hasher = hashlib.sha256()
+        try:
+            with open(tmp, "wb") as out:
+                while True:
+                    buf = stream.read(COPY_BUFFER)
+                    if not buf:
+                        break
+                    hasher.update(buf)
+                    out.write(buf)
+        except BaseException:
+            _remove(tmp)
+            raise
+        digest = hasher.hexdigest()
+        return digest, self._commit(tmp, digest, filename)
+
+    # ---------------- sessions ----------------
+    def _meta_path(self, upload_id):
+        return os.path.join(self.partial_dir, upload_id + ".json")
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.partial_dir, upload_id + ".part")
+
+    def _session_lock(self, upload_id):
+        with self._lock:
+            return self._session_locks.setdefault(upload_id, threading.Lock())
+
+    def session(self, upload_id):
+        """Metadata of an upload session plus its current offset, or None."""
+        if not upload_id or not all(c in "0123456789abcdef" for c in upload_id):
+            return None
+        try:
+            with open(self._meta_path(upload_id)) as fh:
+                meta = json.load(fh)
+            meta["offset"] = os.path.getsize(self._part_path(upload_id))
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def begin(self, filename, size, sha256=None, **extra):
+        """Open a session for a file of `size` bytes; returns its metadata."""
+        if size < 0:
+            raise ValueError("size must be >= 0")
+        self.purge_expired()
+        upload_id = uuid.uuid4().hex
+        meta = dict(extra, upload_id=upload_id, filename=filename, size=int(size),
+                    sha256=(sha256 or "").lower() or None, created=time.time())
+        open(self._part_path(upload_id), "wb").close()
+        with open(self._meta_path(upload_id), "w") as fh:
+            json.dump(meta, fh)
+        meta["offset"] = 0
+        return meta
+
+    def _hasher_at(self, upload_id, offset):
+        cached = self._hashers.get(upload_id)
+        if cached and cached[0] == offset:
+            return cached[1]
+        # server restarted or a chunk failed halfway: rehash what is on disk
+        hasher = hashlib.sha256()
+        with open(self._part_path(upload_id), "rb") as fh:
+            while True:
+                buf = fh.read(COPY_BUFFER)
+                if not buf:
+                    break
+                hasher.update(buf)
+        return hasher
+
+    def append(self, upload_id, offset, stream):
+        """Write one chunk at `offset`; returns the new offset."""
+        with self._session_lock(upload_id):
+            meta = self.session(upload_id)
+            if meta is None:
+                raise KeyError(upload_id)
+            if offset != meta["offset"]:
+                raise UploadConflict(meta["offset"])
+            hasher = self._hasher_at(upload_id, offset)
+            self._hashers.pop(upload_id, None)
+            written = offset
+            with open(self._part_path(upload_id), "ab") as out:
+                while True:
+                    buf = stream.read(COPY_BUFFER)
+                    if not buf:
+                        break
+                    if written + len(buf) > meta["size"]:
+                        out.truncate(offset)
+                        raise ValueError("Chunk goes past the declared upload size")
+                    hasher.update(buf)
+                    out.write(buf)
+                    written += len(buf)
+            self._hashers[upload_id] = (written, hasher)
+            return written
+
+    def finish(self, upload_id):
+        """Verify and store a complete upload: (digest, path, metadata)."""
+        with self._session_lock(upload_id):
+            meta = self.session(upload_id)
+            if meta is None:
+                raise KeyError(upload_id)
+            if meta["offset"] != meta["size"]:
+                raise UploadConflict(meta["offset"])
+            digest = self._hasher_at(upload_id, meta["offset"]).hexdigest()
+            self._hashers.pop(upload_id, None)
+            if meta["sha256"] and meta["sha256"] != digest:
+                self.abort(upload_id)
+                raise ValueError("SHA-256 mismatch, upload discarded")
+            path = self._commit(self._part_path(upload_id), digest, meta["filename"])
+            _remove(self._meta_path(upload_id))
+        with self._lock:
+            self._session_locks.pop(upload_id, None)
+        return digest, path, meta
+
+    def abort(self, upload_id):
+        self._hashers.pop(upload_id, None)
+        _remove(self._part_path(upload_id))
+        _remove(self._meta_path(upload_id))
+
+    def purge_expired(self):
+        """Drop sessions untouched for UPLOAD_EXPIRE_SECONDS."""
+        cutoff = time.time() - UPLOAD_EXPIRE_SECONDS
+        touched = {}    # upload_id or stray file name -> newest mtime
+        for name in os.listdir(self.partial_dir):
+            stem, ext = os.path.splitext(name)
+            key = stem if ext in (".part", ".json") else name
+            try:
+                mtime = os.path.getmtime(os.path.join(self.partial_dir, name))
+            except OSError:
+                continue
+            touched[key] = max(mtime, touched.get(key, mtime))
+        for key, mtime in touched.items():
+            if mtime >= cutoff:
+                continue
+            # the meta file is written once in begin(): a session that is
+            # still receiving chunks is kept alive by its .part file
+            _remove(os.path.join(self.partial_dir, key))
+            self.abort(key)
+            with self._lock:
+                self._session_locks.pop(key, None)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# ------------------------------------------------------
+#  HTTP
+# ------------------------------------------------------
+def upload_blueprint(store, on_complete=None, known_digests=False):
+    """
+    Routes for resumable uploads into `store`.
+
+    POST   /uploads               {filename, size, sha256?, path?}
+           -> {upload_id, offset, chunk_size}, or {complete: true, ...}
+              straight away when known_digests is set and sha256 names
+              an object already stored
+    GET    /uploads/<id>          -> {upload_id, offset, size}  (resume point)
+    PUT    /uploads/<id>?offset=N raw chunk body -> {offset}
+           (409 with the server's offset if N does not match)
+    POST   /uploads/<id>/complete -> {complete: true, sha256, ...}
+    DELETE /uploads/<id>
+
+    on_complete(digest, object_path, meta) may return extra response
+    fields (e.g. where the file was linked).
+
+    known_digests lets a client skip sending a file the store already
+    holds. A claimed digest proves nothing about the client having the
+    bytes, so only enable it where on_complete cannot put the object
+    anywhere the client chooses (the viewer links it at meta["path"]).
+    """
+    bp = Blueprint("uploads", __name__)
+
+    def completed(digest, path, meta):
+        out = {"complete": True, "sha256": digest, "size": os.path.getsize(path)}
+        if on_complete is not None:
+            out.update(on_complete(digest, path, meta) or {})
+        return jsonify(out)
+
+    @bp.route("/uploads", methods=["POST"])
+    def create_upload():
+        body = request.get_json(silent=True) or {}
+        filename = body.get("filename")
+        try:
+            size = int(body.get("size"))
+        except (TypeError, ValueError):
+            size = None
+        if not filename or size is None:
+            return jsonify({"error": "filename and size are required"}), 400
+
+        existing = store.find(body.get("sha256")) if known_digests else None
+        # only the documented fields: anything else would be stored in
+        # the session or clash with begin()'s own arguments
+        meta = {"filename": str(filename)}
+        if isinstance(body.get("path"), str):
+            meta["path"] = body["path"]
+        try:
+            if existing and os.path.getsize(existing) == size:
+                return completed(body["sha256"].lower(), existing, meta)
+            meta = store.begin(size=size, sha256=body.get("sha256"), **meta)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"upload_id": meta["upload_id"], "offset": 0, "chunk_size": CHUNK_SIZE})
+
+    @bp.route("/uploads/<upload_id>", methods=["GET"])
+    def upload_status(upload_id):
+        meta = store.session(upload_id)
+        if meta is None:
+            return jsonify({"error": "Upload not found"}), 404
+        return jsonify({"upload_id": upload_id, "offset": meta["offset"], "size": meta["size"]})
+
+    @bp.route("/uploads/<upload_id>", methods=["PUT"])
+    def upload_chunk(upload_id):
+        offset = request.args.get("offset", type=int)
+        if offset is None:
+            return jsonify({"error": "offset is required"}), 400
+        try:
+            new_offset = store.append(upload_id, offset, request.stream)
+        except KeyError:
+            return jsonify({"error": "Upload not found"}), 404
+        except UploadConflict as e:
+            return jsonify({"error": str(e), "offset": e.offset}), 409
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"offset": new_offset})
+
+    @bp.route("/uploads/<upload_id>/complete", methods=["POST"])
+    def complete_upload(upload_id):
+        try:
+            digest, path, meta = store.finish(upload_id)
+        except KeyError:
+            return jsonify({"error": "Upload not found"}), 404
+        except UploadConflict as e:
+            return jsonify({"error": "Upload incomplete", "offset": e.offset}), 409
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return completed(digest, path, meta)
+
+    @bp.route("/uploads/<upload_id>", methods=["DELETE"])
+    def abort_upload(upload_id):
+        store.abort(upload_id)
+        return jsonify({"message": "Upload discarded"})
+
+    return bp